@@ -0,0 +1,243 @@
+"""Contains a pool that manages the lifecycle of the crawler's browser
+instances.
+"""
+from collections import deque
+from selenium.webdriver import PhantomJS as Driver
+from selenium.common.exceptions import WebDriverException
+from threading import Thread, Condition
+import paths
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class BrowserPoolError(WebDriverException):
+    """Raised when no browser can be handed out."""
+
+
+class PooledBrowser:
+    """A browser owned by a BrowserPool.
+
+    driver   - the Selenium driver
+    page_cnt - how many pages have been loaded on it
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.page_cnt = 0
+
+
+class BrowserPool:
+    """Keeps a fixed number of browsers running and hands them out one page at
+    a time.
+
+    No browser is started until the first one is asked for. Then all of them
+    are started in parallel, and each is handed out as soon as it is ready.
+    Browsers are checked before they are handed out and replaced if they
+    crashed, and are restarted after a number of pages or once they use too
+    much memory, since PhantomJS leaks over long scans.
+    """
+
+    # How long to wait for a browser before checking whether the pool closed
+    POLL_INTERVAL = 0.1
+
+    # The most seconds close waits for the browsers to quit
+    CLOSE_TIMEOUT = 1.5
+
+    def __init__(self, size, load_timeout, max_pages=100, max_rss_mb=None):
+        """
+        :param size: The most browsers that may be open at once
+        :param load_timeout: The page load timeout to give each browser
+        :param max_pages: How many pages a browser loads before it is
+            restarted, or None to never restart browsers for it
+        :param max_rss_mb: If set, browsers using more memory than this are
+            restarted
+        """
+        self.started_cnt = 0
+        self.recycled_cnt = 0
+        self.crashed_cnt = 0
+
+        self.__size = max(size, 1)
+        self.__load_timeout = load_timeout
+        self.__max_pages = max_pages
+        self.__max_rss_mb = max_rss_mb
+
+        self.__idle = deque()
+        self.__browsers = set()  # Every running browser, idle or not
+        self.__starting_cnt = 0
+        self.__last_start_error = None
+        self.__closed = False
+        self.__condition = Condition()
+
+    def acquire(self, deadline=None):
+        """Returns a healthy browser, blocking until one is ready. Raises
+        BrowserPoolError if the pool is closed or browsers fail to start.
+
+        :param deadline: An optional Deadline. Raises Cancelled or
+            DeadlineExceeded if it ends before a browser is ready.
+        :return: A PooledBrowser, which must be given back with release
+        """
+        with self.__condition:
+            self._fill()
+
+        while True:
+            with self.__condition:
+                while not self.__idle:
+                    if self.__closed:
+                        raise BrowserPoolError("The browser pool is closed")
+                    if not self.__browsers and not self.__starting_cnt:
+                        error, self.__last_start_error = self.__last_start_error, None
+                        raise BrowserPoolError("Could not start a browser: " + str(error))
+                    if deadline is not None:
+                        deadline.check()
+                    self.__condition.wait(self.POLL_INTERVAL)
+                browser = self.__idle.popleft()
+
+            if self._is_healthy(browser):
+                return browser
+
+            print("Warning: replacing a browser that stopped responding", file=sys.stderr)
+            with self.__condition:
+                self.crashed_cnt += 1
+            self._retire(browser)
+
+    def release(self, browser):
+        """Gives a browser back to the pool after loading a page on it.
+
+        :param browser: A PooledBrowser returned by acquire
+        """
+        browser.page_cnt += 1
+
+        if (self.__max_pages is not None and browser.page_cnt >= self.__max_pages) or self._is_too_big(browser):
+            with self.__condition:
+                self.recycled_cnt += 1
+            self._retire(browser)
+            return
+
+        with self.__condition:
+            if browser not in self.__browsers:
+                # The pool was closed while the browser was in use
+                return
+            self.__idle.append(browser)
+            self.__condition.notify()
+
+    def close(self):
+        """Quits every browser, including the ones in use, which interrupts
+        any page they are loading. The browsers are quit in parallel, and
+        browsers that take longer than CLOSE_TIMEOUT are left to quit in the
+        background.
+        """
+        with self.__condition:
+            self.__closed = True
+            browsers = list(self.__browsers)
+            self.__browsers.clear()
+            self.__idle.clear()
+            self.__condition.notify_all()
+
+        if not browsers:
+            return
+
+        print("closing " + str(len(browsers)) + " browsers...", file=sys.stderr)
+        threads = [Thread(target=self._quit, args=(browser,), daemon=True) for browser in browsers]
+        for thread in threads:
+            thread.start()
+
+        deadline = time.monotonic() + self.CLOSE_TIMEOUT
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        print("Done", file=sys.stderr)
+
+    def _fill(self):
+        """Starts browsers until the pool is full again. Must be called with
+        the condition held.
+        """
+        while not self.__closed and len(self.__browsers) + self.__starting_cnt < self.__size:
+            self.__starting_cnt += 1
+            Thread(target=self._start_browser, daemon=True).start()
+
+    def _start_browser(self):
+        try:
+            driver = Driver(executable_path=paths.driver)
+            driver.set_page_load_timeout(self.__load_timeout)
+        except Exception as e:
+            print("Error: could not start a browser: ", e, file=sys.stderr)
+            with self.__condition:
+                self.__starting_cnt -= 1
+                self.__last_start_error = e
+                self.__condition.notify_all()
+            return
+
+        browser = PooledBrowser(driver)
+        with self.__condition:
+            self.__starting_cnt -= 1
+            self.started_cnt += 1
+            if not self.__closed:
+                self.__browsers.add(browser)
+                self.__idle.append(browser)
+                self.__condition.notify()
+                return
+
+        # The pool was closed while the browser started
+        self._quit(browser)
+
+    def _retire(self, browser):
+        """Quits a browser and starts a replacement for it."""
+        with self.__condition:
+            if browser not in self.__browsers:
+                # Already quit when the pool was closed
+                return
+            self.__browsers.remove(browser)
+            self._fill()
+
+        # Quitting can take a while, so don't make the caller wait for it
+        Thread(target=self._quit, args=(browser,), daemon=True).start()
+
+    def _is_healthy(self, browser):
+        try:
+            return browser.driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def _is_too_big(self, browser):
+        if self.__max_rss_mb is None:
+            return False
+        rss_mb = _get_rss_mb(browser.driver)
+        return rss_mb is not None and rss_mb > self.__max_rss_mb
+
+    @staticmethod
+    def _quit(browser):
+        try:
+            browser.driver.quit()
+        except Exception as e:
+            print("Error: could not quit a browser: ", e, file=sys.stderr)
+
+
+def _get_rss_mb(driver):
+    """Returns the resident memory of the driver's browser process in
+    megabytes, or None if it can't be measured.
+    """
+    try:
+        pid = driver.service.process.pid
+    except AttributeError:
+        return None
+
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return None
+
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/" + str(pid) + "/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except (OSError, ValueError):
+            return None
+
+    return None
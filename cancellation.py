@@ -0,0 +1,96 @@
+"""Contains the cancellation tokens and deadlines that let every blocking step
+of a crawl be cut short, so that closing a crawler doesn't wait on slow page
+loads, downloads or hosts.
+"""
+from threading import Event
+import time
+
+
+class Cancelled(Exception):
+    """Raised when an operation stops because its token was cancelled."""
+
+
+class DeadlineExceeded(Cancelled):
+    """Raised when an operation stops because its deadline passed."""
+
+
+class CancellationToken:
+    """A thread-safe flag that is set once to ask every operation holding the
+    token to stop.
+    """
+
+    def __init__(self):
+        self.__event = Event()
+
+    def cancel(self):
+        self.__event.set()
+
+    def is_cancelled(self):
+        return self.__event.is_set()
+
+    def wait(self, timeout):
+        """Sleeps for up to timeout seconds, waking up early if the token is
+        cancelled.
+
+        :return: True if the token was cancelled
+        """
+        return self.__event.wait(timeout)
+
+    def check(self):
+        """Raises Cancelled if the token was cancelled."""
+        if self.__event.is_set():
+            raise Cancelled()
+
+
+class Deadline:
+    """The point in time an operation must be done by, optionally tied to a
+    CancellationToken.
+    """
+
+    def __init__(self, seconds, token=None):
+        """
+        :param seconds: How many seconds from now the deadline is, or None
+            for no deadline
+        :param token: An optional CancellationToken that also ends the
+            operation
+        """
+        self.token = token
+        self.__end = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        """Returns how many seconds are left, or None if there is no deadline."""
+        if self.__end is None:
+            return None
+        return max(self.__end - time.monotonic(), 0)
+
+    def timeout(self, limit):
+        """Returns the time left, capped at limit. Meant for the timeout
+        argument of blocking calls.
+
+        :param limit: The most seconds to return
+        """
+        remaining = self.remaining()
+        return limit if remaining is None else min(limit, remaining)
+
+    def check(self):
+        """Raises Cancelled if the token was cancelled, or DeadlineExceeded if
+        the deadline has passed.
+        """
+        if self.token is not None:
+            self.token.check()
+        if self.__end is not None and time.monotonic() >= self.__end:
+            raise DeadlineExceeded()
+
+    def sleep(self, seconds):
+        """Sleeps for the given seconds, then raises like check if the
+        operation should stop. Raises DeadlineExceeded right away if the
+        sleep would outlast the deadline.
+        """
+        remaining = self.remaining()
+        if remaining is not None and seconds > remaining:
+            raise DeadlineExceeded()
+        if self.token is not None:
+            self.token.wait(seconds)
+        else:
+            time.sleep(seconds)
+        self.check()
@@ -0,0 +1,119 @@
+"""Contains a SQLite store that lets a crawl be resumed after the program was
+closed or crashed.
+"""
+from frontier import FrontierEntry
+from threading import Lock
+import hashlib
+import sqlite3
+
+
+class CrawlCheckpoint:
+    """Persists the state of a crawl to a SQLite database: the frontier, the
+    URLs that were crawled or found, the image URLs that still have to be
+    downloaded, and the progress counters.
+
+    Crawled and found URLs are only ever added, so each save just appends the
+    ones that are new since the last save. The frontier and pending images are
+    small, and are replaced as a whole.
+    """
+
+    def __init__(self, path, website_list):
+        """
+        :param path: The database file. Created if missing.
+        :param website_list: The seed URLs of the crawl. A checkpoint can only
+            be resumed by a crawl with the same seeds.
+        """
+        self.__lock = Lock()
+        self.__scan_id = hashlib.sha1("\n".join(website_list).encode("utf-8")).hexdigest()
+
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            CREATE TABLE IF NOT EXISTS frontier (position INTEGER PRIMARY KEY, url TEXT,
+                                                 depth INTEGER, parent TEXT, progress_step REAL);
+            CREATE TABLE IF NOT EXISTS crawled_urls (url TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS found_image_urls (url TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS pending_images (position INTEGER PRIMARY KEY, url TEXT,
+                                                       page_url TEXT);
+        """)
+        self.__db.commit()
+
+    def is_resumable(self):
+        """Returns true if the database holds an unfinished crawl of the same
+        seed URLs.
+        """
+        with self.__lock:
+            meta = self._read_meta()
+        return meta.get("scan_id") == self.__scan_id and not meta.get("finished", True)
+
+    def start(self):
+        """Clears any earlier crawl so a new one can be saved."""
+        with self.__lock:
+            for table in ("meta", "frontier", "crawled_urls", "found_image_urls", "pending_images"):
+                self.__db.execute("DELETE FROM " + table)
+            self._write_meta({"scan_id": self.__scan_id, "finished": 0})
+            self.__db.commit()
+
+    def load(self):
+        """Reads the saved crawl.
+
+        :return: A dict with the frontier (a list of FrontierEntry objects),
+        crawled_urls, found_image_urls, pending_images (a list of
+        (image URL, page URL) tuples) and counters (a dict)
+        """
+        with self.__lock:
+            frontier = [FrontierEntry(*row) for row in self.__db.execute(
+                "SELECT url, depth, parent, progress_step FROM frontier ORDER BY position")]
+            crawled_urls = [row[0] for row in self.__db.execute("SELECT url FROM crawled_urls")]
+            found_image_urls = [row[0] for row in self.__db.execute("SELECT url FROM found_image_urls")]
+            pending_images = [tuple(row) for row in self.__db.execute(
+                "SELECT url, page_url FROM pending_images ORDER BY position")]
+            meta = self._read_meta()
+
+        counters = {key[len("counter_"):]: value for key, value in meta.items()
+                    if key.startswith("counter_")}
+
+        return {"frontier": frontier,
+                "crawled_urls": crawled_urls,
+                "found_image_urls": found_image_urls,
+                "pending_images": pending_images,
+                "counters": counters}
+
+    def save(self, frontier, new_crawled_urls, new_found_image_urls, pending_images, counters):
+        """Saves the current state of the crawl in one transaction.
+
+        :param frontier: Every unfinished FrontierEntry
+        :param new_crawled_urls: Page URLs marked as crawled since the last save
+        :param new_found_image_urls: Image URLs found since the last save
+        :param pending_images: (image URL, page URL) tuples of images that
+            were found but not checked yet
+        :param counters: A dict of progress counters to restore on resume
+        """
+        with self.__lock, self.__db:
+            self.__db.execute("DELETE FROM frontier")
+            self.__db.executemany("INSERT INTO frontier (url, depth, parent, progress_step) "
+                                  "VALUES (?, ?, ?, ?)", frontier)
+            self.__db.executemany("INSERT OR IGNORE INTO crawled_urls VALUES (?)",
+                                  ((url,) for url in new_crawled_urls))
+            self.__db.executemany("INSERT OR IGNORE INTO found_image_urls VALUES (?)",
+                                  ((url,) for url in new_found_image_urls))
+            self.__db.execute("DELETE FROM pending_images")
+            self.__db.executemany("INSERT INTO pending_images (url, page_url) VALUES (?, ?)",
+                                  pending_images)
+            self._write_meta({"counter_" + key: value for key, value in counters.items()})
+
+    def finish(self):
+        """Marks the crawl as complete so it won't be resumed."""
+        with self.__lock, self.__db:
+            self._write_meta({"finished": 1})
+
+    def close(self):
+        """Closes the database."""
+        with self.__lock:
+            self.__db.close()
+
+    def _read_meta(self):
+        return dict(self.__db.execute("SELECT key, value FROM meta"))
+
+    def _write_meta(self, values):
+        self.__db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", values.items())
@@ -1,4 +1,22 @@
+from collections import namedtuple
+from itertools import islice
 from plane_tracker import PlaneTracker
+from vocabulary import BinaryVocabulary, TemplateIndex
+import hashlib
+import numpy as np
+import time
+
+
+# The result of matching one image against the templates.
+#   template    - the index in get_template() of the best matching template, or None if none were found
+#   match_ratio - the share of the best template's features that matched, or 0 if none were found
+#   inliers     - how many of those matches agreed with the template's homography
+#   timings     - a dict with the seconds spent on the image in the "prefilter", "coarse", "detect",
+#                 "match" and "verify" stages
+#   rejected_by - the name of the prefilter stage that rejected the image, or None if it was matched with ORB
+#   scores      - a list with the (match_ratio, inliers) of the image against every template, by index, or None for
+#                 the templates whose outcome is unknown
+ImageMatch = namedtuple('ImageMatch', ['template', 'match_ratio', 'inliers', 'timings', 'rejected_by', 'scores'])
 
 
 class CompareImage:
@@ -9,9 +27,43 @@ class CompareImage:
     The class doesn't have to be too accurate, as long as there are few false negatives.
     """
 
-    def __init__(self, features_detect=1500):
-        self.tracker = PlaneTracker(0.025, 10, max_features_detect=1500)
+    BATCH_SIZE = 32  # How many images match_batch matches against the templates at once
+
+    def __init__(self, features_detect=1500, prefilter=None, feature_store=None, frame_scale_factor=4,
+                 coarse_to_fine=False, matcher=None, shortlist_size=0, vocabulary=None, scale_feature_budget=False):
+        """
+        :param features_detect: How many features to detect in each template, and at most in each image
+        :param prefilter: An optional Prefilter, with no templates yet, that images must pass before they are
+            matched with ORB
+        :param feature_store: An optional TemplateFeatureStore to reuse the features of templates seen before
+        :param frame_scale_factor: Images with more than this many times the pixels of the largest template are
+            scaled down before matching. 0 matches every image as it is.
+        :param coarse_to_fine: Whether to skip images whose thumbnail barely matches any template. Faster, but a
+            template that is small in an image can be missed, so it is off by default.
+        :param matcher: The spec of the descriptor matcher, as matchers.create_matcher takes it, or None for the
+            default one
+        :param shortlist_size: If above zero, images are only matched against the templates a visual vocabulary
+            shortlists as this many most likely ones. Needs a vocabulary, from here or from train_vocabulary.
+        :param vocabulary: An optional BinaryVocabulary to index the templates with
+        :param scale_feature_budget: Whether images smaller than the largest template get fewer features, in
+            proportion to their area, with their match ratio out of that many instead of the template's features.
+            Faster on small images, but changes what a match ratio means, so it is off by default.
+        """
+        self.features_detect = features_detect
+        self.frame_scale_factor = frame_scale_factor
+        self.coarse_to_fine = coarse_to_fine
+        self.prefilter = prefilter
+        self.feature_store = feature_store
+        self.tracker = PlaneTracker(0.025, 10, max_features_detect=features_detect,
+                                    frame_scale_factor=frame_scale_factor, coarse_to_fine=coarse_to_fine,
+                                    matcher=matcher, shortlist_size=shortlist_size,
+                                    scale_feature_budget=scale_feature_budget)
+        self.template_index = None
         self.__templates = []  # Keep track of templates being tracked
+        self.__template_ids = []  # A hash of each template image
+
+        if vocabulary is not None:
+            self.set_vocabulary(vocabulary)
 
     def add_template(self, img):
         """
@@ -21,10 +73,15 @@ class CompareImage:
         if img is None: return
 
         h, w, _ = img.shape
+        template_id = hashlib.sha1(str(img.shape).encode("utf-8") + img.tobytes()).hexdigest()
         self.__templates.append(img)
+        self.__template_ids.append(template_id)
+
+        if self.prefilter is not None:
+            self.prefilter.add_template(img)
 
         # Track the whole image
-        self.tracker.add_target(img, (0, 0, w, h))
+        self.__add_target(template_id, img, (0, 0, w, h))
 
         # # Track the center quarter of the image
         # self.tracker.add_target(img, (int(w * .25),
@@ -44,15 +101,190 @@ class CompareImage:
         #                               int(w * .5),
         #                               int(h * .5)))
 
+    def __add_target(self, template_id, img, rect):
+        # Reuses the target's features from the feature store, or detects and stores them
+        if self.feature_store is None:
+            target = self.tracker.add_target(img, rect)
+        else:
+            params = dict(self.tracker.get_detector_params(), rect=rect)
+            features = self.feature_store.load(template_id, params)
+            target = self.tracker.add_target(img, rect, features)
+            if features is None and target is not None:
+                _, keypoints, descrs = self.tracker.get_target_features(len(self.tracker.targets) - 1)
+                self.feature_store.save(template_id, params, keypoints, descrs)
+
+        if self.template_index is not None and target is not None:
+            self.template_index.add_template(target.descrs)
+
+    def remove_template(self, index):
+        """ Stops comparing images to the template at the index. The templates after it move down by one. """
+        del self.__templates[index]
+        del self.__template_ids[index]
+        self.tracker.remove_target(index)
+        if self.prefilter is not None:
+            self.prefilter.remove_template(index)
+        if self.template_index is not None:
+            self.template_index.remove_template(index)
+
     def get_template(self):
         return self.__templates
 
+    def get_template_ids(self):
+        """ Returns a hash of each template image, by index, which stays the same across runs """
+        return list(self.__template_ids)
+
+    def get_options(self):
+        """ Returns the keyword arguments that create a CompareImage which matches images the same way """
+        return {"features_detect": self.features_detect,
+                "frame_scale_factor": self.frame_scale_factor,
+                "scale_feature_budget": self.tracker.scale_feature_budget,
+                "coarse_to_fine": self.coarse_to_fine,
+                "matcher": self.tracker.matcher_spec,
+                "shortlist_size": self.tracker.shortlist_size,
+                "vocabulary": self.template_index.vocabulary if self.template_index is not None else None}
+
+    def get_settings(self):
+        """ Returns a JSON serializable description of the settings that change how images match """
+        stages = self.prefilter.stages if self.prefilter is not None else []
+        vocabulary = self.template_index.vocabulary.get_id() if self.template_index is not None else None
+        return dict(self.get_options(), vocabulary=vocabulary,
+                    prefilter=[(stage.name, stage.max_distance) for stage in stages])
+
+    def set_vocabulary(self, vocabulary, documents=None):
+        """
+        Indexes the templates with a visual vocabulary, for the shortlist. documents can be a dict of template ID to
+        its document in an index with the same vocabulary, to skip quantizing those templates again.
+        """
+        documents = documents or {}
+        self.template_index = TemplateIndex(vocabulary)
+        for template_id, (_, _, descrs) in zip(self.__template_ids, self.tracker.get_target_features()):
+            if template_id in documents:
+                self.template_index.add_document(documents[template_id])
+            else:
+                self.template_index.add_template(descrs)
+        self.tracker.template_index = self.template_index
+
+    def train_vocabulary(self, **kwargs):
+        """
+        Trains a visual vocabulary over the descriptors of the current templates and indexes them with it. The
+        keyword arguments are those of BinaryVocabulary.train. Does nothing if the templates have no descriptors.
+        """
+        descrs = [descrs for _, _, descrs in self.tracker.get_target_features() if len(descrs)]
+        if not descrs:
+            return
+        self.set_vocabulary(BinaryVocabulary.train(np.concatenate(descrs), **kwargs))
+
+    def get_index_documents(self):
+        """ Returns a dict of template ID to the template's document in the template index, as save_index takes """
+        if self.template_index is None:
+            return {}
+        return dict(zip(self.__template_ids, self.template_index.get_documents()))
+
+    def get_template_features(self, index=None):
+        """
+        Returns the features of every template in a form that can be sent to other processes. With an index, returns
+        only those of the template at the index.
+        """
+        signatures = self.prefilter.get_template_signatures() if self.prefilter is not None else []
+        indices = range(len(self.__template_ids)) if index is None else [index]
+        features = [(self.__template_ids[i], self.tracker.get_target_features(i),
+                     signatures[i] if i < len(signatures) else None) for i in indices]
+        return features if index is None else features[0]
+
+    def add_template_features(self, features):
+        """
+        Adds templates from the output of get_template_features, without detecting their features again. The
+        template images themselves are not kept. The prefilter must have the same stages as the one of the
+        CompareImage the features came from.
+        """
+        for template_id, target, signatures in features:
+            self.__templates.append(None)
+            self.__template_ids.append(template_id)
+            self.tracker.add_target_features([target])
+            if self.template_index is not None:
+                self.template_index.add_template(target[2])
+            if self.prefilter is not None and signatures is not None:
+                self.prefilter.add_template_signatures(signatures)
+
     def is_match(self, img, min_match_ratio):
         """ This will compare the img to the images that are currently being compared"""
-        self.tracker.track(img)
+        return self.match_batch([img], min_match_ratio)[0].match_ratio >= min_match_ratio
+
+    def best_match_ratio(self, img):
+        """ Returns the highest match ratio of the img against any template, or 0 if none of them were found """
+        return self.match_batch([img])[0].match_ratio
+
+    def match_batch(self, imgs, min_match_ratio=None, known_scores=None):
+        """
+        Compares every image to the templates and returns a list with an ImageMatch for each, in order. imgs can be
+        any iterable, including a generator. The images are matched in batches of BATCH_SIZE, so the descriptors of
+        a whole batch go through the matcher together.
+
+        If min_match_ratio is given, only whether an image matches at that ratio is worked out, which is much
+        faster with many templates. Matching images get the same template and match_ratio as without it, but every
+        other score that is not None is 0. The scores of the templates that reach the ratio but were not verified
+        are None.
+
+        known_scores can be an iterable with a dict of template ID to the (match_ratio, inliers) already known for
+        each image, like those of a match memo, or None. Images are only matched against the templates they have no
+        score for, and the known scores are merged into their ImageMatch.
+        """
+        imgs = iter(imgs)
+        known_scores = iter(known_scores) if known_scores is not None else None
+        results = []
+        while True:
+            batch = list(islice(imgs, self.BATCH_SIZE))
+            if not batch:
+                return results
+            known = list(islice(known_scores, len(batch))) if known_scores is not None else [None] * len(batch)
+            results += self.__match(batch, min_match_ratio, [scores or {} for scores in known])
+
+    def __match(self, imgs, min_match_ratio, known_scores):
+        # Only the images that pass the prefilter are matched with ORB
+        rejections, prefilter_times = [], []
+        for img in imgs:
+            start = time.perf_counter()
+            rejections.append(self.prefilter.check(img) if self.prefilter is not None else None)
+            prefilter_times.append(time.perf_counter() - start)
+
+        candidates = [i for i, rejected_by in enumerate(rejections) if rejected_by is None]
+        excluded = [[j for j, template_id in enumerate(self.__template_ids) if template_id in known_scores[i]]
+                    for i in candidates]
+        matched = iter(self.tracker.match_frames([imgs[i] for i in candidates], min_match_ratio, excluded))
+
+        results = []
+        for rejected_by, prefilter_time, known in zip(rejections, prefilter_times, known_scores):
+            if rejected_by is None:
+                tracked, timings, evaluated = next(matched)
+            else:
+                # The prefilter only rejects images that are too far from every template
+                tracked, timings = [], {"coarse": 0, "detect": 0, "match": 0, "verify": 0}
+                evaluated = range(len(self.tracker.targets))
+            timings["prefilter"] = prefilter_time
+            results.append(self.__to_image_match(tracked, timings, evaluated, rejected_by, known))
+        return results
+
+    def __to_image_match(self, tracked, timings, evaluated, rejected_by, known):
+        indices = {id(target): i for i, target in enumerate(self.tracker.targets)}
+        scores = [known.get(template_id) for template_id in self.__template_ids]
+        for i in evaluated:
+            if scores[i] is None:
+                scores[i] = (0, 0)
+        for t in tracked:
+            scores[indices[id(t.target)]] = (t.match_ratio, len(t.p0))
+
+        # A known score beats the templates found now only if its match ratio is higher
+        best = max(tracked, key=lambda t: t.match_ratio, default=None)
+        best_template = indices[id(best.target)] if best is not None else None
+        best_known = max((i for i, template_id in enumerate(self.__template_ids) if template_id in known),
+                         key=lambda i: scores[i][0], default=None)
+        if best_known is not None and scores[best_known][0] > (best.match_ratio if best is not None else 0):
+            best_template = best_known
 
-        for tracked in self.tracker.history[0]:
-            if tracked.match_ratio >= min_match_ratio:
-                return True
+        if best_template is None:
+            return ImageMatch(template=None, match_ratio=0, inliers=0, timings=timings, rejected_by=rejected_by,
+                              scores=scores)
 
-        return False
\ No newline at end of file
+        match_ratio, inliers = scores[best_template]
+        return ImageMatch(template=best_template, match_ratio=match_ratio, inliers=inliers, timings=timings,
+                          rejected_by=rejected_by, scores=scores)
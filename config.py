@@ -14,7 +14,43 @@ class Config:
     DEFAULT_SETTINGS = {"search_depth": 1,
                         "max_browsers": 5,
                         "browser_timeout": 30,
-                        "min_match_percent": 30}
+                        "min_match_percent": 30,
+                        "static_fetch": True,
+                        "bloom_capacity": 0,
+                        "bloom_error_rate": 0.001,
+                        "download_workers": 8,
+                        "download_prefetch": 32,
+                        "image_cache_dir": "ImageCache",
+                        "image_cache_max_mb": 512,
+                        "checkpoint_file": "Checkpoint.sqlite",
+                        "checkpoint_interval": 30,
+                        "host_max_concurrency": 2,
+                        "host_min_delay": 0.5,
+                        "obey_robots": True,
+                        "min_image_size": 32,
+                        "max_image_mb": 20,
+                        "max_image_pixels": 40000000,
+                        "decode_pixel_budget": 2000000,
+                        "browser_max_pages": 100,
+                        "browser_max_rss_mb": 500,
+                        "metrics_port": 0,
+                        "partial_page_timeout": 0,
+                        "match_workers": 0,
+                        "prefilter_stages": [],
+                        "prefilter_max_aspect_change": 4.0,
+                        "prefilter_max_histogram_distance": 0.9,
+                        "prefilter_max_hash_distance": 24,
+                        "match_memo_file": "MatchMemo.sqlite",
+                        "match_memo_size": 10000,
+                        "template_feature_dir": "TemplateFeatures",
+                        "features_detect": 1500,
+                        "frame_scale_factor": 4,
+                        "scale_feature_budget": False,
+                        "coarse_to_fine": False,
+                        "matcher": None,
+                        "shortlist_size": 0,
+                        "template_index_file": "TemplateIndex.npz",
+                        "template_index_max_untrained": 0.25}
 
     def __init__(self):
         self.lock = RLock()
@@ -92,6 +128,353 @@ class Config:
         self.__save_to_settings("min_match_percent", value)
 
 
+    @property
+    def static_fetch(self):
+        return self.__load_from_settings("static_fetch")
+
+    @static_fetch.setter
+    def static_fetch(self, value):
+        self.__save_to_settings("static_fetch", value)
+
+
+    @property
+    def bloom_capacity(self):
+        """ How many URLs the crawler's Bloom filters are sized for. 0 means exact sets are used instead """
+        return self.__load_from_settings("bloom_capacity")
+
+    @bloom_capacity.setter
+    def bloom_capacity(self, value):
+        self.__save_to_settings("bloom_capacity", value)
+
+
+    @property
+    def bloom_error_rate(self):
+        return self.__load_from_settings("bloom_error_rate")
+
+    @bloom_error_rate.setter
+    def bloom_error_rate(self, value):
+        self.__save_to_settings("bloom_error_rate", value)
+
+
+    @property
+    def download_workers(self):
+        return self.__load_from_settings("download_workers")
+
+    @download_workers.setter
+    def download_workers(self, value):
+        self.__save_to_settings("download_workers", value)
+
+
+    @property
+    def download_prefetch(self):
+        return self.__load_from_settings("download_prefetch")
+
+    @download_prefetch.setter
+    def download_prefetch(self, value):
+        self.__save_to_settings("download_prefetch", value)
+
+
+    @property
+    def image_cache_dir(self):
+        """ Where downloaded images are cached between scans. An empty string disables the cache """
+        return self.__load_from_settings("image_cache_dir")
+
+    @image_cache_dir.setter
+    def image_cache_dir(self, value):
+        self.__save_to_settings("image_cache_dir", value)
+
+
+    @property
+    def image_cache_max_mb(self):
+        return self.__load_from_settings("image_cache_max_mb")
+
+    @image_cache_max_mb.setter
+    def image_cache_max_mb(self, value):
+        self.__save_to_settings("image_cache_max_mb", value)
+
+
+    @property
+    def checkpoint_file(self):
+        """ Where the crawl state is saved so a scan can be resumed. An empty string disables checkpoints """
+        return self.__load_from_settings("checkpoint_file")
+
+    @checkpoint_file.setter
+    def checkpoint_file(self, value):
+        self.__save_to_settings("checkpoint_file", value)
+
+
+    @property
+    def checkpoint_interval(self):
+        return self.__load_from_settings("checkpoint_interval")
+
+    @checkpoint_interval.setter
+    def checkpoint_interval(self, value):
+        self.__save_to_settings("checkpoint_interval", value)
+
+
+    @property
+    def host_max_concurrency(self):
+        """ The most requests the crawler may have open to a single website """
+        return self.__load_from_settings("host_max_concurrency")
+
+    @host_max_concurrency.setter
+    def host_max_concurrency(self, value):
+        self.__save_to_settings("host_max_concurrency", value)
+
+
+    @property
+    def host_min_delay(self):
+        """ The least amount of seconds between two requests to a single website """
+        return self.__load_from_settings("host_min_delay")
+
+    @host_min_delay.setter
+    def host_min_delay(self, value):
+        self.__save_to_settings("host_min_delay", value)
+
+
+    @property
+    def obey_robots(self):
+        return self.__load_from_settings("obey_robots")
+
+    @obey_robots.setter
+    def obey_robots(self, value):
+        self.__save_to_settings("obey_robots", value)
+
+
+    @property
+    def min_image_size(self):
+        """ Images narrower or shorter than this many pixels are skipped """
+        return self.__load_from_settings("min_image_size")
+
+    @min_image_size.setter
+    def min_image_size(self, value):
+        self.__save_to_settings("min_image_size", value)
+
+
+    @property
+    def max_image_mb(self):
+        return self.__load_from_settings("max_image_mb")
+
+    @max_image_mb.setter
+    def max_image_mb(self, value):
+        self.__save_to_settings("max_image_mb", value)
+
+
+    @property
+    def max_image_pixels(self):
+        return self.__load_from_settings("max_image_pixels")
+
+    @max_image_pixels.setter
+    def max_image_pixels(self, value):
+        self.__save_to_settings("max_image_pixels", value)
+
+
+    @property
+    def decode_pixel_budget(self):
+        """ Larger images are decoded at a reduced resolution to fit about this many pixels """
+        return self.__load_from_settings("decode_pixel_budget")
+
+    @decode_pixel_budget.setter
+    def decode_pixel_budget(self, value):
+        self.__save_to_settings("decode_pixel_budget", value)
+
+
+    @property
+    def browser_max_pages(self):
+        """ How many pages a browser loads before it is restarted """
+        return self.__load_from_settings("browser_max_pages")
+
+    @browser_max_pages.setter
+    def browser_max_pages(self, value):
+        self.__save_to_settings("browser_max_pages", value)
+
+
+    @property
+    def browser_max_rss_mb(self):
+        return self.__load_from_settings("browser_max_rss_mb")
+
+    @browser_max_rss_mb.setter
+    def browser_max_rss_mb(self, value):
+        self.__save_to_settings("browser_max_rss_mb", value)
+
+
+    @property
+    def metrics_port(self):
+        """ The local port that serves scan metrics, or 0 to not serve them """
+        return self.__load_from_settings("metrics_port")
+
+    @metrics_port.setter
+    def metrics_port(self, value):
+        self.__save_to_settings("metrics_port", value)
+
+
+    @property
+    def partial_page_timeout(self):
+        """ Seconds until a slow page is stopped and what loaded is used. 0 means browser_timeout, below 0 drops it """
+        return self.__load_from_settings("partial_page_timeout")
+
+    @partial_page_timeout.setter
+    def partial_page_timeout(self, value):
+        self.__save_to_settings("partial_page_timeout", value)
+
+
+    @property
+    def match_workers(self):
+        """ How many processes match images against the templates, or 0 for one per core """
+        return self.__load_from_settings("match_workers")
+
+    @match_workers.setter
+    def match_workers(self, value):
+        self.__save_to_settings("match_workers", value)
+
+
+    @property
+    def prefilter_stages(self):
+        """ The prefilter stages images must pass before ORB matching, in order. Empty turns the prefilter off. """
+        return self.__load_from_settings("prefilter_stages")
+
+    @prefilter_stages.setter
+    def prefilter_stages(self, value):
+        self.__save_to_settings("prefilter_stages", value)
+
+
+    @property
+    def prefilter_max_aspect_change(self):
+        return self.__load_from_settings("prefilter_max_aspect_change")
+
+    @prefilter_max_aspect_change.setter
+    def prefilter_max_aspect_change(self, value):
+        self.__save_to_settings("prefilter_max_aspect_change", value)
+
+
+    @property
+    def prefilter_max_histogram_distance(self):
+        return self.__load_from_settings("prefilter_max_histogram_distance")
+
+    @prefilter_max_histogram_distance.setter
+    def prefilter_max_histogram_distance(self, value):
+        self.__save_to_settings("prefilter_max_histogram_distance", value)
+
+
+    @property
+    def prefilter_max_hash_distance(self):
+        return self.__load_from_settings("prefilter_max_hash_distance")
+
+    @prefilter_max_hash_distance.setter
+    def prefilter_max_hash_distance(self, value):
+        self.__save_to_settings("prefilter_max_hash_distance", value)
+
+
+    @property
+    def match_memo_file(self):
+        """ The SQLite file match results are remembered in across scans, or empty to only remember them in memory """
+        return self.__load_from_settings("match_memo_file")
+
+    @match_memo_file.setter
+    def match_memo_file(self, value):
+        self.__save_to_settings("match_memo_file", value)
+
+
+    @property
+    def match_memo_size(self):
+        """ How many images to keep match results of in memory, or 0 to not remember match results """
+        return self.__load_from_settings("match_memo_size")
+
+    @match_memo_size.setter
+    def match_memo_size(self, value):
+        self.__save_to_settings("match_memo_size", value)
+
+
+    @property
+    def template_feature_dir(self):
+        """ The folder the features of template images are stored in, or empty to detect them on every start """
+        return self.__load_from_settings("template_feature_dir")
+
+    @template_feature_dir.setter
+    def template_feature_dir(self, value):
+        self.__save_to_settings("template_feature_dir", value)
+
+
+    @property
+    def features_detect(self):
+        """ How many ORB features to detect in each template, and at most in each image """
+        return self.__load_from_settings("features_detect")
+
+    @features_detect.setter
+    def features_detect(self, value):
+        self.__save_to_settings("features_detect", value)
+
+
+    @property
+    def frame_scale_factor(self):
+        """ Images with more than this many times the pixels of the largest template are scaled down. 0 is off. """
+        return self.__load_from_settings("frame_scale_factor")
+
+    @frame_scale_factor.setter
+    def frame_scale_factor(self, value):
+        self.__save_to_settings("frame_scale_factor", value)
+
+
+    @property
+    def scale_feature_budget(self):
+        """ Whether images smaller than the largest template get fewer features, with the match ratio out of them """
+        return self.__load_from_settings("scale_feature_budget")
+
+    @scale_feature_budget.setter
+    def scale_feature_budget(self, value):
+        self.__save_to_settings("scale_feature_budget", value)
+
+
+    @property
+    def coarse_to_fine(self):
+        """ Whether to skip images whose thumbnail barely matches any template. Can miss small templates. """
+        return self.__load_from_settings("coarse_to_fine")
+
+    @coarse_to_fine.setter
+    def coarse_to_fine(self, value):
+        self.__save_to_settings("coarse_to_fine", value)
+
+
+    @property
+    def matcher(self):
+        """ The spec of the descriptor matcher, as scan.py --tune-matcher saves it, or None for the default one """
+        return self.__load_from_settings("matcher")
+
+    @matcher.setter
+    def matcher(self, value):
+        self.__save_to_settings("matcher", value)
+
+
+    @property
+    def shortlist_size(self):
+        """ How many of the most likely templates images are matched against, or 0 to match against every one """
+        return self.__load_from_settings("shortlist_size")
+
+    @shortlist_size.setter
+    def shortlist_size(self, value):
+        self.__save_to_settings("shortlist_size", value)
+
+
+    @property
+    def template_index_file(self):
+        """ Where the visual vocabulary of the template shortlist is kept, or empty to train it every run """
+        return self.__load_from_settings("template_index_file")
+
+    @template_index_file.setter
+    def template_index_file(self, value):
+        self.__save_to_settings("template_index_file", value)
+
+
+    @property
+    def template_index_max_untrained(self):
+        """ The largest share of templates the stored vocabulary may not have been trained on before it is retrained """
+        return self.__load_from_settings("template_index_max_untrained")
+
+    @template_index_max_untrained.setter
+    def template_index_max_untrained(self, value):
+        self.__save_to_settings("template_index_max_untrained", value)
+
+
     # Helper Functions
     def __save_to_settings(self, key, val):
         """ Saves a settings to the settings file"""
@@ -104,7 +487,7 @@ class Config:
                     data = json.load(file)
 
             except FileNotFoundError:
-                data = self.DEFAULT_SETTINGS
+                data = dict(self.DEFAULT_SETTINGS)
 
             # Change the setting
             data[key] = val
@@ -124,4 +507,5 @@ class Config:
             except FileNotFoundError:
                 return self.DEFAULT_SETTINGS[key]
 
-        return data[key]
\ No newline at end of file
+        # Settings files saved by older versions may be missing newer keys
+        return data.get(key, self.DEFAULT_SETTINGS[key])
\ No newline at end of file
@@ -1,58 +1,235 @@
 """Contains an implementation of a web crawler for finding image URLs.
 """
-from urllib.parse import urlparse
-from selenium.webdriver import PhantomJS as Driver
-from selenium.common.exceptions import TimeoutException, StaleElementReferenceException
-from threading import Thread, Timer
-from urllib.error import URLError
-import paths
-import cv2
-import numpy as np
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from threading import Thread, Timer, Lock, Event
+from urllib.error import URLError, HTTPError
+from page_fetcher import StaticFetcher, BrowserFetcher
+from frontier import Frontier, FrontierEntry
+from url_utils import canonicalize_url, url_host, new_url_set
+from downloader import ImageDownloader
+from image_cache import ImageCache
+from image_filter import ImageFilter
+from checkpoint import CrawlCheckpoint
+from politeness import HostScheduler, RobotsCache
+from browser_pool import BrowserPool
+from metrics import MetricsRegistry
+from cancellation import CancellationToken, Cancelled, Deadline, DeadlineExceeded
+import http.client
 import queue
-import urllib
+import sqlite3
+import sys
 
 
-def _same_domain(url1, url2):
-    """Returns true if the two domains have the same domain.
-    :return: true if domains are the same
+class Crawler(Thread):
+    """A basic web crawler that looks for image URLs breadth-first. Every
+    crawl thread pulls pages from one shared frontier, so all browsers stay
+    busy no matter how the pages are spread across the seed websites.
     """
-    return urlparse(url1).netloc == urlparse(url2).netloc
 
+    # Pages fetched without a browser must turn up at least this many images
+    # and links, or else the domain is assumed to need JavaScript
+    MIN_STATIC_IMAGES = 3
+    MIN_STATIC_LINKS = 3
 
-class Crawler(Thread):
-    """A basic web crawler that looks for image URLs recursively.
-    """
+    STATIC_BACKEND = "static"
+    BROWSER_BACKEND = "browser"
+
+    # How many more times a page is fetched after its host throttled us
+    THROTTLE_RETRIES = 2
+
+    # A page may take this many load timeouts in all, counting the time spent
+    # waiting for its host, for a browser and on the browser fallback
+    PAGE_DEADLINE_FACTOR = 3
 
-    def __init__(self, website_list, max_depth, max_browser_instances, load_timeout):
+    # The most seconds the crawl takes to wind down after close() is called.
+    # Threads stuck in a blocking call after that are left behind.
+    SHUTDOWN_TIMEOUT = 2
+
+    # How often waiting threads check whether the crawler was closed
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, website_list, max_depth, max_browser_instances, load_timeout,
+                 static_fetch=True, bloom_capacity=0, bloom_error_rate=0.001,
+                 download_workers=8, download_prefetch=32, cache_dir=None, cache_max_mb=512,
+                 checkpoint_file=None, checkpoint_interval=30, resume=False,
+                 host_max_concurrency=2, host_min_delay=0.5, obey_robots=True,
+                 min_image_size=32, max_image_mb=20, max_image_pixels=40000000,
+                 decode_pixel_budget=2000000, browser_max_pages=100, browser_max_rss_mb=500,
+                 partial_page_timeout=0, metrics=None, frontier=None, found_image_urls=None, match_memo=None):
         """Creates a new web crawler.
 
         :param website_list: The list of web URLs to start crawling from
         :param max_depth: The maximum amount of pages deep the crawl should go
         :param max_browser_instances: The maximum amount of browser instances
             that may be open at once
+        :param load_timeout: The amount of seconds to wait for a page to load
+        :param static_fetch: If true, pages are first fetched as plain HTML and
+            a browser is only used for domains where that finds too little
+        :param bloom_capacity: If above zero, crawled page and found image URLs
+            are remembered in Bloom filters sized for this many URLs each,
+            instead of in exact sets. Meant for very large crawls.
+        :param bloom_error_rate: The false positive rate of the Bloom filters
+        :param download_workers: How many images may be downloaded at once
+        :param download_prefetch: How many downloaded images may wait to be
+            taken with get_image
+        :param cache_dir: If set, downloaded images are cached in this folder
+            and only downloaded again if they changed on the server
+        :param cache_max_mb: The most megabytes of images to keep in the cache
+        :param checkpoint_file: If set, the state of the crawl is saved to this
+            SQLite database so that it can be resumed later
+        :param checkpoint_interval: How many seconds to wait between saves
+        :param resume: If true, an unfinished crawl of the same websites saved
+            in checkpoint_file is continued instead of starting over
+        :param host_max_concurrency: The most page loads and image downloads
+            that may be open to one host at once
+        :param host_min_delay: The least amount of seconds between the start of
+            two requests to one host
+        :param obey_robots: If true, links disallowed by robots.txt are not
+            followed, and its Crawl-delay is respected
+        :param min_image_size: Images narrower or shorter than this many
+            pixels are dropped before they are fully downloaded
+        :param max_image_mb: Image files larger than this are dropped
+        :param max_image_pixels: Images with more pixels than this are dropped
+        :param decode_pixel_budget: Larger images are scaled down by a power
+            of two while being decoded to fit about this many pixels
+        :param browser_max_pages: How many pages a browser loads before it is
+            restarted
+        :param browser_max_rss_mb: Browsers using more memory than this are
+            restarted
+        :param partial_page_timeout: Pages still loading in a browser after
+            this many seconds are stopped, and the images and links that
+            loaded so far are used. 0 stops them after load_timeout, which
+            is also the most it can be. If negative, pages that take longer
+            than load_timeout are dropped.
+        :param metrics: The MetricsRegistry to record the crawl's metrics in.
+            A new one is made if not given.
+        :param frontier: The frontier to crawl pages from, in place of a new
+            local one. Used to share a crawl between processes.
+        :param found_image_urls: The set to dedupe image URLs with, in place
+            of a new local one
+        :param match_memo: An optional MatchMemo. Images it has a match for
+            are handed out with it instead of being decoded.
         """
 
         super(Crawler, self).__init__()
 
-        # A value from 0 to 100 showing how complete the crawl is.
-        self.progress = 0
-        self.scraped_page_cnt = 0
-        self.failed_page_cnt = 0
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
 
+        # A value from 0 to 100 showing how complete the crawl is.
+        self.__progress = self.metrics.gauge("crawl_progress_percent", "How complete the crawl is")
+        self.__scraped_pages = self.metrics.counter("pages_scraped_total", "Pages the crawler is done with")
+        self.__failed_pages = self.metrics.counter("page_failures_total", "Pages that could not be loaded",
+                                                   labels=("cause",))
+        self.__partial_pages = self.metrics.counter("pages_partial_total",
+                                                    "Pages that were stopped before they finished loading")
+        self.__page_load_time = self.metrics.histogram("page_load_seconds", "How long pages took to load",
+                                                       labels=("backend",))
 
         self.__running = False
+        self.__cancel = CancellationToken()
+        self.__shutdown_deadline = None  # Set by close
         self.__results = queue.Queue()
+        self.__robots = RobotsCache(StaticFetcher.USER_AGENT, load_timeout) if obey_robots else None
+        self.__scheduler = HostScheduler(host_max_concurrency, host_min_delay, robots=self.__robots)
+
+        self.__image_filter = ImageFilter(min_image_size, max_image_mb * 1024 * 1024, max_image_pixels)
+
+        self.__image_cache = None
+        if cache_dir:
+            self.__image_cache = ImageCache(cache_dir, cache_max_mb * 1024 * 1024)
+        self.__downloader = ImageDownloader(self.__results, download_workers, download_prefetch,
+                                            load_timeout, cache=self.__image_cache,
+                                            scheduler=self.__scheduler,
+                                            image_filter=self.__image_filter,
+                                            pixel_budget=decode_pixel_budget,
+                                            metrics=self.metrics,
+                                            cancel_token=self.__cancel,
+                                            memo=match_memo)
+        self.__match_memo = match_memo
 
         self.__website_list = website_list
-        self.__browser_pool = queue.Queue()
-        self.__crawled_urls = []
-        self.__found_image_urls = []
+        self.__frontier = frontier if frontier is not None else Frontier()
+        self.__crawled_urls = new_url_set(bloom_capacity, bloom_error_rate)
+        self.__found_image_urls = found_image_urls
+        if found_image_urls is None:
+            self.__found_image_urls = new_url_set(bloom_capacity, bloom_error_rate)
         self.__max_depth = max_depth
         self.__load_timeout = load_timeout
         self.__browser_instance_cnt = max_browser_instances
-        self.__browser_close_methods = []
+        # With partial pages, the browser's page load timeout is the point
+        # where a slow page is stopped and harvested
+        self.__harvest_partial = partial_page_timeout >= 0
+        browser_load_timeout = min(partial_page_timeout, load_timeout) if partial_page_timeout > 0 else load_timeout
+        self.__browser_pool = BrowserPool(max_browser_instances, browser_load_timeout,
+                                          max_pages=browser_max_pages, max_rss_mb=browser_max_rss_mb)
         self.__is_finished = False
 
+        # Remembers which fetch backend works for each domain
+        self.__static_fetcher = StaticFetcher(load_timeout) if static_fetch else None
+        self.__domain_backends = {}
+        self.__domain_backends_lock = Lock()
+
+        self.__checkpoint = None
+        if checkpoint_file:
+            self.__checkpoint = CrawlCheckpoint(checkpoint_file, website_list)
+        self.__checkpoint_interval = checkpoint_interval
+        # URLs are marked as seen and queued while holding this lock, so a
+        # checkpoint never sees a URL marked as crawled that is not queued
+        self.__checkpoint_lock = Lock()
+        self.__checkpoint_stop = Event()
+        self.__checkpoint_thread = None
+        self.__resume = resume
+        self.__new_crawled_urls = []
+        self.__new_found_image_urls = []
+
+        self._register_metrics()
+
+    def _register_metrics(self):
+        """Adds the metrics that are read from other parts of the crawler when
+        they are collected.
+        """
+        self.metrics.gauge("frontier_pages", "Pages queued or being crawled",
+                           func=lambda: len(self.__frontier))
+        self.metrics.gauge("image_url_queue_depth", "Image URLs waiting to be downloaded",
+                           func=self.__results.qsize)
+        self.metrics.counter("host_throttled_total", "Responses that asked the crawler to slow down",
+                             func=lambda: self.__scheduler.throttled_cnt)
+        self.metrics.counter("browsers_started_total", "Browsers started",
+                             func=lambda: self.__browser_pool.started_cnt)
+        self.metrics.counter("browsers_recycled_total", "Browsers restarted for their age or memory use",
+                             func=lambda: self.__browser_pool.recycled_cnt)
+        self.metrics.counter("browsers_crashed_total", "Browsers replaced after they stopped responding",
+                             func=lambda: self.__browser_pool.crashed_cnt)
+        if self.__image_cache is not None:
+            self.metrics.counter("image_cache_hits_total", "Images served from the cache",
+                                 func=lambda: self.__image_cache.hit_cnt)
+            self.metrics.counter("image_cache_revalidated_total", "Images served from the cache after a 304",
+                                 func=lambda: self.__image_cache.revalidated_cnt)
+            self.metrics.counter("image_cache_misses_total", "Images downloaded in full",
+                                 func=lambda: self.__image_cache.miss_cnt)
+        if self.__match_memo is not None:
+            self.metrics.counter("match_memo_hits_total", "Images whose match was remembered",
+                                 func=lambda: self.__match_memo.hit_cnt)
+            self.metrics.counter("match_memo_misses_total", "Images that had to be matched",
+                                 func=lambda: self.__match_memo.miss_cnt)
+
+    @property
+    def progress(self):
+        """A value from 0 to 100 showing how complete the crawl is."""
+        return self.__progress.get()
+
+    @property
+    def scraped_page_cnt(self):
+        return self.__scraped_pages.get()
+
+    @property
+    def failed_page_cnt(self):
+        return self.__failed_pages.total()
+
+    @property
+    def partial_page_cnt(self):
+        return self.__partial_pages.get()
+
 
     def run(self):
         """Starts the crawling process the listed websites. The results queue
@@ -60,73 +237,176 @@ class Crawler(Thread):
         """
         self.__running = True
 
-        # Open up all browser windows
-        for i in range(self.__browser_instance_cnt):
-            if not self.__running:
-                break # End prematurely
-
-            browser = Driver(executable_path=paths.driver)
+        if self.__resume and self.__checkpoint is not None and self.__checkpoint.is_resumable():
+            self._restore_checkpoint()
+        else:
+            if self.__checkpoint is not None:
+                self.__checkpoint.start()
+            self._seed_frontier()
 
-            # Set up the browser to be closable
-            self.__browser_close_methods.append(browser.quit)
+        self.__downloader.start()
 
-            # Set the page timeout
-            browser.set_page_load_timeout(self.__load_timeout)
-            self.__browser_pool.put(browser)
+        if self.__checkpoint is not None:
+            self.__checkpoint_thread = Thread(target=self._checkpoint_periodically, daemon=True)
+            self.__checkpoint_thread.start()
 
+        # Browsers are borrowed from the pool one page at a time, and only
+        # opened once a page needs one
         crawl_threads = []
-
-        # Starts crawling the page and returns the given browser to the pool
-        # when finished
-        def crawl_and_return_to_pool(url, browser):
-            progress_weight = (1 / len(self.__website_list)) * 100
-            self._crawl_page(url, browser, progress_weight)
-            self.__browser_pool.put(browser)
-
-        # Start crawling each URL
-        for url in self.__website_list:
-            if not self.__running:
-                break # End prematurely
-
-            # Wait for an unused browser instance
-            browser = self.__browser_pool.get()
-            # Start crawling
-            thread = Thread(target = crawl_and_return_to_pool, args = (url, browser))
+        for i in range(self.__browser_instance_cnt):
+            thread = Thread(target=self._crawl_worker, daemon=True)
             thread.start()
             crawl_threads.append(thread)
 
         # Wait for crawling to finish
         for thread in crawl_threads:
-            thread.join()
+            self._wait_until_closed(lambda timeout: _join_thread(thread, timeout))
+
+        self.__browser_pool.close()
 
-        self._close_browsers()
+        # Let the downloader work through the image URLs that are left
+        self.__downloader.finish()
+        if self._wait_until_closed(self.__downloader.join):
+            self._close_image_cache()
+        else:
+            # Downloads stuck past the shutdown deadline may still use the cache
+            print("Warning: some image downloads did not stop in time", file=sys.stderr)
+
+        if self.__checkpoint is not None:
+            self._stop_checkpointing()
+            if self.__running:
+                # Everything was crawled, so there is nothing left to resume
+                self.__checkpoint.finish()
+            self.__checkpoint.close()
 
         self.__running = False
         self.__is_finished = True
 
+    def _wait_until_closed(self, join):
+        """Waits for something to stop. Once the crawler is closed, gives up
+        when the shutdown deadline passes.
+
+        :param join: A function that waits up to the given amount of seconds
+            and returns True once the thing being waited on has stopped
+        :return: True if it stopped
+        """
+        while True:
+            timeout = self.POLL_INTERVAL
+            if self.__cancel.is_cancelled():
+                timeout = self.__shutdown_deadline.timeout(timeout)
+            if join(timeout):
+                return True
+            if self.__cancel.is_cancelled() and not self.__shutdown_deadline.remaining():
+                return False
+
+    def _seed_frontier(self):
+        """Queues every website, each worth an equal share of the progress bar."""
+        progress_weight = (1 / max(len(self.__website_list), 1)) * 100
+        for url in self.__website_list:
+            url = url.strip()
+            canonical_url = canonicalize_url(url)
+            if canonical_url is None:
+                print("Warning: skipping website that is not an http(s) URL", file=sys.stderr)
+                continue
+            if self._mark_crawled(canonical_url):
+                self.__frontier.put(FrontierEntry(url=url, depth=0, parent=None,
+                                                  progress_step=progress_weight))
+
+    def _restore_checkpoint(self):
+        """Continues the crawl saved in the checkpoint database."""
+        state = self.__checkpoint.load()
+        print("Resuming crawl with " + str(len(state["frontier"])) + " pages left", file=sys.stderr)
+
+        for url in state["crawled_urls"]:
+            self.__crawled_urls.add(url)
+        for url in state["found_image_urls"]:
+            self.__found_image_urls.add(url)
+        for entry in state["frontier"]:
+            self.__frontier.put(entry)
+        for image in state["pending_images"]:
+            self.__results.put(image)
+
+        counters = state["counters"]
+        self.__progress.set(counters.get("progress", 0))
+        self.__scraped_pages.inc(counters.get("scraped_page_cnt", 0))
+        self.__failed_pages.inc(counters.get("failed_page_cnt", 0), cause="before_resume")
+        self.__partial_pages.inc(counters.get("partial_page_cnt", 0))
+
+    def _checkpoint_periodically(self):
+        """Saves a checkpoint every checkpoint_interval seconds until stopped."""
+        while not self.__checkpoint_stop.wait(self.__checkpoint_interval):
+            self._save_checkpoint()
+
+    def _stop_checkpointing(self):
+        """Stops the periodic checkpoint thread."""
+        self.__checkpoint_stop.set()
+        if self.__checkpoint_thread is not None:
+            self.__checkpoint_thread.join()
+
+    def _save_checkpoint(self):
+        """Saves the current state of the crawl to the checkpoint database."""
+        with self.__checkpoint_lock:
+            frontier = self.__frontier.snapshot()
+            new_crawled_urls, self.__new_crawled_urls = self.__new_crawled_urls, []
+            new_found_image_urls, self.__new_found_image_urls = self.__new_found_image_urls, []
+            with self.__results.mutex:
+                pending_images = list(self.__results.queue)
+            pending_images = self.__downloader.get_unfinished() + pending_images
+            counters = {"progress": self.progress,
+                        "scraped_page_cnt": self.scraped_page_cnt,
+                        "failed_page_cnt": self.failed_page_cnt,
+                        "partial_page_cnt": self.partial_page_cnt}
+
+        try:
+            self.__checkpoint.save(frontier, new_crawled_urls, new_found_image_urls,
+                                   pending_images, counters)
+        except sqlite3.Error as e:
+            print("Error: could not save crawl checkpoint: ", e, file=sys.stderr)
+            # Keep the new URLs around for the next save
+            with self.__checkpoint_lock:
+                self.__new_crawled_urls = new_crawled_urls + self.__new_crawled_urls
+                self.__new_found_image_urls = new_found_image_urls + self.__new_found_image_urls
+
+    def _crawl_worker(self):
+        """Crawls pages off the shared frontier until it runs out or the
+        crawler is closed.
+        """
+        while self.__running:
+            entry = self.__frontier.get()
+            if entry is None:
+                break
+
+            try:
+                self._crawl_page(entry)
+            finally:
+                self.__frontier.task_done(entry)
+
 
     def get_image(self):
-        """Returns image data loaded from the crawler. Blocks until a new image
-        has been found or until the crawler has finished running, in which case
-        None is returned.
+        """Returns an image that has already been downloaded by the crawler.
+        Does not block. Returns (None, None) if no image is ready yet.
 
         :return: A tuple with image as a Numpy array and the URL of the page it
         came from, or None
         """
 
-        if self.__running:
-            try:
-                # Load image from URL and convert it to a Numpy array
-                (url, page_url) = self.__results.get_nowait()
-                image = self._url_to_image(url)
-                if image is None:
-                    return None, None
-                return self._url_to_image(url), page_url
-            except queue.Empty:
-                # Try again
-                pass
-
-        return None, None
+        return self.__downloader.get_image()
+
+    def get_download(self):
+        """Like get_image, but also returns the URL of the image.
+
+        :return: A tuple with the image as a Numpy array, the URL of the page
+        it came from and the URL of the image, or (None, None, None)
+        """
+        return self.__downloader.get_download()
+
+    def get_next_download(self):
+        """Returns the next downloaded image without blocking. Images the
+        match memo knew are handed out with their match and not decoded.
+
+        :return: A downloader.Download, or None if no image is ready
+        """
+        return self.__downloader.get_next_download()
 
     def is_finished(self):
         """Returns true if the scraping job is finished.
@@ -134,134 +414,255 @@ class Crawler(Thread):
         """
         return self.__is_finished
 
-    def _crawl_page(self, url, browser, progress_step, depth=0):
+    def get_domain_backend(self, url):
+        """Returns the fetch backend that has been chosen for the URL's domain.
+
+        :param url: Any URL on the domain
+        :return: STATIC_BACKEND, BROWSER_BACKEND, or None if undecided
+        """
+        url = canonicalize_url(url)
+        if url is None:
+            return None
+        with self.__domain_backends_lock:
+            return self.__domain_backends.get(url_host(url))
+
+    def _crawl_page(self, entry):
         """Crawls the given page for images and links to other webpages. Image
-        URLs are put in the results queue. Links are followed and crawled.
+        URLs are put in the results queue. Links to unseen pages on the same
+        domain are added to the frontier.
 
-        :param url: The URL of the page to crawl
-        :param browser: The browser instance to open the page on
-        :param progress_step: The amount to increment progress after this step
-        is finished
-        :param depth: The current crawling depth, starting at zero
+        :param entry: The FrontierEntry of the page to crawl
         """
+        url = entry.url
 
-        if depth > self.__max_depth:
-            self.progress += progress_step
-            return
         if not self.__running:
             # Abort processing the page
             return
 
-        self.__crawled_urls.append(url)
+        next_entries = []
 
-        image_urls = []
-        link_urls = []
-
-        # Load up the page
         try:
-            browser.get(url)
-
-            image_urls = self._get_image_urls(browser)
-            link_urls = self._get_link_urls(browser)
-
-            # Emit the URLs of all unique images in the page
-            for image_url in image_urls:
-                if image_url not in self.__found_image_urls:
-                    self.__results.put((image_url, url))
-                    self.__found_image_urls.append(image_url)
-
-            # Follow links to unique URLs that have the same domain as the parent
-            for link_url in link_urls:
-                if link_url not in self.__crawled_urls and _same_domain(url, link_url):
-                    # Split up the parent's progress step value by the value of a
-                    # single link
-                    next_progress_step = (1 / len(link_urls)) * progress_step
-                    self._crawl_page(link_url, browser, next_progress_step, depth=depth+1)
+            deadline = Deadline(self.__load_timeout * self.PAGE_DEADLINE_FACTOR, self.__cancel)
+
+            # Seed websites were picked by the user, so robots.txt only applies
+            # to the links that are followed from them
+            if entry.depth > 0 and self.__robots is not None and not self.__robots.allowed(url, deadline):
+                print("Info: robots.txt disallows " + url, file=sys.stderr)
+                self.__progress.inc(entry.progress_step)
+                return
+
+            # Load up the page
+            page = self._fetch_page(url, deadline)
+
+            if page.partial:
+                self.__partial_pages.inc()
+                print("Info: page " + url + " was slow, using what loaded of it", file=sys.stderr)
+
+            # URLs are fetched as they were found, and only compared by their canonical URLs
+            image_urls = self._with_canonical_urls(page.image_urls)
+            link_urls = []
+            if entry.depth < self.__max_depth:
+                link_urls = self._with_canonical_urls(page.link_urls)
+        except DeadlineExceeded:
+            self.__failed_pages.inc(cause="deadline")
+            print("Warning: gave up on page " + url + " after waiting too long", file=sys.stderr)
+        except Cancelled:
+            return
         except TimeoutException:
-            # TODO(velovix): Add support for partially loaded pages
-            self.failed_page_cnt += 1
-            print("Warning: page " + url + " timed out")
-        except URLError:
-            self.failed_page_cnt
-            print("Warning: page " + url + " refused connection")
-
-        self.scraped_page_cnt += 1
-
+            self.__failed_pages.inc(cause="timeout")
+            print("Warning: page " + url + " timed out", file=sys.stderr)
+        except (ValueError, TypeError, KeyError) as e:
+            # The browser's script returned something that isn't the expected JSON
+            self.__failed_pages.inc(cause="extract")
+            print("Warning: could not read the images and links of page " + url + ": ", e, file=sys.stderr)
+        except (WebDriverException, URLError) as e:
+            if self.__cancel.is_cancelled():
+                # The browser was quit under the page by close()
+                return
+            if isinstance(e, WebDriverException):
+                self.__failed_pages.inc(cause="browser")
+                print("Warning: browser failed to load page " + url + ": ", e, file=sys.stderr)
+            else:
+                self.__failed_pages.inc(cause="connection")
+                print("Warning: page " + url + " refused connection", file=sys.stderr)
+        else:
+            with self.__checkpoint_lock:
+                # Emit the URLs of all unique images in the page
+                for image_url in self._mark_found(image_urls, deadline):
+                    self.__results.put((image_url, url))
 
-    def _get_image_urls(self, browser):
-        """Returns the URLs of all images in the current page.
+                # Queue links to unique URLs that have the same domain as the parent
+                host = url_host(url)
+                next_entries = [link_url for link_url, canonical_url in link_urls
+                                if url_host(canonical_url) == host and self._mark_crawled(canonical_url)]
 
-        :param browser: The browser that the page is loaded on
-        :return: list of image URLs
-        """
+                if len(next_entries):
+                    # Split up the page's progress step between the pages it links to
+                    next_progress_step = (1 / len(next_entries)) * entry.progress_step
+                    self.__frontier.put_many([FrontierEntry(url=link_url,
+                                                            depth=entry.depth + 1,
+                                                            parent=url,
+                                                            progress_step=next_progress_step)
+                                              for link_url in next_entries])
 
-        images = browser.find_elements_by_css_selector("img")
-        urls = []
-        for image in images:
-            try:
-                new_url = image.get_attribute("src")  # Throws error sometimes
-                if new_url is not None:
-                    urls.append(new_url)
-            except StaleElementReferenceException as e:
-                print("ERROR: Tried to get a URL that has already disappeared from page", e)
-        return urls
+        if not len(next_entries):
+            self.__progress.inc(entry.progress_step)
 
+        self.__scraped_pages.inc()
 
-    def _get_link_urls(self, browser):
-        """Returns the URLs of all links in the current page.
+    def _mark_crawled(self, url):
+        """Records that the page URL has been queued for crawling.
 
-        :param browser: The browser that the page is loaded on
-        :return: list of link URLs
+        :param url: The canonical URL of the page
+        :return: True if the URL had not been seen before
         """
-        urls = []
-
-        # OLD METHOD: Opens tons of sockets and causes failures in windows
-        links = browser.find_elements_by_css_selector("a")
-        for link in links:
+        if self.__crawled_urls.add(url):
+            if self.__checkpoint is not None:
+                self.__new_crawled_urls.append(url)
+            return True
+        return False
+
+    def _mark_found(self, urls, deadline=None):
+        """Records that the image URLs have been emitted. They are checked in
+        one batch, since the set may live in another process.
+
+        :param urls: A list of the (URL, canonical URL) of every image
+        :param deadline: The Deadline of the page, which a set in another
+            process stops waiting for it by
+        :return: The URLs whose canonical URL had not been seen before
+        """
+        if not urls:
+            return []
+        canonical_urls = [canonical_url for _, canonical_url in urls]
+        is_new = self.__found_image_urls.add_many(canonical_urls, deadline)
+        if self.__checkpoint is not None:
+            self.__new_found_image_urls.extend(url for url, new in zip(canonical_urls, is_new) if new)
+        return [url for (url, _), new in zip(urls, is_new) if new]
+
+    @staticmethod
+    def _with_canonical_urls(urls):
+        """Pairs every URL with its canonical URL, leaving out those that
+        aren't http or https URLs.
+
+        :param urls: A list of absolute URLs
+        :return: A list of (URL, canonical URL) tuples
+        """
+        pairs = [(url, canonicalize_url(url)) for url in urls]
+        return [(url, canonical_url) for url, canonical_url in pairs if canonical_url is not None]
+
+    def _fetch_page(self, url, deadline):
+        """Loads the page with the backend chosen for its domain. The first
+        page of a domain is tried without a browser. If that finds too few
+        images or links, the domain is switched over to the browser for the
+        rest of the crawl.
+
+        :param url: The URL of the page to load
+        :param deadline: The Deadline the page must be loaded by
+        :return: A Page with the image and link URLs found on the page
+        """
+        domain = url_host(url)
+
+        with self.__domain_backends_lock:
+            backend = self.__domain_backends.get(domain)
+
+        if self.__static_fetcher is not None and backend != self.BROWSER_BACKEND:
+            page = self._fetch_static(url, deadline)
+
+            if backend == self.STATIC_BACKEND:
+                # The domain is known to work statically, so only this page
+                # falls back to the browser
+                if page is not None:
+                    return page
+            elif page is not None and \
+                    len(page.image_urls) >= self.MIN_STATIC_IMAGES and \
+                    len(page.link_urls) >= self.MIN_STATIC_LINKS:
+                with self.__domain_backends_lock:
+                    self.__domain_backends[domain] = self.STATIC_BACKEND
+                return page
+            else:
+                print("Info: using a browser for " + domain, file=sys.stderr)
+                with self.__domain_backends_lock:
+                    self.__domain_backends[domain] = self.BROWSER_BACKEND
+
+        browser = self.__browser_pool.acquire(deadline)
+        try:
+            with self.__scheduler.slot(url, deadline), self.__page_load_time.time(backend=self.BROWSER_BACKEND):
+                return BrowserFetcher(browser.driver, self.__harvest_partial).fetch(url, deadline)
+        finally:
+            self.__browser_pool.release(browser)
+
+    def _fetch_static(self, url, deadline):
+        """Fetches the page without a browser. If the host is throttling
+        requests, waits for it and tries again.
+
+        :param url: The URL of the page to load
+        :param deadline: The Deadline the page must be loaded by
+        :return: A Page, or None if the page could not be fetched
+        """
+        for attempt in range(self.THROTTLE_RETRIES + 1):
             try:
-                new_url = link.get_attribute("href")
-                urls.append(new_url)
-            except StaleElementReferenceException as e:
-                print("Error; Unable to get a link attribute: ", e)
-
-        return urls
-
+                with self.__scheduler.slot(url, deadline), self.__page_load_time.time(backend=self.STATIC_BACKEND):
+                    page = self.__static_fetcher.fetch(url, deadline)
+            except HTTPError as e:
+                error = e
+                if e.code not in HostScheduler.THROTTLE_STATUS_CODES:
+                    break
+                self.__scheduler.report_throttled(url, e.headers.get("Retry-After"), deadline)
+            except (OSError, ValueError, LookupError, http.client.HTTPException) as e:
+                error = e
+                break
+            else:
+                self.__scheduler.report_success(url)
+                return page
+
+        print("Warning: static fetch of " + url + " failed: ", error, file=sys.stderr)
+        return None
+
+    def get_cache_stats(self):
+        """Returns how many images were served by the image cache.
+
+        :return: A dict with hit, revalidated and miss counts, or None if the
+        cache is disabled
+        """
+        if self.__image_cache is None:
+            return None
+        return {"hit": self.__image_cache.hit_cnt,
+                "revalidated": self.__image_cache.revalidated_cnt,
+                "miss": self.__image_cache.miss_cnt}
 
-    def _url_to_image(self, url):
-        """ Download the image, convert it to a NumPy array, and then read it into OpenCV format"""
-        # image_data = urllib.request.urlopen(url).read()
-        # return np.array(Image.open(io.BytesIO(image_data)))
+    def get_rejected_image_counts(self):
+        """Returns how many images were dropped before being fully downloaded.
 
-        try:
-            resp = urllib.request.urlopen(url, timeout=self.__load_timeout)
-        except URLError as e:
-            print("Error: Could not get image from: ", url, " because: ", e)
-            return None
-        except ValueError as e:
-            print("Error: Tried to open a URL that had a length of zero",e)
-            return None
-        except ConnectionAbortedError as e:
-            print("Error: Computer lost internet connection", e)
-        except Exception as e:
-            print("URL Before crash: ", url)
-            raise
-
-        image = np.asarray(bytearray(resp.read()), dtype="uint8")
-        if len(image):
-            image = cv2.imdecode(image, cv2.IMREAD_COLOR)
-            return image
-        else:
-            return None
+        :return: A dict of rejection reason to count
+        """
+        return self.__image_filter.get_rejected_counts()
 
-    def _close_browsers(self):
-        """Closes all browser instances."""
-        for cl in self.__browser_close_methods:
-            print("closing a browser...")
-            cl()
-            print("Done")
+    def _close_image_cache(self):
+        """Closes the image cache once no downloads can use it anymore."""
+        if self.__image_cache is not None:
+            self.__image_cache.close()
 
     def close(self):
-        """Prematurely stops crawling pages.
+        """Prematurely stops crawling pages. Every page load, download and
+        wait in progress is cancelled, and the crawler finishes within about
+        SHUTDOWN_TIMEOUT seconds. Blocks while a last checkpoint is saved, if
+        checkpoints are on, and for up to BrowserPool.CLOSE_TIMEOUT seconds
+        while it joins the threads that quit the browsers.
         """
+        if self.__checkpoint is not None and self.__running:
+            # Save before stopping, while the pages being crawled still count
+            # as unfinished
+            self._stop_checkpointing()
+            self._save_checkpoint()
+
+        self.__shutdown_deadline = Deadline(self.SHUTDOWN_TIMEOUT)
+        self.__cancel.cancel()
         self.__running = False
-        self._close_browsers()
+        self.__frontier.close()
+        self.__downloader.close()
+        self.__browser_pool.close()
+
+
+def _join_thread(thread, timeout):
+    thread.join(timeout)
+    return not thread.is_alive()
@@ -0,0 +1,885 @@
+"""Spreads one scan over several worker processes, which may run on different
+machines.
+
+A coordinator holds the crawl frontier and the sets of seen page and image
+URLs for the whole scan. Workers each run their own Crawler and CompareImage.
+They lease pages from the coordinator, send back the links they find, ask it
+which image URLs are new, and report their matches to it. The coordinator
+writes every match as a line of JSON, like scan.py, and saves checkpoints of
+the crawl that it can resume from, like a Crawler.
+
+The frontier is split into shards by a hash of the page's host, and each shard
+is owned by one worker at a time, so every host is only crawled from one
+place and the per-host politeness limits still hold. Shards are moved between
+workers to even them out when workers join or leave, but a shard only leaves
+a live worker once none of its pages are leased to it. Pages leased by a
+worker that stops responding are queued again.
+
+Workers talk to the coordinator over TCP, one JSON object per line each way.
+Anyone who can reach the coordinator can steer the crawl, so it only listens
+on other addresses than loopback with a shared token, which workers must send
+before any other request. The token is best passed in the COORDINATOR_TOKEN
+environment variable, where other users can't see it.
+
+    python distributed.py coordinator -w Websites.txt --port 8765 [--resume]
+    python distributed.py worker Templates --coordinator 127.0.0.1:8765
+"""
+from cancellation import Cancelled
+from checkpoint import CrawlCheckpoint
+from collections import deque
+from config import Config
+from factories import create_comparer, create_crawler, create_match_memo
+from frontier import FrontierEntry
+from url_utils import canonicalize_url, new_url_set, url_host, UrlSet
+from threading import Thread, Lock, Event
+import argparse
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import scan
+import socket
+import socketserver
+import sqlite3
+import sys
+import time
+
+
+class CoordinatorError(Exception):
+    """Raised when the coordinator rejects a request."""
+
+
+class Coordinator:
+    """Holds the state of a distributed crawl. Thread-safe, since the server
+    handles every worker connection on its own thread.
+    """
+
+    # Replies to workers asking for pages
+    OK = "ok"
+    WAIT = "wait"  # Nothing to do right now, but other workers may add pages
+    DONE = "done"  # Every page has been crawled
+
+    def __init__(self, website_list, output, shard_cnt=64, worker_timeout=60,
+                 bloom_capacity=0, bloom_error_rate=0.001, checkpoint_file=None, resume=False):
+        """
+        :param website_list: The list of web URLs to start crawling from
+        :param output: The file to write match records to
+        :param shard_cnt: How many shards to split the frontier into. Should
+            be well above the number of workers.
+        :param worker_timeout: How many seconds a worker may go without
+            contacting the coordinator before its pages are handed to others
+        :param bloom_capacity: If above zero, seen URLs are remembered in
+            Bloom filters sized for this many URLs each
+        :param bloom_error_rate: The false positive rate of the Bloom filters
+        :param checkpoint_file: If set, save_checkpoint saves the state of the
+            crawl to this SQLite database
+        :param resume: If true, an unfinished crawl of the same websites in
+            checkpoint_file is continued instead of starting over
+        """
+        self.progress = 0
+        self.match_cnt = 0
+
+        self.__output = output
+        self.__shard_cnt = max(shard_cnt, 1)
+        self.__worker_timeout = worker_timeout
+        self.__shards = [deque() for i in range(self.__shard_cnt)]
+        self.__crawled_urls = new_url_set(bloom_capacity, bloom_error_rate)
+        self.__found_image_urls = new_url_set(bloom_capacity, bloom_error_rate)
+
+        # Worker ID -> the time it was last heard from
+        self.__workers = {}
+        self.__next_worker_id = 1
+        # Worker ID -> {page URL: [FrontierEntry, progress handed to its links]}
+        self.__leases = {}
+        # Shard index -> the worker ID that owns it
+        self.__shard_owners = {}
+        self.__had_workers = False
+        self.__lock = Lock()
+
+        self.__checkpoint = None
+        if checkpoint_file:
+            self.__checkpoint = CrawlCheckpoint(checkpoint_file, website_list)
+        # The URLs added since the last checkpoint
+        self.__new_crawled_urls = []
+        self.__new_found_image_urls = []
+
+        if resume and self.__checkpoint is not None and self.__checkpoint.is_resumable():
+            self._restore_checkpoint()
+        else:
+            if self.__checkpoint is not None:
+                self.__checkpoint.start()
+            self._seed(website_list)
+
+    def _seed(self, website_list):
+        progress_weight = (1 / max(len(website_list), 1)) * 100
+        for url in website_list:
+            url = url.strip()
+            canonical_url = canonicalize_url(url)
+            if canonical_url is None:
+                print("Warning: skipping website that is not an http(s) URL", file=sys.stderr)
+                continue
+            if self._mark_crawled(canonical_url):
+                self._queue(FrontierEntry(url=url, depth=0, parent=None, progress_step=progress_weight))
+
+    def _restore_checkpoint(self):
+        state = self.__checkpoint.load()
+        print("Info: resuming crawl with " + str(len(state["frontier"])) + " pages left", file=sys.stderr)
+
+        for url in state["crawled_urls"]:
+            self.__crawled_urls.add(url)
+        for url in state["found_image_urls"]:
+            self.__found_image_urls.add(url)
+        for entry in state["frontier"]:
+            self._queue(entry)
+        self.progress = state["counters"].get("progress", 0)
+        self.match_cnt = state["counters"].get("match_cnt", 0)
+
+    def _mark_crawled(self, canonical_url):
+        """Adds a page URL to the crawled set. Returns true if it is new."""
+        if not self.__crawled_urls.add(canonical_url):
+            return False
+        if self.__checkpoint is not None:
+            self.__new_crawled_urls.append(canonical_url)
+        return True
+
+    def register(self):
+        """Adds a worker to the crawl and gives it a share of the shards.
+
+        :return: The new worker's ID
+        """
+        with self.__lock:
+            worker_id = str(self.__next_worker_id)
+            self.__next_worker_id += 1
+            self.__workers[worker_id] = time.time()
+            self.__leases[worker_id] = {}
+            self.__had_workers = True
+            self._assign_shards()
+        print("Info: worker " + worker_id + " joined", file=sys.stderr)
+        return worker_id
+
+    def leave(self, worker_id):
+        """Removes a worker from the crawl. Any pages it still had leased are
+        queued again.
+        """
+        with self.__lock:
+            self._remove_worker(worker_id)
+        print("Info: worker " + worker_id + " left", file=sys.stderr)
+
+    def heartbeat(self, worker_id):
+        with self.__lock:
+            self._touch(worker_id)
+
+    def get(self, worker_id, max_cnt):
+        """Leases up to max_cnt pages from the worker's shards.
+
+        :return: A tuple of OK, WAIT or DONE and a list of FrontierEntry
+            objects
+        """
+        with self.__lock:
+            self._touch(worker_id)
+            leases = self.__leases[worker_id]
+            # Shards that were pinned to a busy worker may be free to move by now
+            self._assign_shards()
+
+            entries = []
+            for shard, owner in self.__shard_owners.items():
+                queue = self.__shards[shard]
+                while owner == worker_id and queue and len(entries) < max_cnt:
+                    entry = queue.popleft()
+                    leases[entry.url] = [entry, 0]
+                    entries.append(entry)
+            if entries:
+                return self.OK, entries
+
+            if any(self.__shards) or any(self.__leases.values()):
+                return self.WAIT, []
+            return self.DONE, []
+
+    def put(self, worker_id, entries):
+        """Queues the links a worker found on a leased page, dropping the ones
+        that were seen before.
+
+        :return: How many of the entries were queued
+        """
+        with self.__lock:
+            self._touch(worker_id)
+            leases = self.__leases[worker_id]
+
+            accepted_cnt = 0
+            for entry in entries:
+                canonical_url = canonicalize_url(entry.url)
+                if canonical_url is None or not self._mark_crawled(canonical_url):
+                    # Nothing more will come of this link
+                    self.progress += entry.progress_step
+                    continue
+                self._queue(entry)
+                accepted_cnt += 1
+                if entry.parent in leases:
+                    leases[entry.parent][1] += entry.progress_step
+            return accepted_cnt
+
+    def done(self, worker_id, urls):
+        """Marks leased pages as crawled."""
+        with self.__lock:
+            self._touch(worker_id)
+            leases = self.__leases[worker_id]
+            for url in urls:
+                lease = leases.pop(url, None)
+                if lease is not None:
+                    entry, handed_on = lease
+                    self.progress += max(entry.progress_step - handed_on, 0)
+
+    def add_images(self, worker_id, urls):
+        """Records the image URLs a worker found.
+
+        :return: A list with True for every URL that is new to the whole crawl
+        """
+        with self.__lock:
+            self._touch(worker_id)
+        is_new = self.__found_image_urls.add_many(urls)
+        if self.__checkpoint is not None:
+            with self.__lock:
+                self.__new_found_image_urls.extend(url for url, new in zip(urls, is_new) if new)
+        return is_new
+
+    def report_match(self, worker_id, record):
+        """Writes a worker's match record to the output."""
+        record = dict(record, worker=worker_id)
+        with self.__lock:
+            self._touch(worker_id)
+            if record.get("match"):
+                self.match_cnt += 1
+            scan.write_record(self.__output, record)
+
+    def status(self):
+        with self.__lock:
+            return {"progress": min(self.progress, 100),
+                    "queued": sum(len(queue) for queue in self.__shards),
+                    "leased": sum(len(leases) for leases in self.__leases.values()),
+                    "workers": len(self.__workers),
+                    "matches": self.match_cnt}
+
+    def save_checkpoint(self):
+        """Saves the state of the crawl to the checkpoint database, if there
+        is one. Leased pages are saved as queued, since they may not be done.
+        """
+        if self.__checkpoint is None:
+            return
+        with self.__lock:
+            frontier = [entry for leases in self.__leases.values() for entry, _ in leases.values()]
+            frontier += [entry for queue in self.__shards for entry in queue]
+            new_crawled_urls, self.__new_crawled_urls = self.__new_crawled_urls, []
+            new_found_image_urls, self.__new_found_image_urls = self.__new_found_image_urls, []
+            counters = {"progress": self.progress, "match_cnt": self.match_cnt}
+
+        try:
+            self.__checkpoint.save(frontier, new_crawled_urls, new_found_image_urls, [], counters)
+        except sqlite3.Error as e:
+            print("Error: could not save crawl checkpoint: ", e, file=sys.stderr)
+            # Keep the new URLs around for the next save
+            with self.__lock:
+                self.__new_crawled_urls = new_crawled_urls + self.__new_crawled_urls
+                self.__new_found_image_urls = new_found_image_urls + self.__new_found_image_urls
+
+    def close(self):
+        """Closes the checkpoint database. A crawl that is finished by then is
+        marked as such, so it won't be resumed.
+        """
+        if self.__checkpoint is None:
+            return
+        try:
+            if self.is_finished():
+                self.__checkpoint.finish()
+        except sqlite3.Error as e:
+            print("Error: could not save crawl checkpoint: ", e, file=sys.stderr)
+        self.__checkpoint.close()
+
+    def is_finished(self):
+        """Returns true once every page is crawled and every worker that
+        joined has left.
+        """
+        with self.__lock:
+            return self.__had_workers and not self.__workers and not any(self.__shards)
+
+    def reap_workers(self):
+        """Removes workers that have not been heard from in worker_timeout
+        seconds.
+        """
+        with self.__lock:
+            deadline = time.time() - self.__worker_timeout
+            for worker_id, last_seen in list(self.__workers.items()):
+                if last_seen < deadline:
+                    print("Warning: worker " + worker_id + " stopped responding", file=sys.stderr)
+                    self._remove_worker(worker_id)
+
+    def _queue(self, entry):
+        self.__shards[self._shard_of(entry.url)].append(entry)
+
+    def _shard_of(self, url):
+        # A stable hash, so the same host always lands on the same shard
+        digest = hashlib.sha1(url_host(url).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "little") % self.__shard_cnt
+
+    def _touch(self, worker_id):
+        if worker_id not in self.__workers:
+            raise CoordinatorError("Unknown worker " + str(worker_id))
+        self.__workers[worker_id] = time.time()
+
+    def _remove_worker(self, worker_id):
+        """Must be called with the lock held."""
+        if self.__workers.pop(worker_id, None) is None:
+            return
+        for entry, handed_on in self.__leases.pop(worker_id).values():
+            # Crawl it again from the start
+            self.__shards[self._shard_of(entry.url)].appendleft(entry)
+        self._assign_shards()
+
+    def _assign_shards(self):
+        """Spreads the shards as evenly over the workers as it can without
+        taking a shard from a worker that still has pages of it leased, so two
+        workers never crawl the same host at once. Must be called with the
+        lock held.
+        """
+        worker_ids = sorted(self.__workers, key=int)
+        if not worker_ids:
+            self.__shard_owners = {}
+            return
+
+        owned = {worker_id: [] for worker_id in worker_ids}
+        free = []
+        for shard in range(self.__shard_cnt):
+            owner = self.__shard_owners.get(shard)
+            if owner in owned:
+                owned[owner].append(shard)
+            else:
+                free.append(shard)
+
+        def fewest():
+            return min(worker_ids, key=lambda worker_id: (len(owned[worker_id]), int(worker_id)))
+
+        # The shards of workers that left go to those with the fewest
+        for shard in free:
+            owned[fewest()].append(shard)
+
+        # Then shards move from the workers with the most to those with the fewest, if they are idle
+        busy = {worker_id: {self._shard_of(url) for url in self.__leases[worker_id]} for worker_id in worker_ids}
+        for worker_id in sorted(worker_ids, key=lambda worker_id: -len(owned[worker_id])):
+            idle = [shard for shard in owned[worker_id] if shard not in busy[worker_id]]
+            while idle and len(owned[worker_id]) > len(owned[fewest()]) + 1:
+                shard = idle.pop()
+                owned[worker_id].remove(shard)
+                owned[fewest()].append(shard)
+
+        self.__shard_owners = {shard: worker_id for worker_id, shards in owned.items() for shard in shards}
+
+
+def _entry_to_json(entry):
+    return list(entry)
+
+
+def _entry_from_json(values):
+    return FrontierEntry(*values)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of one worker connection."""
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        authenticated = self.server.token is None
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if not authenticated:
+                    # Nothing else is answered until the connection sent the token
+                    authenticated = self._authenticate(request)
+                    reply = {}
+                else:
+                    reply = self._dispatch(coordinator, request)
+            except (ValueError, KeyError, TypeError, CoordinatorError) as e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            if not authenticated:
+                return
+
+    def _authenticate(self, request):
+        token = request.get("token") if request.get("op") == "auth" else None
+        if not isinstance(token, str) or \
+                not hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("utf-8")):
+            raise CoordinatorError("The coordinator needs a valid token")
+        return True
+
+    @staticmethod
+    def _dispatch(coordinator, request):
+        op = request["op"]
+        if op == "register":
+            return {"worker_id": coordinator.register()}
+        if op == "get":
+            status, entries = coordinator.get(request["worker_id"], request["max_cnt"])
+            return {"status": status, "entries": [_entry_to_json(entry) for entry in entries]}
+        if op == "put":
+            entries = [_entry_from_json(values) for values in request["entries"]]
+            return {"accepted": coordinator.put(request["worker_id"], entries)}
+        if op == "done":
+            coordinator.done(request["worker_id"], request["urls"])
+            return {}
+        if op == "add_images":
+            return {"new": coordinator.add_images(request["worker_id"], request["urls"])}
+        if op == "match":
+            coordinator.report_match(request["worker_id"], request["record"])
+            return {}
+        if op == "heartbeat":
+            coordinator.heartbeat(request["worker_id"])
+            return {}
+        if op == "leave":
+            coordinator.leave(request["worker_id"])
+            return {}
+        if op == "status":
+            return coordinator.status()
+        raise CoordinatorError("Unknown request " + str(op))
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    """Serves a Coordinator to workers over TCP."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, coordinator, host, port, token=None):
+        """
+        :param token: The shared token workers must send first, or None to
+            answer anyone
+        """
+        self.coordinator = coordinator
+        self.token = token or None
+        super(CoordinatorServer, self).__init__((host, port), _RequestHandler)
+
+
+def is_loopback(host):
+    """Returns true if every address the host resolves to is a loopback
+    address, so only this machine can connect to a server listening on it.
+    """
+    try:
+        addresses = socket.getaddrinfo(host or None, None, proto=socket.IPPROTO_TCP, flags=socket.AI_PASSIVE)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address[4][0].split("%")[0]).is_loopback for address in addresses)
+
+
+class CoordinatorClient:
+    """A worker's connection to the coordinator. Requests from different
+    threads are sent one at a time. If the connection fails, the next request
+    opens a new one.
+    """
+
+    def __init__(self, host, port, timeout=30, token=None):
+        """
+        :param host: The coordinator's address
+        :param port: The coordinator's port
+        :param timeout: The amount of seconds to wait for a reply
+        :param token: The coordinator's shared token, if it has one
+        """
+        self.__address = (host, port)
+        self.__timeout = timeout
+        self.__token = token
+        self.__socket = None
+        self.__file = None
+        self.__lock = Lock()
+        with self.__lock:
+            self._connect()
+
+    def request(self, op, **kwargs):
+        """Sends a request and waits for the reply. Raises OSError if the
+        connection failed, or CoordinatorError if the request was rejected.
+
+        :return: The reply as a dict
+        """
+        with self.__lock:
+            if self.__file is None:
+                self._connect()
+            return self._send(dict(kwargs, op=op))
+
+    def close(self):
+        with self.__lock:
+            self._disconnect()
+
+    def _connect(self):
+        self.__socket = socket.create_connection(self.__address, timeout=self.__timeout)
+        self.__file = self.__socket.makefile("rwb")
+        if self.__token:
+            self._send({"op": "auth", "token": self.__token})
+
+    def _send(self, request):
+        try:
+            self.__file.write(json.dumps(request).encode("utf-8") + b"\n")
+            self.__file.flush()
+            line = self.__file.readline()
+            if not line:
+                raise ConnectionError("The coordinator closed the connection")
+        except OSError:
+            # A reply that comes in after a timeout would be read as the reply to the next request
+            self._disconnect()
+            raise
+
+        reply = json.loads(line.decode("utf-8"))
+        if "error" in reply:
+            raise CoordinatorError(reply["error"])
+        return reply
+
+    def _disconnect(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__socket.close()
+            self.__file = None
+            self.__socket = None
+
+
+class RemoteFrontier:
+    """A frontier that leases pages from the coordinator, for use in place of
+    a Crawler's local Frontier.
+    """
+
+    # How long to wait before asking again when the coordinator has no pages
+    POLL_INTERVAL = 0.5
+
+    # How often to tell the coordinator this worker is still alive
+    HEARTBEAT_INTERVAL = 10
+
+    def __init__(self, client, worker_id, batch_size):
+        """
+        :param client: The CoordinatorClient to use
+        :param worker_id: The ID the coordinator gave this worker
+        :param batch_size: How many pages to lease at once
+        """
+        self.__client = client
+        self.__worker_id = worker_id
+        self.__batch_size = max(batch_size, 1)
+        self.__entries = deque()
+        self.__in_progress = []
+        self.__lock = Lock()
+        self.__fetch_lock = Lock()
+        self.__closed = Event()
+
+        Thread(target=self._send_heartbeats, daemon=True).start()
+
+    def put(self, entry):
+        self.put_many([entry])
+
+    def put_many(self, entries):
+        """Sends links found on a leased page to the coordinator."""
+        try:
+            self.__client.request("put", worker_id=self.__worker_id,
+                                  entries=[_entry_to_json(entry) for entry in entries])
+        except (OSError, CoordinatorError) as e:
+            print("Error: could not send links to the coordinator: ", e, file=sys.stderr)
+
+    def get(self):
+        """Returns the next leased page, asking the coordinator for more when
+        none are left. Blocks while other workers may still add pages.
+
+        :return: The next FrontierEntry, or None if the crawl is finished or
+        the frontier was closed
+        """
+        while not self.__closed.is_set():
+            # One thread asks the coordinator at a time, without blocking task_done and snapshot meanwhile
+            with self.__fetch_lock:
+                entry = self._next_entry()
+                if entry is not None:
+                    return entry
+
+                try:
+                    reply = self.__client.request("get", worker_id=self.__worker_id, max_cnt=self.__batch_size)
+                except (OSError, CoordinatorError) as e:
+                    print("Error: could not get pages from the coordinator: ", e, file=sys.stderr)
+                    return None
+                if reply["status"] == Coordinator.DONE:
+                    return None
+                with self.__lock:
+                    self.__entries.extend(_entry_from_json(values) for values in reply["entries"])
+
+                entry = self._next_entry()
+                if entry is not None:
+                    return entry
+
+            self.__closed.wait(self.POLL_INTERVAL)
+        return None
+
+    def _next_entry(self):
+        with self.__lock:
+            if not self.__entries:
+                return None
+            entry = self.__entries.popleft()
+            self.__in_progress.append(entry)
+            return entry
+
+    def task_done(self, entry):
+        with self.__lock:
+            self.__in_progress.remove(entry)
+        try:
+            self.__client.request("done", worker_id=self.__worker_id, urls=[entry.url])
+        except (OSError, CoordinatorError) as e:
+            print("Error: could not report a page to the coordinator: ", e, file=sys.stderr)
+
+    def close(self):
+        """Stops handing out pages. Leased pages that were not crawled are
+        given back to the coordinator when the worker leaves.
+        """
+        self.__closed.set()
+
+    def snapshot(self):
+        with self.__lock:
+            return list(self.__in_progress) + list(self.__entries)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def _send_heartbeats(self):
+        while not self.__closed.wait(self.HEARTBEAT_INTERVAL):
+            try:
+                self.__client.request("heartbeat", worker_id=self.__worker_id)
+            except (OSError, CoordinatorError) as e:
+                print("Warning: could not reach the coordinator: ", e, file=sys.stderr)
+
+
+class RemoteUrlSet:
+    """A set of image URLs kept by the coordinator, so that each image is only
+    downloaded by one worker.
+
+    While the coordinator can't be reached, URLs are checked against a local
+    set instead. Images found then may be downloaded again, by this worker or
+    others, but none are dropped.
+    """
+
+    # How many times to try the coordinator again, and the seconds to wait before the first retry, which doubles
+    RETRIES = 3
+    RETRY_DELAY = 0.5
+
+    def __init__(self, client, worker_id):
+        self.__client = client
+        self.__worker_id = worker_id
+        self.__local = UrlSet()
+
+    def add(self, url):
+        return self.add_many([url])[0]
+
+    def add_many(self, urls, deadline=None):
+        """Adds the URLs to the coordinator's set.
+
+        :param deadline: An optional Deadline to stop retrying by. The URLs
+            are checked locally once it passes or is cancelled, since the
+            crawler waits on this while it holds the checkpoint lock.
+        :return: A list with True for every URL that was new to the crawl
+        """
+        for attempt in range(self.RETRIES + 1):
+            try:
+                if attempt > 0:
+                    delay = self.RETRY_DELAY * 2 ** (attempt - 1)
+                    if deadline is not None:
+                        deadline.sleep(delay)
+                    else:
+                        time.sleep(delay)
+                is_new = self.__client.request("add_images", worker_id=self.__worker_id, urls=urls)["new"]
+            except Cancelled:
+                error = "the page was cancelled or ran out of time"
+                break
+            except OSError as e:
+                error = e
+            except CoordinatorError as e:
+                # Asking again won't change the answer
+                error = e
+                break
+            else:
+                return is_new
+
+        print("Warning: could not send image URLs to the coordinator, checking them locally: ", error,
+              file=sys.stderr)
+        return self.__local.add_many(urls)
+
+
+def _parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def run_coordinator(args):
+    try:
+        websites = scan.get_websites(args)
+    except OSError as e:
+        print("Error: could not read websites: ", e, file=sys.stderr)
+        return scan.EXIT_ERROR
+    if not websites:
+        print("Error: there are no websites to scan", file=sys.stderr)
+        return scan.EXIT_ERROR
+
+    if not args.token and not is_loopback(args.host):
+        print("Error: set a token in COORDINATOR_TOKEN or with --token to listen on " + args.host +
+              ", or anyone who can reach it can steer the scan", file=sys.stderr)
+        return scan.EXIT_ERROR
+
+    config = Config()
+    if args.resume and not scan.is_resumable(config.checkpoint_file, websites):
+        print("Warning: there is no unfinished scan of these websites to resume, starting over",
+              file=sys.stderr)
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        coordinator = Coordinator(websites, output, shard_cnt=args.shards, worker_timeout=args.worker_timeout,
+                                  bloom_capacity=config.bloom_capacity, bloom_error_rate=config.bloom_error_rate,
+                                  checkpoint_file=config.checkpoint_file, resume=args.resume)
+    except sqlite3.Error as e:
+        print("Error: could not open the crawl checkpoint: ", e, file=sys.stderr)
+        if output is not sys.stdout:
+            output.close()
+        return scan.EXIT_ERROR
+    try:
+        server = CoordinatorServer(coordinator, args.host, args.port, args.token)
+    except OSError as e:
+        print("Error: could not listen on port " + str(args.port) + ": ", e, file=sys.stderr)
+        coordinator.close()
+        if output is not sys.stdout:
+            output.close()
+        return scan.EXIT_ERROR
+    Thread(target=server.serve_forever, daemon=True).start()
+    print("Waiting for workers on " + args.host + ":" + str(server.server_address[1]), file=sys.stderr)
+
+    last_checkpoint = time.monotonic()
+    try:
+        while not coordinator.is_finished():
+            time.sleep(1)
+            coordinator.reap_workers()
+            if time.monotonic() - last_checkpoint >= config.checkpoint_interval:
+                coordinator.save_checkpoint()
+                last_checkpoint = time.monotonic()
+    except KeyboardInterrupt:
+        print("Scan interrupted", file=sys.stderr)
+        return scan.EXIT_INTERRUPTED
+    finally:
+        server.shutdown()
+        server.server_close()
+        coordinator.save_checkpoint()
+        coordinator.close()
+        if output is not sys.stdout:
+            output.close()
+
+    print("Scan finished, " + str(coordinator.match_cnt) + " matched", file=sys.stderr)
+    return scan.EXIT_MATCH if coordinator.match_cnt else scan.EXIT_NO_MATCH
+
+
+def run_worker(args):
+    config = Config()
+    comparer = create_comparer(config, args.templates, args.prefilter, args.retrain_vocabulary)
+    if comparer is None:
+        return scan.EXIT_ERROR
+
+    host, port = _parse_address(args.coordinator)
+    try:
+        client = CoordinatorClient(host, port, token=args.token)
+        worker_id = client.request("register")["worker_id"]
+    except (OSError, CoordinatorError) as e:
+        print("Error: could not join the coordinator at " + args.coordinator + ": ", e, file=sys.stderr)
+        return scan.EXIT_ERROR
+
+    min_match_percent = args.min_match if args.min_match is not None else config.min_match_percent
+    fast_match_ratio = scan.get_fast_match_ratio(args, min_match_percent)
+    try:
+        memo = create_match_memo(config, comparer, fast_match_ratio)
+    except sqlite3.Error as e:
+        print("Error: could not open the match memo: ", e, file=sys.stderr)
+        return scan.EXIT_ERROR
+
+    overrides = scan.crawler_overrides(args)
+    batch_size = overrides.get("max_browser_instances", config.max_browsers)
+    frontier = RemoteFrontier(client, worker_id, batch_size)
+    # The coordinator seeds the crawl and keeps the checkpoints, so a worker that stops is just started again
+    crawler = create_crawler(config, [], frontier=frontier, found_image_urls=RemoteUrlSet(client, worker_id),
+                             checkpoint_file=None, match_memo=memo, **overrides)
+    crawler.daemon = True
+
+    def report(record):
+        try:
+            client.request("match", worker_id=worker_id, record=record)
+        except (OSError, CoordinatorError) as e:
+            print("Error: could not report a match to the coordinator: ", e, file=sys.stderr)
+
+    try:
+        metrics_server = scan.start_metrics_server(crawler, config, args)
+    except OSError as e:
+        print("Error: could not serve metrics: ", e, file=sys.stderr)
+        if memo is not None:
+            memo.close()
+        return scan.EXIT_ERROR
+
+    engine = scan.create_match_engine(comparer, crawler, config, args, fast_match_ratio)
+    try:
+        crawler.start()
+        tested_cnt, match_cnt = scan.run_scan(crawler, engine, min_match_percent / 100.0, report, args.all, memo)
+    except KeyboardInterrupt:
+        print("Worker interrupted, stopping...", file=sys.stderr)
+        crawler.close()
+        return scan.EXIT_INTERRUPTED
+    finally:
+        engine.close()
+        frontier.close()
+        if memo is not None:
+            memo.close()
+        try:
+            client.request("leave", worker_id=worker_id)
+        except (OSError, CoordinatorError):
+            pass
+        client.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+    if not crawler.is_finished():
+        print("Error: the crawler stopped before finishing", file=sys.stderr)
+        return scan.EXIT_ERROR
+    print("Worker " + worker_id + " scanned " + str(crawler.scraped_page_cnt) + " pages and tested " +
+          str(tested_cnt) + " images, " + str(match_cnt) + " matched", file=sys.stderr)
+    return scan.EXIT_MATCH if match_cnt else scan.EXIT_NO_MATCH
+
+
+def add_token_argument(parser):
+    parser.add_argument("--token", default=os.environ.get("COORDINATOR_TOKEN"),
+                        help="the token workers must send to the coordinator. Needed to listen on other addresses "
+                             "than loopback. Defaults to the COORDINATOR_TOKEN environment variable.")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Runs a scan spread over several worker processes.")
+    subparsers = parser.add_subparsers(dest="mode")
+    subparsers.required = True
+
+    coordinator = subparsers.add_parser("coordinator", help="hand out pages to workers and collect matches")
+    scan.add_website_arguments(coordinator)
+    coordinator.add_argument("-o", "--output", help="the file to append matches to (default: stdout)")
+    coordinator.add_argument("--host", default="127.0.0.1",
+                             help="the address to listen on (default: %(default)s)")
+    coordinator.add_argument("--port", type=int, default=8765, help="the port to listen on (default: %(default)s)")
+    coordinator.add_argument("--shards", type=int, default=64,
+                             help="how many shards to split the frontier into (default: %(default)s)")
+    add_token_argument(coordinator)
+    coordinator.add_argument("--resume", action="store_true",
+                             help="continue an unfinished scan of the same websites")
+    coordinator.add_argument("--worker-timeout", type=int, default=60,
+                             help="seconds before a silent worker's pages are handed out again "
+                                  "(default: %(default)s)")
+
+    worker = subparsers.add_parser("worker", help="crawl and match pages handed out by a coordinator")
+    scan.add_matching_arguments(worker)
+    worker.add_argument("--coordinator", default="127.0.0.1:8765",
+                        help="the coordinator's host:port (default: %(default)s)")
+    add_token_argument(worker)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mode == "coordinator":
+        return run_coordinator(args)
+    return run_worker(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
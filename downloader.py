@@ -0,0 +1,407 @@
+"""Contains the image download stage that sits between the crawler and the
+image matcher.
+"""
+from collections import namedtuple
+from threading import Thread, Lock
+from urllib.error import HTTPError
+from image_filter import ImageRejected, read_image_size
+from cancellation import CancellationToken, Cancelled, Deadline, DeadlineExceeded
+from metrics import MetricsRegistry
+from url_utils import canonicalize_url
+import contextlib
+import cv2
+import hashlib
+import http.client
+import numpy as np
+import queue
+import sqlite3
+import sys
+import urllib.request
+
+
+# An image handed out by the downloader.
+#   image        - the decoded image as a Numpy array, or None if match is set
+#   page_url     - the URL of the page the image was found on
+#   image_url    - the URL of the image
+#   content_hash - the SHA-256 of the image file, or None without a match memo
+#   match        - the memoized ImageMatch if the image was matched before, else None
+#   data         - the image file if match is set, for callers that still want the pixels
+#   known_scores - a dict of template ID to the memoized (match_ratio, inliers) of the image if match is not set,
+#                  so it is only matched against the other templates, else None
+Download = namedtuple('Download', ['image', 'page_url', 'image_url', 'content_hash', 'match', 'data',
+                                   'known_scores'])
+
+
+def decode_image(data, flag=cv2.IMREAD_COLOR):
+    """Decodes an image file into a Numpy array, or returns None if it can't be decoded."""
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+
+
+class ImageDownloader:
+    """Downloads and decodes images with a pool of worker threads, keeping a
+    bounded number of decoded images ready ahead of whoever consumes them.
+    """
+
+    USER_AGENT = "Mozilla/5.0 (compatible; ImageCrawler)"
+
+    # HTTP status codes that are worth retrying
+    RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+    # How often blocked workers check whether they should stop
+    POLL_INTERVAL = 0.1
+
+    # The ways an image can be scaled down while it is decoded
+    REDUCED_DECODE_FLAGS = [(1, cv2.IMREAD_COLOR),
+                            (2, cv2.IMREAD_REDUCED_COLOR_2),
+                            (4, cv2.IMREAD_REDUCED_COLOR_4),
+                            (8, cv2.IMREAD_REDUCED_COLOR_8)]
+
+    def __init__(self, url_queue, worker_cnt, prefetch_cnt, timeout, retries=2, backoff=0.5,
+                 cache=None, scheduler=None, image_filter=None, pixel_budget=None, metrics=None,
+                 cancel_token=None, deadline=None, memo=None):
+        """
+        :param url_queue: The queue of (image URL, page URL) tuples to download
+        :param worker_cnt: How many images may be downloaded at once
+        :param prefetch_cnt: How many decoded images may wait to be consumed
+        :param timeout: The amount of seconds to wait for each request
+        :param retries: How many more times a failed download is tried
+        :param backoff: The amount of seconds to wait before the first retry.
+            This doubles with every retry.
+        :param cache: An optional ImageCache to reuse images from earlier scans
+        :param scheduler: An optional HostScheduler that limits the downloads
+            open to each host
+        :param image_filter: An optional ImageFilter that drops downloads
+            that can't be useful before they are fully downloaded or decoded
+        :param pixel_budget: If set, large images are decoded at a half,
+            quarter or eighth of their size so they have about this many
+            pixels at most
+        :param metrics: An optional MetricsRegistry to record download and
+            decode metrics in
+        :param cancel_token: An optional CancellationToken that stops the
+            workers when cancelled. close() cancels it.
+        :param deadline: The most seconds a single image may take, including
+            waiting for its host and retries. Defaults to the timeout of
+            every attempt added up.
+        :param memo: An optional MatchMemo. Images it already has a match
+            for are handed out with that match, without being decoded.
+        """
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.__downloads = metrics.counter("image_downloads_total", "Images downloaded and decoded",
+                                           labels=("result",))
+        self.__rejections = metrics.counter("image_rejections_total", "Images dropped by the image filter",
+                                            labels=("reason",))
+        self.__download_time = metrics.histogram("image_download_seconds", "How long image downloads took")
+        self.__decode_time = metrics.histogram("image_decode_seconds", "How long images took to decode")
+        self.__cache_errors = metrics.counter("image_cache_errors_total", "Image cache operations that failed",
+                                              labels=("operation",))
+
+        self.__url_queue = url_queue
+        self.__images = queue.Queue(maxsize=max(prefetch_cnt, 1))
+        self.__worker_cnt = max(worker_cnt, 1)
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__cache = cache
+        self.__scheduler = scheduler
+        self.__filter = image_filter
+        self.__pixel_budget = pixel_budget
+        self.__memo = memo
+        self.__cancel = cancel_token if cancel_token is not None else CancellationToken()
+        self.__deadline = deadline if deadline is not None else timeout * (retries + 1)
+
+        # The (image URL, page URL) tuples taken off the URL queue whose images
+        # have not been handed out by get_image yet
+        self.__in_flight = []
+        self.__in_flight_lock = Lock()
+
+        self.__workers = []
+        self.__finishing = False
+
+        metrics.gauge("image_prefetch_depth", "Decoded images waiting to be matched",
+                      func=self.__images.qsize)
+        metrics.gauge("image_downloads_in_flight", "Images being downloaded or waiting to be matched",
+                      func=lambda: len(self.__in_flight))
+
+    @property
+    def downloaded_cnt(self):
+        return self.__downloads.get(result="ok")
+
+    @property
+    def failed_cnt(self):
+        return self.__downloads.get(result="failed")
+
+    def start(self):
+        """Starts the download workers."""
+        for i in range(self.__worker_cnt):
+            worker = Thread(target=self._work, daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def finish(self):
+        """Tells the workers that no more URLs will be queued. They stop once
+        the URL queue is empty.
+        """
+        self.__finishing = True
+
+    def join(self, timeout=None):
+        """Waits for all workers to stop.
+
+        :param timeout: The most seconds to wait, or None to wait for as long
+            as it takes
+        :return: True if every worker stopped
+        """
+        deadline = Deadline(timeout)
+        for worker in self.__workers:
+            worker.join(deadline.remaining())
+        return not any(worker.is_alive() for worker in self.__workers)
+
+    def close(self):
+        """Stops the workers without downloading the remaining URLs. Workers
+        in the middle of a download give up on it.
+        """
+        self.__cancel.cancel()
+
+    def is_finished(self):
+        """Returns true if every worker has stopped and every downloaded image
+        has been consumed.
+        """
+        return not any(worker.is_alive() for worker in self.__workers) and self.__images.empty()
+
+    def get_image(self):
+        """Returns the next downloaded image without blocking.
+
+        :return: A tuple with the image as a Numpy array and the URL of the
+        page it came from, or (None, None) if no image is ready
+        """
+        image, page_url, url = self.get_download()
+        return image, page_url
+
+    def get_download(self):
+        """Returns the next downloaded image and where it came from without
+        blocking. Memoized images are decoded.
+
+        :return: A tuple with the image as a Numpy array, the URL of the page
+        it came from and the URL of the image, or (None, None, None) if no
+        image is ready
+        """
+        download = self.get_next_download()
+        if download is None:
+            return None, None, None
+
+        image = download.image
+        if image is None:
+            image = decode_image(download.data, self._decode_flag(read_image_size(download.data)))
+        return image, download.page_url, download.image_url
+
+    def get_next_download(self):
+        """Returns the next downloaded image without blocking.
+
+        :return: A Download, or None if no image is ready
+        """
+        try:
+            download = self.__images.get_nowait()
+        except queue.Empty:
+            return None
+
+        self._remove_in_flight(download.image_url, download.page_url)
+        return download
+
+    def get_unfinished(self):
+        """Returns the images that were taken off the URL queue but have not
+        been handed out by get_image yet.
+
+        :return: A list of (image URL, page URL) tuples
+        """
+        with self.__in_flight_lock:
+            return list(self.__in_flight)
+
+    def _work(self):
+        """Downloads images until the URL queue runs dry after finish() was
+        called, or until close() is called.
+        """
+        while not self.__cancel.is_cancelled():
+            try:
+                url, page_url = self.__url_queue.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self.__finishing:
+                    break
+                continue
+
+            with self.__in_flight_lock:
+                self.__in_flight.append((url, page_url))
+
+            try:
+                download = self._url_to_download(url, page_url)
+            except ImageRejected as e:
+                self.__downloads.inc(result="rejected")
+                self.__rejections.inc(reason=e.reason)
+                self._remove_in_flight(url, page_url)
+                continue
+            except DeadlineExceeded:
+                print("Error: Gave up on image from: ", url, " after ", self.__deadline, "s", file=sys.stderr)
+                download = None
+            except Cancelled:
+                # Left in flight, so a checkpoint taken before closing keeps it
+                break
+
+            if download is None:
+                self.__downloads.inc(result="failed")
+                self._remove_in_flight(url, page_url)
+                continue
+            self.__downloads.inc(result="ok")
+
+            # Wait for room in the prefetch queue
+            while not self.__cancel.is_cancelled():
+                try:
+                    self.__images.put(download, timeout=self.POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    pass
+
+    def _remove_in_flight(self, url, page_url):
+        with self.__in_flight_lock:
+            self.__in_flight.remove((url, page_url))
+
+    def _url_to_download(self, url, page_url):
+        """ Download the image, convert it to a NumPy array, and then read it into OpenCV format. Images the
+        memo already has a match for are not decoded. Returns a Download, or None if the image could not be
+        downloaded or decoded. Raises ImageRejected if the image filter dropped it, and Cancelled or
+        DeadlineExceeded if the download was cut short."""
+        with self.__download_time.time():
+            data = self._download(url, Deadline(self.__deadline, self.__cancel))
+        if not data:
+            return None
+
+        if self.__filter is not None:
+            # Downloads are checked as they come in, but cached files aren't
+            size = self.__filter.check_header(data, complete=True)
+        else:
+            size = read_image_size(data)
+
+        content_hash, known_scores = None, None
+        if self.__memo is not None:
+            content_hash = hashlib.sha256(data).hexdigest()
+            match = self.__memo.lookup(content_hash)
+            if match is not None:
+                return Download(None, page_url, url, content_hash, match, data, None)
+            known_scores = self.__memo.known_scores(content_hash)
+
+        with self.__decode_time.time():
+            image = decode_image(data, self._decode_flag(size))
+        if image is None:
+            print("Error: Could not decode image from: ", url, file=sys.stderr)
+            return None
+        return Download(image, page_url, url, content_hash, None, None, known_scores)
+
+    def _decode_flag(self, size):
+        """Picks the smallest reduction that brings the image within the pixel
+        budget. JPEGs are then scaled down while they are decoded, which is
+        much faster and uses much less memory than decoding at full size.
+
+        :param size: The ImageSize read from the header, or None if unknown
+        :return: An OpenCV imread flag
+        """
+        if self.__pixel_budget is None or size is None:
+            return cv2.IMREAD_COLOR
+
+        pixels = size.width * size.height
+        for scale, flag in self.REDUCED_DECODE_FLAGS:
+            if pixels <= self.__pixel_budget * scale * scale:
+                return flag
+        return self.REDUCED_DECODE_FLAGS[-1][1]
+
+    def _download(self, url, deadline):
+        """Downloads the URL, retrying with exponential backoff when the error
+        might be temporary.
+
+        :param url: The URL of the image
+        :param deadline: The Deadline the download must be done by
+        :return: The response body, or None if the download failed
+        """
+        headers = {"User-Agent": self.USER_AGENT}
+
+        # The image is fetched from its URL as found, but cached under its canonical URL
+        cache_key = canonicalize_url(url) or url
+        cache_entry = self._use_cache("lookup", cache_key) if self.__cache is not None else None
+        if cache_entry is not None:
+            if cache_entry["fresh"]:
+                data = self._use_cache("read", cache_key, cache_entry)
+                if data is not None:
+                    return data
+                cache_entry = None
+            else:
+                # Only have the server send the image if it changed
+                headers.update(self.__cache.conditional_headers(cache_entry))
+
+        request = urllib.request.Request(url, headers=headers)
+
+        for attempt in range(self.__retries + 1):
+            if attempt > 0:
+                deadline.sleep(self.__backoff * 2 ** (attempt - 1))
+            deadline.check()
+
+            try:
+                with self._host_slot(url, deadline):
+                    with urllib.request.urlopen(request, timeout=deadline.timeout(self.__timeout)) as resp:
+                        if self.__filter is not None:
+                            data = self.__filter.read(resp)
+                        else:
+                            data = resp.read()
+                        response_headers = resp.headers
+            except HTTPError as e:
+                if self.__scheduler is not None and e.code in self.__scheduler.THROTTLE_STATUS_CODES:
+                    self.__scheduler.report_throttled(url, e.headers.get("Retry-After"), deadline)
+                if e.code == 304 and cache_entry is not None:
+                    # Not modified since it was cached
+                    data = self._use_cache("read", cache_key, cache_entry, revalidated_headers=e.headers)
+                    if data is not None:
+                        return data
+                    # The cached file went missing, so download it in full
+                    request.remove_header("If-none-match")
+                    request.remove_header("If-modified-since")
+                    cache_entry = None
+                    error = e
+                    continue
+                if e.code not in self.RETRY_STATUS_CODES:
+                    print("Error: Could not get image from: ", url, " because: ", e, file=sys.stderr)
+                    return None
+                error = e
+            except ValueError as e:
+                print("Error: Tried to open a URL that had a length of zero", e, file=sys.stderr)
+                return None
+            except (OSError, http.client.HTTPException) as e:
+                # URLErrors, timeouts, refused and dropped connections
+                error = e
+            else:
+                if self.__scheduler is not None:
+                    self.__scheduler.report_success(url)
+                if self.__cache is not None:
+                    self._use_cache("store", cache_key, data, response_headers)
+                return data
+
+        print("Error: Could not get image from: ", url, " because: ", error, file=sys.stderr)
+        return None
+
+    def _use_cache(self, operation, *args, **kwargs):
+        """Calls the cache's lookup, read or store method. A cache that can't
+        be used, like one on a full disk or a locked database, only makes
+        the image miss it or not be stored.
+
+        :return: What the method returned, or None if it failed
+        """
+        try:
+            return getattr(self.__cache, operation)(*args, **kwargs)
+        except (OSError, sqlite3.Error) as e:
+            print("Warning: Could not " + operation + " the image cache entry of " + str(args[0]) + ": ", e,
+                  file=sys.stderr)
+            self.__cache_errors.inc(operation=operation)
+            return None
+
+    def _host_slot(self, url, deadline):
+        """Returns a context manager that waits until the URL's host may be
+        sent another request.
+        """
+        if self.__scheduler is None:
+            return contextlib.nullcontext()
+        return self.__scheduler.slot(url, deadline)
@@ -0,0 +1,183 @@
+"""Builds the crawler, the comparer and the match memo from the settings,
+for the GUI, the command line scan and the distributed workers alike.
+"""
+from crawler import Crawler
+from compare_image import CompareImage
+from match_memo import MatchMemo
+from template_store import TemplateFeatureStore
+from prefilter import build_prefilter
+from vocabulary import load_index, save_index, untrained_share
+import cv2
+import os
+import sys
+
+
+TEMPLATE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+
+def create_crawler(config, website_list, resume=False, **overrides):
+    """Creates a Crawler with the scan settings in the config.
+
+    :param config: The Config to read the settings from
+    :param website_list: The list of web URLs to start crawling from
+    :param resume: If true, an unfinished crawl of the same websites is
+        continued
+    :param overrides: Crawler arguments that take precedence over the config
+    :return: A Crawler that has not been started
+    """
+    kwargs = dict(max_depth=config.search_depth,
+                  max_browser_instances=config.max_browsers,
+                  load_timeout=config.browser_timeout,
+                  static_fetch=config.static_fetch,
+                  bloom_capacity=config.bloom_capacity,
+                  bloom_error_rate=config.bloom_error_rate,
+                  download_workers=config.download_workers,
+                  download_prefetch=config.download_prefetch,
+                  cache_dir=config.image_cache_dir,
+                  cache_max_mb=config.image_cache_max_mb,
+                  checkpoint_file=config.checkpoint_file,
+                  checkpoint_interval=config.checkpoint_interval,
+                  resume=resume,
+                  host_max_concurrency=config.host_max_concurrency,
+                  host_min_delay=config.host_min_delay,
+                  obey_robots=config.obey_robots,
+                  min_image_size=config.min_image_size,
+                  max_image_mb=config.max_image_mb,
+                  max_image_pixels=config.max_image_pixels,
+                  decode_pixel_budget=config.decode_pixel_budget,
+                  browser_max_pages=config.browser_max_pages,
+                  browser_max_rss_mb=config.browser_max_rss_mb,
+                  partial_page_timeout=config.partial_page_timeout)
+    kwargs.update(overrides)
+    return Crawler(website_list, **kwargs)
+
+
+def read_images(directory):
+    """Reads every image in the directory, in name order. Raises OSError if
+    the directory can't be listed.
+
+    :return: A generator of images
+    """
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(TEMPLATE_EXTENSIONS):
+            continue
+        img = cv2.imread(os.path.join(directory, name))
+        if img is None:
+            print("Warning: could not read image " + name, file=sys.stderr)
+            continue
+        yield img
+
+
+def load_templates(comparer, template_dir):
+    """Adds every image in the directory to the comparer as a template.
+
+    :return: How many templates were added
+    """
+    cnt = 0
+    for img in read_images(template_dir):
+        comparer.add_template(img)
+        cnt += 1
+    return cnt
+
+
+def create_prefilter(config, stage_names=None):
+    """Creates the Prefilter configured in the settings.
+
+    :param stage_names: The stages to use instead of the ones in the settings
+    :return: The Prefilter, or None if it is turned off
+    """
+    if stage_names is None:
+        stage_names = config.prefilter_stages
+    return build_prefilter(stage_names, config.prefilter_max_aspect_change,
+                           config.prefilter_max_histogram_distance, config.prefilter_max_hash_distance)
+
+
+def create_match_memo(config, comparer, min_match_ratio=None):
+    """Creates the MatchMemo configured in the settings for the comparer's
+    current templates. Raises sqlite3.Error if the memo file can't be opened.
+
+    :param min_match_ratio: The ratio images are only checked against, if
+        they are not scored fully
+    :return: The MatchMemo, or None if it is turned off
+    """
+    if config.match_memo_size <= 0:
+        return None
+    settings = dict(comparer.get_settings(), decode_pixel_budget=config.decode_pixel_budget,
+                    min_match_ratio=min_match_ratio)
+    memo = MatchMemo(config.match_memo_file or None, settings, config.match_memo_size)
+    memo.set_templates(comparer.get_template_ids())
+    return memo
+
+
+def new_comparer(config, prefilter_stages=None):
+    """Creates a CompareImage without templates, with the prefilter and
+    template feature store configured in the settings.
+
+    :param prefilter_stages: The prefilter stages to use instead of the ones
+        in the settings
+    """
+    feature_store = None
+    if config.template_feature_dir:
+        try:
+            feature_store = TemplateFeatureStore(config.template_feature_dir)
+        except OSError as e:
+            print("Warning: not storing template features: ", e, file=sys.stderr)
+    return CompareImage(features_detect=config.features_detect, prefilter=create_prefilter(config, prefilter_stages),
+                        feature_store=feature_store, frame_scale_factor=config.frame_scale_factor,
+                        coarse_to_fine=config.coarse_to_fine, matcher=config.matcher,
+                        shortlist_size=config.shortlist_size, scale_feature_budget=config.scale_feature_budget)
+
+
+def create_comparer(config, template_dir, prefilter_stages=None, retrain_vocabulary=False):
+    """Creates a CompareImage with the templates in the directory. Prints why
+    if there are none.
+
+    :param prefilter_stages: The prefilter stages to use instead of the ones
+        in the settings
+    :param retrain_vocabulary: Whether to train the vocabulary of the
+        template shortlist again, even if the stored one is still good
+    :return: The CompareImage, or None if no template could be loaded
+    """
+    comparer = new_comparer(config, prefilter_stages)
+    try:
+        template_cnt = load_templates(comparer, template_dir)
+    except OSError as e:
+        print("Error: could not read templates: ", e, file=sys.stderr)
+        return None
+    if not template_cnt:
+        print("Error: there are no template images in " + template_dir, file=sys.stderr)
+        return None
+    create_template_index(config, comparer, retrain_vocabulary)
+    return comparer
+
+
+def create_template_index(config, comparer, retrain=False):
+    """Indexes the comparer's templates for the shortlist, with the visual
+    vocabulary in the template index file. If there is none yet, one is
+    trained over the templates and saved. It is also trained again when more
+    than template_index_max_untrained of the templates are ones it was not
+    trained on, or when retrain is set. Does nothing if the shortlist is off
+    or the comparer already has an index.
+    """
+    if config.shortlist_size <= 0 or comparer.template_index is not None:
+        return
+    stored = load_index(config.template_index_file) if config.template_index_file else None
+    template_ids = comparer.get_template_ids()
+
+    if stored is not None and not retrain and \
+            untrained_share(stored[2], template_ids) <= config.template_index_max_untrained:
+        vocabulary, documents, trained_ids = stored
+        comparer.set_vocabulary(vocabulary, documents)
+    else:
+        if stored is not None:
+            print("Info: training the template vocabulary again for the current templates", file=sys.stderr)
+        comparer.train_vocabulary()
+        trained_ids = template_ids
+
+    if comparer.template_index is None or not config.template_index_file:
+        return
+    try:
+        save_index(config.template_index_file, comparer.template_index.vocabulary, comparer.get_index_documents(),
+                   trained_ids)
+    except OSError as e:
+        print("Warning: could not store the template index: ", e, file=sys.stderr)
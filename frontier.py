@@ -0,0 +1,96 @@
+"""Contains the crawl frontier, the shared queue of pages waiting to be
+crawled.
+"""
+from collections import deque, namedtuple
+from threading import Condition
+
+
+# A page waiting to be crawled.
+#   url           - the URL of the page
+#   depth         - how many links away from a seed URL the page is
+#   parent        - the URL of the page that linked here, or None for seeds
+#   progress_step - how much crawl progress the page and its children are worth
+FrontierEntry = namedtuple('FrontierEntry', ['url', 'depth', 'parent', 'progress_step'])
+
+
+class Frontier:
+    """A thread-safe first-in first-out queue of FrontierEntry objects that
+    all crawl threads pull from, which makes the crawl breadth-first.
+
+    The frontier keeps track of which entries have been taken but not yet
+    marked done, so it knows the crawl is finished once it is empty and no
+    thread can add any more entries to it.
+    """
+
+    def __init__(self):
+        self.__entries = deque()
+        self.__in_progress = []
+        self.__closed = False
+        self.__condition = Condition()
+
+    def put(self, entry):
+        """Adds a page to the end of the frontier.
+
+        :param entry: The FrontierEntry to add
+        """
+        with self.__condition:
+            self.__entries.append(entry)
+            self.__condition.notify()
+
+    def put_many(self, entries):
+        """Adds pages to the end of the frontier, in order.
+
+        :param entries: A list of FrontierEntry objects to add
+        """
+        with self.__condition:
+            self.__entries.extend(entries)
+            self.__condition.notify(len(entries))
+
+    def get(self):
+        """Takes the next page off the frontier. Blocks while the frontier is
+        empty but other threads are still crawling pages that may add to it.
+        Each entry returned must be followed by a call to task_done.
+
+        :return: The next FrontierEntry, or None if the crawl is finished or
+        the frontier was closed
+        """
+        with self.__condition:
+            while not self.__entries and self.__in_progress and not self.__closed:
+                self.__condition.wait()
+
+            if self.__closed or not self.__entries:
+                return None
+
+            entry = self.__entries.popleft()
+            self.__in_progress.append(entry)
+            return entry
+
+    def task_done(self, entry):
+        """Marks an entry returned by get as finished.
+
+        :param entry: The FrontierEntry that was returned by get
+        """
+        with self.__condition:
+            self.__in_progress.remove(entry)
+            if not self.__in_progress:
+                # Threads waiting on an empty frontier may now be done
+                self.__condition.notify_all()
+
+    def close(self):
+        """Stops handing out entries and wakes up every waiting thread."""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def snapshot(self):
+        """Returns every entry that has not been finished yet, including the
+        ones being crawled right now, in the order they were taken or queued.
+
+        :return: A list of FrontierEntry objects
+        """
+        with self.__condition:
+            return list(self.__in_progress) + list(self.__entries)
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__entries)
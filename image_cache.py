@@ -0,0 +1,235 @@
+"""Contains a persistent on-disk cache of downloaded image bytes, so repeat
+scans of the same websites only download images that have changed.
+"""
+from email.utils import parsedate_to_datetime
+from threading import Lock, get_ident
+import hashlib
+import os
+import sqlite3
+import time
+
+
+class ImageCache:
+    """A content-addressed disk cache for image downloads.
+
+    Image bytes are stored in files named after the hash of their content, so
+    an image served under many URLs is only stored once. A small SQLite index
+    maps each URL to its content and to the validators (ETag, Last-Modified
+    and Cache-Control expiry) needed to revalidate it with a conditional
+    request. The least recently used entries are evicted once the cache grows
+    past its size cap.
+    """
+
+    INDEX_FILE = "index.sqlite"
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param directory: The folder to keep the cache in. Created if missing.
+        :param max_bytes: The most image bytes to keep on disk
+        """
+        self.hit_cnt = 0  # Served from the cache without a request
+        self.revalidated_cnt = 0  # Served from the cache after a 304 response
+        self.miss_cnt = 0  # Downloaded in full
+
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.__db = sqlite3.connect(os.path.join(directory, self.INDEX_FILE), check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                          "url TEXT PRIMARY KEY, "
+                          "hash TEXT NOT NULL, "
+                          "size INTEGER NOT NULL, "
+                          "etag TEXT, "
+                          "last_modified TEXT, "
+                          "expires REAL, "
+                          "last_used REAL NOT NULL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.__db.commit()
+
+        # The size of all distinct content files, kept up to date as entries
+        # are added and removed
+        row = self.__db.execute("SELECT SUM(size) FROM "
+                                "(SELECT MAX(size) AS size FROM entries GROUP BY hash)").fetchone()
+        self.__stored_bytes = row[0] or 0
+
+    def lookup(self, url):
+        """Returns the cached entry for the URL.
+
+        :param url: The canonical URL of the image
+        :return: A dict with the entry's hash, etag, last_modified and fresh
+        keys, or None if the URL is not cached
+        """
+        with self.__lock:
+            row = self.__db.execute("SELECT hash, etag, last_modified, expires FROM entries "
+                                    "WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+
+        content_hash, etag, last_modified, expires = row
+        return {"hash": content_hash,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fresh": expires is not None and expires > time.time()}
+
+    def conditional_headers(self, entry):
+        """Returns the request headers that ask the server to only send the
+        image if it changed since the entry was cached.
+
+        :param entry: An entry returned by lookup
+        :return: A dict of HTTP headers
+        """
+        headers = {}
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def read(self, url, entry, revalidated_headers=None):
+        """Returns the cached bytes for an entry and marks it as recently used.
+
+        :param url: The canonical URL of the image
+        :param entry: An entry returned by lookup
+        :param revalidated_headers: The headers of a 304 response, if the entry
+            was just revalidated with the server
+        :return: The image bytes, or None if the content file has gone missing
+        """
+        try:
+            with open(self._content_path(entry["hash"]), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            self.remove(url)
+            return None
+
+        with self.__lock:
+            if revalidated_headers is not None:
+                self.__db.execute("UPDATE entries SET expires = ?, last_used = ? WHERE url = ?",
+                                  (_expiry_time(revalidated_headers), time.time(), url))
+                self.revalidated_cnt += 1
+            else:
+                self.__db.execute("UPDATE entries SET last_used = ? WHERE url = ?", (time.time(), url))
+                self.hit_cnt += 1
+            self.__db.commit()
+
+        return data
+
+    def store(self, url, data, headers):
+        """Caches freshly downloaded image bytes.
+
+        :param url: The canonical URL of the image
+        :param data: The image bytes
+        :param headers: The response headers the bytes came with
+        """
+        with self.__lock:
+            self.miss_cnt += 1
+
+        if "no-store" in (headers.get("Cache-Control") or "").lower():
+            return
+
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self._content_path(content_hash)
+        if not os.path.exists(path):
+            # Write to a temporary file first so that readers never see half
+            # of an image
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + ".tmp" + str(os.getpid()) + "-" + str(get_ident())
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+
+        with self.__lock:
+            old = self.__db.execute("SELECT hash, size FROM entries WHERE url = ?", (url,)).fetchone()
+            is_new_content = self.__db.execute("SELECT 1 FROM entries WHERE hash = ? LIMIT 1",
+                                               (content_hash,)).fetchone() is None
+            self.__db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (url, content_hash, len(data), headers.get("ETag"),
+                               headers.get("Last-Modified"), _expiry_time(headers), time.time()))
+            if is_new_content:
+                self.__stored_bytes += len(data)
+            if old is not None and old[0] != content_hash:
+                self._delete_unreferenced(*old)
+            self._evict()
+            self.__db.commit()
+
+    def remove(self, url):
+        """Removes the URL from the cache.
+
+        :param url: The canonical URL of the image
+        """
+        with self.__lock:
+            row = self.__db.execute("SELECT hash, size FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return
+            self.__db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._delete_unreferenced(*row)
+            self.__db.commit()
+
+    def size(self):
+        """Returns the amount of image bytes stored on disk."""
+        with self.__lock:
+            return self.__stored_bytes
+
+    def close(self):
+        """Closes the cache index."""
+        with self.__lock:
+            self.__db.close()
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache fits in its
+        size cap. Must be called with the lock held.
+        """
+        while self.__stored_bytes > self.__max_bytes:
+            row = self.__db.execute("SELECT url, hash, size FROM entries "
+                                    "ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            url, content_hash, size = row
+            self.__db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._delete_unreferenced(content_hash, size)
+
+    def _delete_unreferenced(self, content_hash, size):
+        """Deletes a content file if no URL uses it anymore. Must be called
+        with the lock held.
+        """
+        row = self.__db.execute("SELECT 1 FROM entries WHERE hash = ? LIMIT 1", (content_hash,)).fetchone()
+        if row is None:
+            self.__stored_bytes -= size
+            try:
+                os.remove(self._content_path(content_hash))
+            except FileNotFoundError:
+                pass
+
+    def _content_path(self, content_hash):
+        # Spread files over subfolders so no single folder gets too big
+        return os.path.join(self.__directory, content_hash[:2], content_hash)
+
+
+def _expiry_time(headers):
+    """Returns the time until which a response may be used without asking the
+    server again, or None if it must always be revalidated.
+
+    :param headers: The HTTP response headers
+    :return: A Unix timestamp or None
+    """
+    cache_control = (headers.get("Cache-Control") or "").lower()
+    if "no-cache" in cache_control:
+        return None
+
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "max-age":
+            try:
+                return time.time() + int(value.strip('"'))
+            except ValueError:
+                return None
+
+    if headers.get("Expires"):
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    return None
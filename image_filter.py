@@ -0,0 +1,219 @@
+"""Contains a filter that rejects downloads which can't be useful template
+matches, using only the response headers and the first few KB of the file.
+"""
+from collections import namedtuple
+from threading import Lock
+import struct
+
+
+# The format and dimensions read from an image file's header
+ImageSize = namedtuple('ImageSize', ['format', 'width', 'height'])
+
+
+def read_image_size(data):
+    """Reads the dimensions of a PNG, JPEG, GIF, WebP or BMP image from the
+    start of its file, without decoding it.
+
+    :param data: The first bytes of the image file
+    :return: An ImageSize, or None if the format is unknown or more bytes are
+    needed
+    """
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", data[16:24])
+            return ImageSize("png", width, height)
+
+        if data[:6] in (b"GIF87a", b"GIF89a"):
+            width, height = struct.unpack("<HH", data[6:10])
+            return ImageSize("gif", width, height)
+
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return _read_webp_size(data)
+
+        if data[:2] == b"\xff\xd8":
+            return _read_jpeg_size(data)
+
+        if data[:2] == b"BM":
+            width, height = struct.unpack("<ii", data[18:26])
+            return ImageSize("bmp", width, abs(height))
+    except struct.error:
+        # Not enough bytes yet
+        return None
+
+    return None
+
+
+def is_image_signature(data):
+    """Returns true if the data starts like an image file OpenCV can read."""
+    return data[:8] == b"\x89PNG\r\n\x1a\n" or data[:6] in (b"GIF87a", b"GIF89a") or \
+        (data[:4] == b"RIFF" and data[8:12] == b"WEBP") or data[:2] in (b"\xff\xd8", b"BM")
+
+
+def _read_webp_size(data):
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        # Lossy: the frame header follows a 3 byte start code
+        width, height = struct.unpack("<HH", data[26:30])
+        return ImageSize("webp", width & 0x3fff, height & 0x3fff)
+    if chunk == b"VP8L":
+        # Lossless: 14 bit dimensions minus one, packed after a signature byte
+        b0, b1, b2, b3 = struct.unpack("<BBBB", data[21:25])
+        width = 1 + (b0 | ((b1 & 0x3f) << 8))
+        height = 1 + ((b1 >> 6) | (b2 << 2) | ((b3 & 0x0f) << 10))
+        return ImageSize("webp", width, height)
+    if chunk == b"VP8X":
+        # Extended: 24 bit canvas dimensions minus one
+        if len(data) < 30:
+            return None
+        width = 1 + int.from_bytes(data[24:27], "little")
+        height = 1 + int.from_bytes(data[27:30], "little")
+        return ImageSize("webp", width, height)
+    return None
+
+
+def _read_jpeg_size(data):
+    # Walk the segments until a start of frame marker, which holds the size
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xff:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xff:
+            # Padding
+            pos += 1
+            continue
+        if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+            # Markers without a length
+            pos += 2
+            continue
+
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return ImageSize("jpeg", width, height)
+        pos += 2 + length
+
+    return None
+
+
+class ImageRejected(Exception):
+    """Raised when a download is dropped by the ImageFilter."""
+
+    def __init__(self, reason):
+        super(ImageRejected, self).__init__(reason)
+        self.reason = reason
+
+
+class ImageFilter:
+    """Decides from the response headers and the start of the file whether a
+    download is worth finishing. Tracking pixels, icons and sprites are too
+    small to ever have enough features for a match, and huge files cost too
+    much to download and decode.
+    """
+
+    # Rejection reasons
+    NOT_IMAGE = "not_image"
+    TOO_MANY_BYTES = "too_many_bytes"
+    TOO_SMALL = "too_small"
+    TOO_MANY_PIXELS = "too_many_pixels"
+
+    # Content types some servers send for images
+    GENERIC_CONTENT_TYPES = {"application/octet-stream", "binary/octet-stream"}
+
+    # How much of the file to read while looking for the image size. JPEGs
+    # with large EXIF or ICC blocks can need a lot of it.
+    SNIFF_CHUNK = 4096
+    MAX_SNIFF_BYTES = 64 * 1024
+
+    def __init__(self, min_size, max_bytes, max_pixels):
+        """
+        :param min_size: The least width and height an image may have
+        :param max_bytes: The most bytes an image file may have
+        :param max_pixels: The most pixels an image may have
+        """
+        self.min_size = min_size
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+        self.__rejected_cnts = {}
+        self.__lock = Lock()
+
+    def check_response(self, headers):
+        """Checks the response headers before any of the body is read. Raises
+        ImageRejected if the download should be dropped.
+
+        :param headers: The HTTP response headers
+        """
+        content_type = headers.get_content_type() if headers.get("Content-Type") else None
+        if content_type is not None and not content_type.startswith("image/") and \
+                content_type not in self.GENERIC_CONTENT_TYPES:
+            self._reject(self.NOT_IMAGE)
+
+        try:
+            length = int(headers.get("Content-Length", -1))
+        except ValueError:
+            length = -1
+        if length > self.max_bytes:
+            self._reject(self.TOO_MANY_BYTES)
+
+    def check_header(self, data, complete=False):
+        """Checks the first bytes of an image file. Raises ImageRejected if the
+        download should be dropped.
+
+        :param data: The start of the file
+        :param complete: True if data is the whole file
+        :return: The ImageSize, or None if it could not be read
+        """
+        if len(data) > self.max_bytes:
+            self._reject(self.TOO_MANY_BYTES)
+
+        size = read_image_size(data)
+        if size is None:
+            if (complete or len(data) >= self.SNIFF_CHUNK) and not is_image_signature(data):
+                self._reject(self.NOT_IMAGE)
+            return None
+
+        if size.width < self.min_size or size.height < self.min_size:
+            self._reject(self.TOO_SMALL)
+        if size.width * size.height > self.max_pixels:
+            self._reject(self.TOO_MANY_PIXELS)
+        return size
+
+    def read(self, resp):
+        """Reads a response body, checking it as it comes in. Stops as soon as
+        the image is known to be rejected.
+
+        :param resp: An open HTTP response
+        :return: The whole body
+        """
+        self.check_response(resp.headers)
+
+        # Read just enough to learn the image size
+        data = b""
+        while len(data) < self.MAX_SNIFF_BYTES:
+            chunk = resp.read(self.SNIFF_CHUNK)
+            if not chunk:
+                self.check_header(data, complete=True)
+                return data
+            data += chunk
+            if self.check_header(data) is not None:
+                break
+
+        rest = resp.read(self.max_bytes + 1 - len(data))
+        data += rest
+        if len(data) > self.max_bytes:
+            self._reject(self.TOO_MANY_BYTES)
+        return data
+
+    def get_rejected_counts(self):
+        """Returns how many downloads were dropped for each reason.
+
+        :return: A dict of reason to count
+        """
+        with self.__lock:
+            return dict(self.__rejected_cnts)
+
+    def _reject(self, reason):
+        with self.__lock:
+            self.__rejected_cnts[reason] = self.__rejected_cnts.get(reason, 0) + 1
+        raise ImageRejected(reason)
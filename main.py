@@ -1,9 +1,13 @@
-from crawler import Crawler
+from factories import create_crawler, new_comparer, create_match_memo, create_template_index
 from config import Config
 from PyQt5 import QtCore, QtWidgets, QtGui  # All GUI things
 from results_gui import ResultsList
-from compare_image import CompareImage
-from threading import Thread
+from checkpoint import CrawlCheckpoint
+from metrics import MetricsServer
+from match_engine import MatchEngine, submit_downloads
+from downloader import decode_image
+from collections import deque
+import multiprocessing
 import time
 import datetime
 import sys
@@ -31,7 +35,8 @@ class MainWindow(QtWidgets.QWidget):
 
         self.config = Config()
         self.crawler = None  # Initialized in self.start_scan
-        self.comparer = CompareImage()
+        self.metrics_server = None  # Started with the first scan, if enabled
+        self.comparer = new_comparer(self.config)
 
         # Init UI Globals
         self.scan_btn = QtWidgets.QPushButton("Start Search")
@@ -53,10 +58,10 @@ class MainWindow(QtWidgets.QWidget):
         tstamp = datetime.datetime.fromtimestamp(time.time()).strftime('%m-%d %I-%M%p ')
         self.output_file = str(tstamp) + "Results.txt"  # "Results" + str(tstamp) + ".txt"
 
-        # Buffer for images that are next to be checked
-        self.getting_image = False
-        self.next_image = None
-        self.next_url = None
+        # Matches images in other processes during a scan
+        self.match_engine = None  # Initialized in self.start_scan
+        self.match_memo = None  # Initialized in self.start_scan, if enabled
+        self.pending_matches = deque()  # (future, Download) of images being matched
 
         # Initialize the UI
         self.init_UI()
@@ -132,17 +137,34 @@ class MainWindow(QtWidgets.QWidget):
                                            QtWidgets.QMessageBox.Ok)
             return
 
-
-        self.crawler = Crawler(self.config.websites,
-                               self.config.search_depth,
-                               self.config.max_browsers,
-                               self.config.browser_timeout)
+        # Offer to continue a scan that was interrupted
+        resume = False
+        if self.config.checkpoint_file:
+            checkpoint = CrawlCheckpoint(self.config.checkpoint_file, self.config.websites)
+            if checkpoint.is_resumable():
+                reply = QtWidgets.QMessageBox.question(self, 'Resume Scan',
+                                                       "The last scan of these websites did not finish. "
+                                                       "Do you want to continue where it left off?",
+                                                       QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No)
+                resume = reply == QtWidgets.QMessageBox.Yes
+            checkpoint.close()
+
+        # Index the templates for the shortlist first, since the match memo depends on the vocabulary
+        create_template_index(self.config, self.comparer)
+
+        # The GUI only shows matches, so images are only checked against the match ratio
+        min_match_ratio = self.config.min_match_percent / 100.0
+        self.match_memo = create_match_memo(self.config, self.comparer, min_match_ratio)
+        self.crawler = create_crawler(self.config, self.config.websites, resume=resume, match_memo=self.match_memo)
         self.crawler.setDaemon(True)
+        self.serve_metrics()
+
+        self.match_engine = MatchEngine(self.comparer, self.config.match_workers, metrics=self.crawler.metrics,
+                                        min_match_ratio=min_match_ratio)
 
         # Disable the scan button
         self.scan_btn.setDisabled(True)
         self.settings_btn.setDisabled(True)
-        self.template_btn.setDisabled(True)
         self.website_btn.setDisabled(True)
 
         # Start crawling in another thread
@@ -151,6 +173,21 @@ class MainWindow(QtWidgets.QWidget):
         # Start analyzing in a while so the browsers have time to open
         self.scan_timer.singleShot(1000, self.check_crawler)
 
+    def serve_metrics(self):
+        """ Serves the metrics of the current scan on the configured local port """
+        if not self.config.metrics_port:
+            return
+
+        if self.metrics_server is None:
+            try:
+                self.metrics_server = MetricsServer(self.crawler.metrics, self.config.metrics_port)
+            except OSError as e:
+                print("Error: could not serve metrics on port " + str(self.config.metrics_port) + ": ", e)
+                return
+            self.metrics_server.start()
+        else:
+            self.metrics_server.registry = self.crawler.metrics
+
     def open_settings(self):
         self.settings_btn.setDisabled(True)
 
@@ -195,11 +232,13 @@ class MainWindow(QtWidgets.QWidget):
         brwsr_lbl = QtWidgets.QLabel("Maximum Open Browsers")
         timeout_lbl = QtWidgets.QLabel("URL Load Timeout (s)")
         ratio_lbl = QtWidgets.QLabel("Min Percent Match")
+        static_lbl = QtWidgets.QLabel("Try Without Browser First")
 
         window.depth_txt = QtWidgets.QLineEdit()
         window.brwsr_txt = QtWidgets.QLineEdit()  # Show prints from robot class
         window.timeout_txt = QtWidgets.QLineEdit()  # Show prints from robot class
         window.ratio_sldr = QtWidgets.QSlider()
+        window.static_chk = QtWidgets.QCheckBox()
 
         # Any setup that's necessary
         window.ratio_sldr.setRange(0, 95)
@@ -210,12 +249,14 @@ class MainWindow(QtWidgets.QWidget):
         window.brwsr_txt.setText(str(self.config.max_browsers))
         window.timeout_txt.setText(str(self.config.browser_timeout))
         window.ratio_sldr.setValue(self.config.min_match_percent)
+        window.static_chk.setChecked(self.config.static_fetch)
 
         window.content.addWidget(desc_lbl)
         addRow(depth_lbl, window.depth_txt)
         addRow(brwsr_lbl, window.brwsr_txt)
         addRow(timeout_lbl, window.timeout_txt)
         addRow(ratio_lbl, window.ratio_sldr)
+        addRow(static_lbl, window.static_chk)
 
         window.mainVLayout.addLayout(buttonRow)  # Add button after, so hints appear above buttons
 
@@ -233,6 +274,7 @@ class MainWindow(QtWidgets.QWidget):
             except ValueError: pass
 
             self.config.min_match_percent = window.ratio_sldr.value()
+            self.config.static_fetch = window.static_chk.isChecked()
 
         # Make sure QT properly handles the memory after this function ends
         window.close()
@@ -252,8 +294,15 @@ class MainWindow(QtWidgets.QWidget):
 
         # Add the image to the comparer
         img = cv2.imread(img_file)
+        if img is None: return
         self.comparer.add_template(img)
 
+        # Templates can be added while a scan is running
+        if self.match_engine is not None:
+            self.match_engine.add_template(self.comparer.get_template_features(len(self.comparer.get_template()) - 1))
+        if self.match_memo is not None:
+            self.match_memo.set_templates(self.comparer.get_template_ids())
+
     def open_websites(self):
         window = QtWidgets.QDialog()
 
@@ -308,31 +357,44 @@ class MainWindow(QtWidgets.QWidget):
         timer = lambda: self.scan_timer.singleShot(self.scan_check_time, self.check_crawler)
         self.progress_bar.setValue(self.crawler.progress)
 
-        self.web_cnt_lbl.setText("Sites: " + str(self.crawler.scraped_page_cnt))
+        self.web_cnt_lbl.setText("Sites: " + str(self.crawler.scraped_page_cnt) +
+                                 " (" + str(self.crawler.partial_page_cnt) + " partial)")
         self.fail_cnt_lbl.setText("Failures: " + str(self.crawler.failed_page_cnt))
 
-        if self.next_image is not None and self.getting_image is False:
-            # Scan the next image
-            if self.comparer.is_match(self.next_image, self.config.min_match_percent / 100.0):
+        # Hand the crawler's images to the match engine while it has room, a page at a time
+        downloads = []
+        while len(self.pending_matches) + len(downloads) < self.match_engine.max_pending:
+            download = self.crawler.get_next_download()
+            if download is None:
+                break
+            downloads.append(download)
+        self.pending_matches.extend(submit_downloads(self.match_engine, downloads))
+
+        # Handle the images that are done matching, in the order they came in
+        matched = self.crawler.metrics.counter("images_matched_total", "Images matched against the templates",
+                                               labels=("result",))
+        while self.pending_matches and self.pending_matches[0][0].done():
+            future, download = self.pending_matches.popleft()
+            url = download.page_url
+            try:
+                result = future.result()
+            except Exception as e:
+                print("Error: could not match image from " + str(url) + ": ", e)
+                continue
+            if self.match_memo is not None and download.match is None:
+                self.match_memo.store(download.content_hash, result.scores)
+
+            is_match = result.match_ratio >= self.config.min_match_percent / 100.0
+            matched.inc(result="match" if is_match else "no_match")
+
+            if is_match:
+                img = download.image if download.image is not None else decode_image(download.data)
                 print("GOT MATCH!", self.scanned_count)
-                cv2.imwrite("OUTPUT/" + str(self.scanned_count) + '.png', self.next_image)  # TODO: Should I save images to file?
-                self.add_match(self.next_image, "Image " + str(self.scanned_count), self.next_url)
+                cv2.imwrite("OUTPUT/" + str(self.scanned_count) + '.png', img)  # TODO: Should I save images to file?
+                self.add_match(img, "Image " + str(self.scanned_count), url)
 
             self.img_cnt_lbl.setText("Imgs Tested: " + str(self.scanned_count))
             self.scanned_count += 1
-            self.next_image = None
-            self.next_url = None
-
-        # Queue a new image using another thread
-        def setNew(self):
-            img, url = self.crawler.get_image()
-            self.next_image = img
-            self.next_url = url
-
-        if self.next_image is None and not self.getting_image:
-            self.getting_image = True
-            Thread(target=lambda: setNew(self)).start()
-            self.getting_image = False
 
         timer()
 
@@ -365,8 +427,20 @@ class MainWindow(QtWidgets.QWidget):
 
             self.crawler.close()
 
+        if self.match_engine is not None and event.isAccepted():
+            self.match_engine.close()
+
+        if self.match_memo is not None and event.isAccepted():
+            self.match_memo.close()
+
+        if self.metrics_server is not None and event.isAccepted():
+            self.metrics_server.close()
+
 
 if __name__ == '__main__':
+    # Match workers start this executable again, which must run the worker instead of the GUI when frozen
+    multiprocessing.freeze_support()
+
     # Install a global exception hook to catch pyQt errors that fall through (for debugging)
     sys.__excepthook = sys.excepthook
     sys._excepthook  = sys.excepthook
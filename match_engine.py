@@ -0,0 +1,351 @@
+"""Contains a matching engine that compares images against the templates in a
+pool of worker processes, so matching uses every core and never blocks the
+GUI.
+"""
+from collections import namedtuple
+from compare_image import CompareImage
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from metrics import MetricsRegistry
+from prefilter import Prefilter
+from threading import BoundedSemaphore, Lock
+import cv2
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+
+# The result of matching one image. The first six fields are those of
+# compare_image.ImageMatch.
+#   template    - the index of the best matching template, or None
+#   match_ratio - the highest match ratio of the image against any template
+#   inliers     - how many matches agreed with the best template's homography
+#   timings     - the seconds spent in each stage of matching
+#   rejected_by - the prefilter stage that rejected the image, or None
+#   scores      - the (match_ratio, inliers) against every template, or None
+#                 for the templates whose outcome is unknown
+#   seconds     - how long matching took in the worker
+MatchResult = namedtuple('MatchResult', ['template', 'match_ratio', 'inliers', 'timings', 'rejected_by',
+                                         'scores', 'seconds'])
+
+
+# The CompareImage of the worker process, built once by _init_worker
+_worker_comparer = None
+# The match ratio the worker only checks images against, or None to score them fully
+_worker_min_match_ratio = None
+# The version of the templates the worker's comparer has
+_worker_template_version = 0
+
+
+def _init_worker(options, prefilter_stages, template_features, min_match_ratio, template_version):
+    global _worker_comparer, _worker_min_match_ratio, _worker_template_version
+
+    # Every process already gets a core of its own
+    cv2.setNumThreads(1)
+
+    prefilter = Prefilter(prefilter_stages) if prefilter_stages else None
+    _worker_comparer = CompareImage(prefilter=prefilter, **options)
+    _worker_comparer.add_template_features(template_features)
+    _worker_min_match_ratio = min_match_ratio
+    _worker_template_version = template_version
+
+
+def _apply_template_changes(changes):
+    # Brings the worker's templates up to date with the (version, command, argument) changes it has not seen yet
+    global _worker_template_version
+
+    for version, command, arg in changes:
+        if version <= _worker_template_version:
+            continue
+        if command == "add":
+            _worker_comparer.add_template_features([arg])
+        else:
+            _worker_comparer.remove_template(arg)
+        _worker_template_version = version
+
+
+def _match_batch(task):
+    # Returns the worker's process ID and template version with the results. The time is split evenly between the
+    # images, since their descriptors are matched together.
+    changes, imgs, known_scores = task
+    _apply_template_changes(changes)
+    start = time.perf_counter()
+    matches = _worker_comparer.match_batch(imgs, _worker_min_match_ratio, known_scores)
+    seconds = (time.perf_counter() - start) / max(len(imgs), 1)
+    return os.getpid(), _worker_template_version, [MatchResult(*match, seconds=seconds) for match in matches]
+
+
+def submit_downloads(engine, downloads):
+    """Submits downloaded images to the engine. The images of each page that
+    come one after another are matched as one batch, so their descriptors go
+    through the matcher together. Downloads the match memo already knew get a
+    finished future, and the others are only matched against the templates
+    the memo has no score for. Images that can't be submitted because the workers keep
+    crashing are left out, with an error.
+
+    :param engine: The MatchEngine to match the images with
+    :param downloads: A list of downloader.Download
+    :return: A list with a (future, Download) for every download, in order,
+        whose future's result is a MatchResult
+    """
+    submitted = []  # (future, Download), where the future is None until the image's batch is submitted
+    batch = []  # The indices in submitted of the images of the batch being put together
+
+    def submit_batch():
+        try:
+            futures = engine.submit_batch([submitted[i][1].image for i in batch],
+                                          known_scores=[submitted[i][1].known_scores for i in batch])
+        except BrokenProcessPool as e:
+            print("Error: could not match the images from " + str(submitted[batch[0]][1].page_url) + ": ", e,
+                  file=sys.stderr)
+            futures = [None] * len(batch)
+        for i, future in zip(batch, futures):
+            submitted[i] = (future, submitted[i][1])
+        batch.clear()
+
+    for download in downloads:
+        if batch and (download.page_url != submitted[batch[0]][1].page_url or len(batch) >= engine.max_pending):
+            submit_batch()
+        if download.match is not None:
+            # Matched before, so there is nothing left to do
+            future = Future()
+            future.set_result(MatchResult(*download.match, seconds=0))
+            submitted.append((future, download))
+        else:
+            batch.append(len(submitted))
+            submitted.append((None, download))
+    if batch:
+        submit_batch()
+    return [(future, download) for future, download in submitted if future is not None]
+
+
+class MatchEngine:
+    """Matches images against a fixed set of templates in worker processes.
+    The templates' features are detected once in this process and sent to
+    every worker when it starts.
+
+    At most max_pending images are being matched or waiting to be matched at
+    once. submit blocks when that many are in, which keeps the images waiting
+    in memory bounded.
+
+    Templates can be added and removed while images are being matched. Every
+    change makes a new version of the template set, and is sent along with
+    the images submitted after it until every worker has reported it back.
+    Workers apply the changes they have not seen before matching the images.
+    Only a burst of more than MAX_LIVE_CHANGES changes, like loading a folder
+    of templates, restarts the workers with the current templates instead,
+    as does a worker crashing.
+    """
+
+    # The most template changes sent along with images before the workers are restarted instead
+    MAX_LIVE_CHANGES = 32
+
+    def __init__(self, comparer, worker_cnt=0, max_pending=0, metrics=None, min_match_ratio=None):
+        """
+        :param comparer: A CompareImage with the templates to match against.
+            Templates added to it later must also be added with add_template.
+        :param worker_cnt: How many worker processes to start, or 0 for one
+            per core
+        :param max_pending: How many images may be submitted but not done
+            yet, or 0 for twice the number of workers
+        :param metrics: An optional MetricsRegistry to record match times and
+            the number of pending images in
+        :param min_match_ratio: If given, images are only checked for a match
+            at this ratio, as with CompareImage.match_batch, instead of being
+            scored against every template
+        """
+        self.worker_cnt = worker_cnt if worker_cnt > 0 else (os.cpu_count() or 1)
+        self.max_pending = max_pending if max_pending > 0 else 2 * self.worker_cnt
+
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.__match_time = metrics.histogram("match_seconds", "How long images took to match against the templates")
+        self.__pending = metrics.gauge("match_pending", "Images submitted for matching that are not done yet")
+        self.__prefiltered = None
+        self.__prefilter_stages = [stage.name for stage in comparer.prefilter.stages] if comparer.prefilter else []
+        if comparer.prefilter is not None:
+            self.__prefiltered = metrics.counter("prefilter_images_total",
+                                                 "Images run through the prefilter, by the stage that rejected them",
+                                                 labels=("result",))
+
+        self.__slots = BoundedSemaphore(self.max_pending)
+        self.__options = comparer.get_options()
+        self.__prefilter = comparer.prefilter.stages if comparer.prefilter else None
+        self.__template_features = comparer.get_template_features()
+        self.__min_match_ratio = min_match_ratio
+        self.__template_version = 0  # Counts the changes to the templates
+        self.__worker_version = 0  # The template version the workers were started with
+        self.__changes = []  # The (version, command, argument) of the changes some worker may not have yet
+        self.__reported_versions = {}  # Worker process ID -> the template version it last matched images with
+        self.__lock = Lock()
+        self.__executor = self._start_workers()
+
+    def _start_workers(self):
+        self.__worker_version = self.__template_version
+        self.__changes = []
+        self.__reported_versions = {}
+        # Spawned rather than forked, since the process already runs Qt, browsers and downloader threads
+        return ProcessPoolExecutor(max_workers=self.worker_cnt,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(self.__options, self.__prefilter, list(self.__template_features),
+                                             self.__min_match_ratio, self.__worker_version))
+
+    def add_template(self, features):
+        """Adds a template to the workers. Images submitted from now on are
+        matched against it too.
+
+        :param features: The template's item of
+            CompareImage.get_template_features
+        """
+        with self.__lock:
+            self.__template_features.append(features)
+            self.__template_version += 1
+            self.__changes.append((self.__template_version, "add", features))
+
+    def remove_template(self, index):
+        """Removes the template at the index from the workers. Images
+        submitted from now on are no longer matched against it.
+        """
+        with self.__lock:
+            del self.__template_features[index]
+            self.__template_version += 1
+            self.__changes.append((self.__template_version, "remove", index))
+
+    def _restart_workers(self):
+        # Images already submitted are still matched by the old workers, unless they broke
+        self.__executor.shutdown(wait=False)
+        self.__executor = self._start_workers()
+
+    def submit(self, img, callback=None, timeout=None):
+        """Queues an image to be matched. Blocks while max_pending images are
+        already in.
+
+        :param img: The image to match, as a Numpy array
+        :param callback: An optional function called with the future once it
+            is done. It runs on a background thread.
+        :param timeout: The most seconds to wait for room, or None to wait for
+            as long as it takes. Raises queue.Full if there is no room in time.
+        :return: A Future whose result is a MatchResult. Raises
+            BrokenProcessPool if the workers crash even after a restart.
+        """
+        future = self.submit_batch([img], timeout)[0]
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def submit_batch(self, imgs, timeout=None, known_scores=None):
+        """Queues images to be matched together by one worker, like the
+        images of a single page, so their descriptors go through the matcher
+        in one call. Blocks until there is room for all of them.
+
+        :param imgs: The images to match, as Numpy arrays. At most
+            max_pending of them.
+        :param timeout: As for submit
+        :param known_scores: An optional list with the scores already known
+            for every image, as CompareImage.match_batch takes them
+        :return: A list with a Future for every image, whose result is its
+            MatchResult. Raises BrokenProcessPool like submit.
+        """
+        imgs = list(imgs)
+        if len(imgs) > self.max_pending:
+            raise ValueError("A batch can hold at most " + str(self.max_pending) + " images")
+        if not imgs:
+            return []
+
+        batch, executor = self._submit(imgs, known_scores, timeout)
+        futures = [Future() for _ in imgs]
+        batch.add_done_callback(lambda batch: self._on_batch_done(batch, futures, executor))
+        return futures
+
+    def _submit(self, imgs, known_scores, timeout):
+        # Takes a slot for every image and hands them to the workers with the template changes they may not have.
+        # Returns the future of the batch and the executor it went to.
+        self._acquire_slots(len(imgs), timeout)
+        self.__pending.inc(len(imgs))
+        try:
+            with self.__lock:
+                changes = self._unreported_changes()
+                if len(changes) > self.MAX_LIVE_CHANGES:
+                    self._restart_workers()
+                    changes = []
+                try:
+                    return self.__executor.submit(_match_batch, (changes, imgs, known_scores)), self.__executor
+                except BrokenProcessPool:
+                    # A worker that crashed, in OpenCV for example, breaks the whole pool
+                    print("Warning: restarting the match workers after one of them crashed", file=sys.stderr)
+                    self._restart_workers()
+                    return self.__executor.submit(_match_batch, ([], imgs, known_scores)), self.__executor
+        except Exception:
+            self._release_slots(len(imgs))
+            raise
+
+    def _unreported_changes(self):
+        # The template changes that some worker may not have applied yet. Workers that never matched anything
+        # still have the templates they were started with.
+        versions = list(self.__reported_versions.values())
+        if len(versions) < self.worker_cnt:
+            versions.append(self.__worker_version)
+        oldest = min(versions)
+        self.__changes = [change for change in self.__changes if change[0] > oldest]
+        return self.__changes
+
+    def _acquire_slots(self, cnt, timeout):
+        end = None if timeout is None else time.monotonic() + timeout
+        for acquired_cnt in range(cnt):
+            if not self.__slots.acquire(timeout=None if end is None else max(end - time.monotonic(), 0)):
+                for _ in range(acquired_cnt):
+                    self.__slots.release()
+                raise queue.Full()
+
+    def _release_slots(self, cnt):
+        self.__pending.dec(cnt)
+        for _ in range(cnt):
+            self.__slots.release()
+
+    def _on_batch_done(self, batch, futures, executor):
+        self._release_slots(len(futures))
+        if batch.cancelled():
+            for future in futures:
+                future.cancel()
+        elif batch.exception() is not None:
+            for future in futures:
+                future.set_exception(batch.exception())
+        else:
+            pid, version, results = batch.result()
+            with self.__lock:
+                # Workers that were restarted since don't get the changes anymore
+                if executor is self.__executor:
+                    self.__reported_versions[pid] = max(version, self.__reported_versions.get(pid, 0))
+            for future, result in zip(futures, results):
+                self._record(result)
+                future.set_result(result)
+
+    def _record(self, result):
+        self.__match_time.observe(result.seconds)
+        if self.__prefiltered is not None:
+            self.__prefiltered.inc(result=result.rejected_by or "passed")
+
+    def get_prefilter_stats(self):
+        """Returns how many images reached each prefilter stage in the workers and how many it rejected, like
+        Prefilter.get_stats, or None if there is no prefilter.
+        """
+        if self.__prefiltered is None:
+            return None
+
+        stats = {}
+        reached_cnt = self.__prefiltered.total()
+        for name in self.__prefilter_stages:
+            rejected_cnt = self.__prefiltered.get(result=name)
+            stats[name] = {"tested": reached_cnt,
+                           "rejected": rejected_cnt,
+                           "rejection_rate": rejected_cnt / max(reached_cnt, 1)}
+            reached_cnt -= rejected_cnt
+        return stats
+
+    def close(self):
+        """Stops the workers. Images that were not matched yet are dropped."""
+        with self.__lock:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,175 @@
+"""Contains a memo of match results keyed by a hash of the image file, so an
+image that was matched before, under any URL or in an earlier scan, is neither
+decoded nor matched again.
+"""
+from collections import OrderedDict
+from compare_image import ImageMatch
+from threading import Lock
+import hashlib
+import json
+import sqlite3
+
+
+class MatchMemo:
+    """Remembers the score of images against each template.
+
+    Scores are kept per template, keyed by a hash of the template image, so
+    adding a template only makes images miss until they are matched against
+    it too, and removing one only drops its own scores. Scores also depend on
+    how images are matched, so every set of match settings has its own
+    scores.
+
+    Only the scores of templates whose outcome for an image is known are
+    stored. The fast check against a minimum match ratio leaves the templates
+    it did not need to verify unknown, and an image that misses can be
+    matched against just the templates it has no score for with
+    known_scores.
+
+    The scores of recently used images are kept in memory, and every score is
+    also stored in SQLite so it lasts across scans. Thread-safe.
+    """
+
+    # How many stores to make before committing them to the database
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path, settings, capacity=10000):
+        """
+        :param path: The SQLite database to keep the scores in, or None to
+            only keep them in memory
+        :param settings: A JSON serializable description of everything besides
+            the templates that changes the scores
+        :param capacity: How many images to keep the scores of in memory
+        """
+        self.hit_cnt = 0
+        self.miss_cnt = 0
+
+        self.__settings = hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+        self.__capacity = max(capacity, 1)
+        self.__templates = []  # The IDs of the current templates, by index
+        self.__recent = OrderedDict()  # Image hash -> {template ID: (match ratio, inliers)}, least recent first
+        self.__uncommitted_cnt = 0
+        self.__lock = Lock()
+
+        self.__db = None
+        if path:
+            self.__db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS scores ("
+                              "image TEXT NOT NULL, "
+                              "settings TEXT NOT NULL, "
+                              "template TEXT NOT NULL, "
+                              "match_ratio REAL NOT NULL, "
+                              "inliers INTEGER NOT NULL, "
+                              "PRIMARY KEY (image, settings, template))")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS scores_template ON scores (template)")
+            self.__db.commit()
+
+    def set_templates(self, template_ids):
+        """Sets the templates that lookups and stores refer to.
+
+        :param template_ids: The ID of every template, in the order of their
+            indices in an ImageMatch
+        """
+        with self.__lock:
+            self.__templates = list(template_ids)
+
+    def lookup(self, image_hash):
+        """Returns how the image matched the current templates.
+
+        :param image_hash: The hash of the image file
+        :return: An ImageMatch, or None if the image was not matched against
+            every current template yet
+        """
+        with self.__lock:
+            scores = self._load(image_hash)
+            templates = self.__templates
+            if not templates or scores is None or any(template not in scores for template in templates):
+                self.miss_cnt += 1
+                return None
+            self.hit_cnt += 1
+            return self._to_image_match([scores[template] for template in templates])
+
+    def known_scores(self, image_hash):
+        """Returns the scores of the image that are known, for
+        CompareImage.match_batch to only match it against the other
+        templates.
+
+        :param image_hash: The hash of the image file
+        :return: A dict of template ID to (match_ratio, inliers), empty if
+            none are known
+        """
+        with self.__lock:
+            return dict(self._load(image_hash) or {})
+
+    def store(self, image_hash, scores):
+        """Remembers how an image matched the current templates.
+
+        :param image_hash: The hash of the image file
+        :param scores: The scores field of the image's ImageMatch. Templates
+            with a score of None were not matched and are not stored.
+        """
+        with self.__lock:
+            if len(scores) != len(self.__templates):
+                # The templates changed since the image was matched
+                return
+
+            new_scores = {template: score for template, score in zip(self.__templates, scores) if score is not None}
+            if not new_scores:
+                return
+            self._remember(image_hash, dict(self.__recent.get(image_hash, {}), **new_scores))
+
+            if self.__db is not None:
+                self.__db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)",
+                                      [(image_hash, self.__settings, template, match_ratio, inliers)
+                                       for template, (match_ratio, inliers) in new_scores.items()])
+                self.__uncommitted_cnt += 1
+                if self.__uncommitted_cnt >= self.COMMIT_INTERVAL:
+                    self.__db.commit()
+                    self.__uncommitted_cnt = 0
+
+    def remove_template(self, template_id):
+        """Forgets every score against a template. Call set_templates too if
+        it is one of the current templates.
+        """
+        with self.__lock:
+            for scores in self.__recent.values():
+                scores.pop(template_id, None)
+            if self.__db is not None:
+                self.__db.execute("DELETE FROM scores WHERE template = ?", (template_id,))
+                self.__db.commit()
+                self.__uncommitted_cnt = 0
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.commit()
+                self.__db.close()
+                self.__db = None
+
+    def _load(self, image_hash):
+        # Returns the dict of template ID to score of the image, or None if nothing is known about it
+        scores = self.__recent.get(image_hash)
+        if scores is not None:
+            self.__recent.move_to_end(image_hash)
+        elif self.__db is not None:
+            rows = self.__db.execute("SELECT template, match_ratio, inliers FROM scores "
+                                     "WHERE image = ? AND settings = ?",
+                                     (image_hash, self.__settings)).fetchall()
+            if rows:
+                scores = {template: (match_ratio, inliers) for template, match_ratio, inliers in rows}
+                self._remember(image_hash, scores)
+        return scores
+
+    def _remember(self, image_hash, scores):
+        self.__recent[image_hash] = scores
+        self.__recent.move_to_end(image_hash)
+        while len(self.__recent) > self.__capacity:
+            self.__recent.popitem(last=False)
+
+    @staticmethod
+    def _to_image_match(scores):
+        best = max(range(len(scores)), key=lambda i: scores[i][0])
+        match_ratio, inliers = scores[best]
+        if match_ratio <= 0:
+            return ImageMatch(template=None, match_ratio=0, inliers=0, timings={}, rejected_by=None, scores=scores)
+        return ImageMatch(template=best, match_ratio=match_ratio, inliers=inliers, timings={}, rejected_by=None,
+                          scores=scores)
@@ -0,0 +1,279 @@
+"""Contains the descriptor matchers PlaneTracker can find ORB matches with,
+and a benchmark to pick the fastest one for a set of templates.
+
+Every template gets a matcher of its own, trained on its descriptors, and
+frames matched against every template go through one more matcher trained on
+the descriptors of all of them. Which one is fastest depends mostly on how many templates there are: brute force
+has no index to build and is exact, which is hard to beat for a few
+templates, while FLANN's LSH index only pays off with many of them, and then
+only with parameters that suit the templates.
+"""
+from abc import ABC, abstractmethod
+import sys
+import time
+import cv2
+import numpy as np
+
+
+FLANN_INDEX_LSH = 6
+
+# The matcher PlaneTracker uses unless told otherwise
+DEFAULT_MATCHER = {"name": "flann_lsh", "table_number": 6, "key_size": 12, "multi_probe_level": 1}
+
+# The matcher whose matches benchmark_matchers measures the others against
+EXACT_MATCHER = {"name": "brute_force", "cross_check": False}
+
+# How many bits are set in every byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+# About how many bytes hamming_knn's differing bits of a chunk of descriptors take up
+CHUNK_BYTES = 1 << 24
+
+
+class DescriptorMatcher(ABC):
+    """The base class of the matchers. A matcher is trained on the descriptors
+    of one template, and then finds the nearest of them to descriptors of
+    frames.
+    """
+
+    name = None
+
+    # Whether the two nearest neighbours are found, for the ratio test. If not, only mutually nearest
+    # descriptors are returned, which filters the matches on its own.
+    ratio_test = True
+
+    def get_params(self):
+        """Returns the keyword arguments that create the same matcher."""
+        return {}
+
+    @abstractmethod
+    def train(self, descrs):
+        """Indexes the descriptors of a template, as a Numpy array."""
+
+    @abstractmethod
+    def knn_match(self, descrs):
+        """Finds the nearest trained descriptors of every descriptor.
+
+        :param descrs: The descriptors of a frame, as a Numpy array
+        :return: A list with, for every descriptor, a list of up to two
+            (distance, trainIdx), nearest first
+        """
+
+
+class BruteForceMatcher(DescriptorMatcher):
+    """Compares every descriptor with every trained one. Exact, and there is
+    no index to build.
+    """
+
+    name = "brute_force"
+
+    def __init__(self, cross_check=False):
+        """
+        :param cross_check: Only return a match if the descriptors are the
+            nearest to each other both ways, instead of the two nearest
+        """
+        self.cross_check = cross_check
+        self.ratio_test = not cross_check
+        self.__matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=cross_check)
+
+    def get_params(self):
+        return {"cross_check": self.cross_check}
+
+    def train(self, descrs):
+        self.__matcher.add([descrs])
+
+    def knn_match(self, descrs):
+        k = 1 if self.cross_check else 2
+        return [[(m.distance, m.trainIdx) for m in knn] for knn in self.__matcher.knnMatch(descrs, k=k)]
+
+
+class FlannLshMatcher(DescriptorMatcher):
+    """Looks descriptors up in FLANN's locality sensitive hash tables. The
+    neighbours it finds are not always the nearest.
+    """
+
+    name = "flann_lsh"
+
+    def __init__(self, table_number=6, key_size=12, multi_probe_level=1):
+        """
+        :param table_number: How many hash tables to build. More finds more
+            true neighbours, but takes longer.
+        :param key_size: How many bits each hash is. Longer makes fewer
+            descriptors share a bucket.
+        :param multi_probe_level: How many bits a hash may differ from the
+            looked up one to check its bucket too
+        """
+        self.table_number = table_number
+        self.key_size = key_size
+        self.multi_probe_level = multi_probe_level
+        index_params = dict(algorithm=FLANN_INDEX_LSH, **self.get_params())
+        self.__matcher = cv2.FlannBasedMatcher(index_params, {})  # bug : need to pass empty dict (#1329)
+
+    def get_params(self):
+        return {"table_number": self.table_number,
+                "key_size": self.key_size,
+                "multi_probe_level": self.multi_probe_level}
+
+    def train(self, descrs):
+        # Build the index now, instead of on the first match
+        self.__matcher.add([descrs])
+        self.__matcher.train()
+
+    def knn_match(self, descrs):
+        return [[(m.distance, m.trainIdx) for m in knn] for knn in self.__matcher.knnMatch(descrs, k=2)]
+
+
+class NumpyMatcher(DescriptorMatcher):
+    """Compares every descriptor with every trained one like BruteForceMatcher,
+    but with hamming_knn, which counts the differing bits with a lookup table.
+    """
+
+    name = "numpy"
+
+    def __init__(self):
+        self.__descrs = np.zeros((0, 32), np.uint8)
+
+    def train(self, descrs):
+        descrs = np.uint8(descrs)
+        self.__descrs = descrs if len(descrs) else np.zeros((0, 32), np.uint8)
+
+    def knn_match(self, descrs):
+        if not len(descrs):
+            return []
+        distances, nearest = hamming_knn(descrs, self.__descrs, 2)
+        return [list(zip(row_distances, row)) for row_distances, row in zip(distances.tolist(), nearest.tolist())]
+
+
+def hamming_knn(descrs, trained, k):
+    """Finds the k nearest trained descriptors of every descriptor by their
+    Hamming distance, with vectorized Numpy.
+
+    :param descrs: The descriptors to look up, as a Numpy array of bytes
+    :param trained: The descriptors to find them in, as a Numpy array of bytes
+    :return: Two arrays with a row for every descriptor, of the distances and
+        the indices into trained of its nearest descriptors, nearest first.
+        There are fewer than k columns if there are fewer trained descriptors.
+    """
+    descrs, trained = np.uint8(descrs), np.uint8(trained)
+    k = min(k, len(trained))
+    if not k:
+        return np.zeros((len(descrs), 0), np.uint16), np.zeros((len(descrs), 0), np.intp)
+
+    rows = max(CHUNK_BYTES // trained.size, 1)
+    all_distances, all_nearest = [], []
+    for start in range(0, len(descrs), rows):
+        chunk = descrs[start:start + rows]
+        distances = POPCOUNT[chunk[:, None, :] ^ trained[None, :, :]].sum(axis=2, dtype=np.uint16)
+
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1)
+        all_nearest.append(np.take_along_axis(nearest, order, axis=1))
+        all_distances.append(np.take_along_axis(nearest_distances, order, axis=1))
+    if not all_nearest:
+        return np.zeros((0, k), np.uint16), np.zeros((0, k), np.intp)
+    return np.concatenate(all_distances), np.concatenate(all_nearest)
+
+
+# Matcher name -> class
+MATCHERS = {BruteForceMatcher.name: BruteForceMatcher,
+            FlannLshMatcher.name: FlannLshMatcher,
+            NumpyMatcher.name: NumpyMatcher}
+
+
+def create_matcher(spec):
+    """Creates an untrained matcher.
+
+    :param spec: A dict with the name of the matcher in MATCHERS under "name",
+        and the arguments of its class, as from matcher_spec
+    """
+    params = dict(spec)
+    return MATCHERS[params.pop("name")](**params)
+
+
+def matcher_spec(spec):
+    """Checks a matcher spec and fills in the default arguments. An unknown
+    matcher or arguments fall back to DEFAULT_MATCHER with a warning.
+
+    :param spec: A dict like create_matcher takes, or None for DEFAULT_MATCHER
+    :return: The complete spec, which is JSON serializable
+    """
+    if spec is None:
+        spec = DEFAULT_MATCHER
+    try:
+        matcher = create_matcher(spec)
+    except (KeyError, TypeError) as e:
+        print("Warning: using the default matcher instead of " + str(spec) + ": ", e, file=sys.stderr)
+        matcher = create_matcher(DEFAULT_MATCHER)
+    return dict(matcher.get_params(), name=matcher.name)
+
+
+def candidate_matchers():
+    """Returns the specs benchmark_matchers tries by default: brute force both
+    ways, the Numpy matcher, and a grid of LSH parameters.
+    """
+    specs = [{"name": BruteForceMatcher.name, "cross_check": False},
+             {"name": BruteForceMatcher.name, "cross_check": True},
+             {"name": NumpyMatcher.name}]
+    for table_number in (6, 12, 20):
+        for key_size in (12, 16, 20):
+            for multi_probe_level in (1, 2):
+                specs.append({"name": FlannLshMatcher.name, "table_number": table_number, "key_size": key_size,
+                              "multi_probe_level": multi_probe_level})
+    return specs
+
+
+def benchmark_matchers(tracker, frame_descrs, specs):
+    """Times how long each matcher takes to match frames against the
+    tracker's targets, and how close its matches come to the exact ones. The
+    tracker's own matcher is put back afterwards.
+
+    :param tracker: A PlaneTracker with the targets to benchmark with
+    :param frame_descrs: A list with the descriptors of every frame, as from
+        PlaneTracker.detect_frame
+    :param specs: The matcher specs to benchmark
+    :return: A list with a dict for every spec with the complete "matcher"
+        spec, "build_seconds" to train it on every target, "match_seconds" to
+        match every frame, "matches" found, "recall", the share of the exact
+        matches it found, and "precision", the share of its matches that were
+        exact ones
+    """
+    original = tracker.matcher_spec
+    try:
+        tracker.set_matcher(EXACT_MATCHER)
+        exact = _match_keys(tracker.match_frame_descriptors(frame_descrs))
+
+        report = []
+        for spec in specs:
+            start = time.perf_counter()
+            tracker.set_matcher(spec)
+            build_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            found = _match_keys(tracker.match_frame_descriptors(frame_descrs))
+            match_time = time.perf_counter() - start
+
+            report.append({"matcher": tracker.matcher_spec,
+                           "build_seconds": build_time,
+                           "match_seconds": match_time,
+                           "matches": len(found),
+                           "recall": len(found & exact) / len(exact) if exact else 1.0,
+                           "precision": len(found & exact) / len(found) if found else 1.0})
+    finally:
+        tracker.set_matcher(original)
+    return report
+
+
+def pick_matcher(report, min_recall):
+    """Returns the item of a benchmark_matchers report with the fastest
+    matcher whose recall and precision are both at least min_recall, or the
+    one with the highest recall if none are.
+    """
+    accurate = [item for item in report if item["recall"] >= min_recall and item["precision"] >= min_recall]
+    if accurate:
+        return min(accurate, key=lambda item: item["match_seconds"])
+    return max(report, key=lambda item: (item["recall"], item["precision"]))
+
+
+def _match_keys(matches_by_frame):
+    return {(i, m.queryIdx, m.imgIdx, m.trainIdx) for i, matches in enumerate(matches_by_frame) for m in matches}
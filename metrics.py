@@ -0,0 +1,297 @@
+"""Contains a thread-safe registry of crawl and match metrics, and a small
+HTTP server that exposes it in Prometheus text format and as JSON.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import json
+import time
+
+
+class _Metric:
+    """The base class for metrics. A metric holds one value for every
+    combination of label values it has been given.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names=(), func=None):
+        """
+        :param name: The metric name, in Prometheus naming style
+        :param help_text: A one line description of the metric
+        :param label_names: The names of the labels the metric is split by
+        :param func: If set, the metric has no values of its own and this is
+            called to read its unlabelled value instead
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._func = func
+        self._values = {}
+        self._lock = Lock()
+
+    def get(self, **labels):
+        """Returns the value for the given labels."""
+        if self._func is not None:
+            return self._func()
+        with self._lock:
+            return self._values.get(self._key(labels), self._initial_value())
+
+    def total(self):
+        """Returns the sum of the values over every label combination."""
+        if self._func is not None:
+            return self._func()
+        with self._lock:
+            return sum(self._values.values())
+
+    def values(self):
+        """Returns a list of (labels dict, value) tuples."""
+        if self._func is not None:
+            return [({}, self._func())]
+        with self._lock:
+            items = list(self._values.items())
+        return [(dict(zip(self.label_names, key)), value) for key, value in items]
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(self.name + " takes the labels " + str(self.label_names) +
+                             ", not " + str(tuple(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _initial_value(self):
+        return 0
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Adds to the value for the given labels."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class _HistogramValue:
+    def __init__(self, bucket_cnt):
+        self.bucket_cnts = [0] * bucket_cnt
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    """Counts observations, like latencies, into buckets."""
+
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Records one observation for the given labels."""
+        key = self._key(labels)
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = _HistogramValue(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist.bucket_cnts[i] += 1
+                    break
+            hist.count += 1
+            hist.sum += value
+
+    @contextmanager
+    def time(self, **labels):
+        """A context manager that observes how many seconds its body took."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """Returns a dict with the count, sum and cumulative bucket counts of
+        the observations for the given labels.
+        """
+        with self._lock:
+            hist = self._values.get(self._key(labels))
+            return self._summarize(hist)
+
+    def total(self):
+        """Returns the number of observations over every label combination."""
+        with self._lock:
+            return sum(hist.count for hist in self._values.values())
+
+    def values(self):
+        with self._lock:
+            items = [(key, self._summarize(hist)) for key, hist in self._values.items()]
+        return [(dict(zip(self.label_names, key)), value) for key, value in items]
+
+    def _summarize(self, hist):
+        if hist is None:
+            hist = _HistogramValue(len(self.buckets))
+        cumulative, buckets = 0, []
+        for bound, cnt in zip(self.buckets, hist.bucket_cnts):
+            cumulative += cnt
+            buckets.append((bound, cumulative))
+        return {"count": hist.count, "sum": hist.sum, "buckets": buckets}
+
+
+class MetricsRegistry:
+    """Holds every metric of a crawl. Metrics are created on first use and
+    shared afterwards, so any part of the pipeline can ask for the same one by
+    name.
+    """
+
+    PREFIX = "imagecrawler_"
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = Lock()
+
+    def counter(self, name, help_text, labels=(), func=None):
+        return self._get_or_create(Counter, name, help_text, labels, func=func)
+
+    def gauge(self, name, help_text, labels=(), func=None):
+        return self._get_or_create(Gauge, name, help_text, labels, func=func)
+
+    def histogram(self, name, help_text, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, labels, buckets=buckets)
+
+    def snapshot(self):
+        """Returns the current value of every metric as a JSON-serializable
+        dict.
+        """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        return {metric.name: {"type": metric.TYPE,
+                              "help": metric.help_text,
+                              "values": [{"labels": labels, "value": value}
+                                         for labels, value in metric.values()]}
+                for metric in metrics}
+
+    def to_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        lines = []
+        for metric in metrics:
+            name = self.PREFIX + metric.name
+            lines.append("# HELP " + name + " " + metric.help_text)
+            lines.append("# TYPE " + name + " " + metric.TYPE)
+            for labels, value in metric.values():
+                if metric.TYPE == "histogram":
+                    for bound, cnt in value["buckets"]:
+                        lines.append(name + "_bucket" + _format_labels(labels, le=repr(float(bound))) +
+                                     " " + str(cnt))
+                    lines.append(name + "_bucket" + _format_labels(labels, le="+Inf") +
+                                 " " + str(value["count"]))
+                    lines.append(name + "_sum" + _format_labels(labels) + " " + repr(float(value["sum"])))
+                    lines.append(name + "_count" + _format_labels(labels) + " " + str(value["count"]))
+                else:
+                    lines.append(name + _format_labels(labels) + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+    def _get_or_create(self, metric_class, name, help_text, labels, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = metric_class(name, help_text, labels, **kwargs)
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(labels):
+                raise ValueError("Metric " + name + " already exists with a different type or labels")
+            return metric
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    pairs = [key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+             for key, value in sorted(labels.items())]
+    return "{" + ",".join(pairs) + "}"
+
+
+class MetricsServer:
+    """Serves a MetricsRegistry over HTTP on the local machine.
+
+    /metrics      - Prometheus text format
+    /metrics.json - a JSON snapshot
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        """
+        :param registry: The MetricsRegistry to serve
+        :param port: The port to listen on
+        :param host: The address to listen on
+        """
+        self.registry = registry
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    body = server.registry.to_prometheus().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif path == "/metrics.json":
+                    body = json.dumps(server.registry.snapshot()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't print a line for every scrape
+                pass
+
+        self.__httpd = ThreadingHTTPServer((host, port), Handler)
+        self.__httpd.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def port(self):
+        return self.__httpd.server_address[1]
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self.__thread = Thread(target=self.__httpd.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        """Stops serving and frees the port."""
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
@@ -0,0 +1,283 @@
+"""Contains the page fetch backends the crawler uses to pull image and link
+URLs out of a web page.
+
+StaticFetcher downloads the raw HTML and parses it without starting a browser,
+which is enough for most pages. BrowserFetcher drives a Selenium browser and
+is used for pages that build their content with JavaScript.
+"""
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from html.parser import HTMLParser
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from urllib.parse import urljoin
+import codecs
+import json
+import urllib.request
+
+
+# The image and link URLs found on a single page. Partial pages were cut off
+# before they finished loading.
+Page = namedtuple('Page', ['url', 'image_urls', 'link_urls', 'partial'], defaults=(False,))
+
+# The characters HTML counts as whitespace
+SPACE_CHARS = " \t\n\f\r"
+
+
+class PageFetcher(ABC):
+    """The base class for page fetch backends. Subclasses load a page and
+    return the absolute URLs of every image and link on it.
+    """
+
+    @abstractmethod
+    def fetch(self, url, deadline=None):
+        """Loads the page at the given URL.
+
+        :param url: The URL of the page to load
+        :param deadline: An optional Deadline to load the page by
+        :return: A Page with the image and link URLs found on the page
+        """
+
+
+class _LinkParser(HTMLParser):
+    """Collects img src and srcset, the srcset of source tags in a picture,
+    and a href attributes from raw HTML, like BrowserFetcher.EXTRACT_SCRIPT.
+    """
+
+    def __init__(self, base_url):
+        super(_LinkParser, self).__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.image_urls = []
+        self.link_urls = []
+        self.picture_depth = 0  # How many picture tags the parser is in
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "base" and attrs.get("href"):
+            self.base_url = urljoin(self.base_url, attrs["href"])
+        elif tag == "picture":
+            self.picture_depth += 1
+        elif tag == "img" or (tag == "source" and self.picture_depth > 0):
+            if tag == "img" and attrs.get("src"):
+                self.image_urls.append(urljoin(self.base_url, attrs["src"].strip()))
+            for candidate in _parse_srcset(attrs.get("srcset") or ""):
+                self.image_urls.append(urljoin(self.base_url, candidate))
+        elif tag == "a" and attrs.get("href"):
+            self.link_urls.append(urljoin(self.base_url, attrs["href"].strip()))
+
+    def handle_startendtag(self, tag, attrs):
+        # A self-closing picture has no sources in it
+        if tag != "picture":
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "picture":
+            self.picture_depth = max(self.picture_depth - 1, 0)
+
+
+def _parse_srcset(srcset):
+    """Returns the URLs of the candidates in a srcset attribute. As in the
+    HTML spec, a candidate is a URL followed by optional descriptors, and
+    only a comma after whitespace or at the end of a URL separates
+    candidates, so URLs with commas in them, as image CDNs make, survive.
+    """
+    urls = []
+    pos, end = 0, len(srcset)
+    while pos < end:
+        # Skip the whitespace and commas before the candidate
+        while pos < end and (srcset[pos] in SPACE_CHARS or srcset[pos] == ","):
+            pos += 1
+        start = pos
+        while pos < end and srcset[pos] not in SPACE_CHARS:
+            pos += 1
+        url = srcset[start:pos]
+
+        if url.endswith(","):
+            url = url.rstrip(",")
+        else:
+            # Skip the descriptors, up to the comma that ends the candidate
+            depth = 0
+            while pos < end and (srcset[pos] != "," or depth > 0):
+                if srcset[pos] == "(":
+                    depth += 1
+                elif srcset[pos] == ")":
+                    depth = max(depth - 1, 0)
+                pos += 1
+
+        if url:
+            urls.append(url)
+    return urls
+
+
+def _known_charset(charset):
+    """Returns the charset, or utf-8 if the server sent none or one that
+    Python doesn't know.
+    """
+    if charset:
+        try:
+            codecs.lookup(charset)
+            return charset
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+class StaticFetcher(PageFetcher):
+    """Fetches pages with a plain HTTP request and parses the returned HTML.
+    No JavaScript is run, so pages that build their content in the browser
+    will come back mostly empty.
+    """
+
+    USER_AGENT = "Mozilla/5.0 (compatible; ImageCrawler)"
+
+    # Don't bother parsing anything larger than this
+    MAX_PAGE_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, load_timeout):
+        """
+        :param load_timeout: The amount of seconds to wait for the server
+        """
+        self.load_timeout = load_timeout
+
+    def fetch(self, url, deadline=None):
+        """Downloads and parses the page at the given URL. Raises URLError if
+        the page could not be loaded.
+        """
+        timeout = self.load_timeout
+        if deadline is not None:
+            deadline.check()
+            timeout = deadline.timeout(timeout)
+
+        request = urllib.request.Request(url, headers={"User-Agent": self.USER_AGENT})
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            # Only HTML pages have images and links worth parsing
+            if resp.headers.get_content_type() not in ("text/html", "application/xhtml+xml"):
+                return Page(url=url, image_urls=[], link_urls=[])
+
+            charset = _known_charset(resp.headers.get_content_charset())
+            html = resp.read(self.MAX_PAGE_BYTES).decode(charset, errors="replace")
+
+            # Links are relative to wherever we ended up after redirects
+            final_url = resp.geturl()
+
+        parser = _LinkParser(final_url)
+        parser.feed(html)
+        parser.close()
+
+        return Page(url=url, image_urls=parser.image_urls, link_urls=parser.link_urls)
+
+
+class BrowserFetcher(PageFetcher):
+    """Fetches pages by loading them in a Selenium browser, so that images and
+    links created by JavaScript are found too.
+    """
+
+    # Collects the absolute URL of every image source, srcset candidate and
+    # link in the page. Written in ES5, since PhantomJS doesn't support newer
+    # JavaScript.
+    EXTRACT_SCRIPT = """
+        var resolver = document.createElement('a');
+        function resolve(url) {
+            resolver.href = url;
+            return resolver.href;
+        }
+        // Splits srcset like _parse_srcset, so commas inside URLs survive
+        function addSrcset(srcset, urls) {
+            if (!srcset) { return; }
+            var pos = 0, end = srcset.length;
+            while (pos < end) {
+                while (pos < end && /[ \\t\\n\\f\\r,]/.test(srcset.charAt(pos))) { pos++; }
+                var start = pos;
+                while (pos < end && !/[ \\t\\n\\f\\r]/.test(srcset.charAt(pos))) { pos++; }
+                var url = srcset.substring(start, pos);
+
+                if (url.charAt(url.length - 1) === ',') {
+                    url = url.replace(/,+$/, '');
+                } else {
+                    var depth = 0;
+                    while (pos < end && (srcset.charAt(pos) !== ',' || depth > 0)) {
+                        if (srcset.charAt(pos) === '(') { depth++; }
+                        else if (srcset.charAt(pos) === ')') { depth = Math.max(depth - 1, 0); }
+                        pos++;
+                    }
+                }
+
+                if (url) { urls.push(resolve(url)); }
+            }
+        }
+
+        var images = [];
+        var imgs = document.getElementsByTagName('img');
+        for (var i = 0; i < imgs.length; i++) {
+            var src = imgs[i].getAttribute('src');
+            if (src) { images.push(imgs[i].src); }
+            addSrcset(imgs[i].getAttribute('srcset'), images);
+        }
+        var sources = document.querySelectorAll('picture source');
+        for (var i = 0; i < sources.length; i++) {
+            addSrcset(sources[i].getAttribute('srcset'), images);
+        }
+
+        var links = [];
+        var anchors = document.getElementsByTagName('a');
+        for (var i = 0; i < anchors.length; i++) {
+            if (anchors[i].getAttribute('href')) { links.push(anchors[i].href); }
+        }
+
+        return JSON.stringify({images: images, links: links});
+    """
+
+    def __init__(self, browser, harvest_partial=False):
+        """
+        :param browser: The Selenium browser to load pages on
+        :param harvest_partial: If true, pages that hit the browser's page
+            load timeout are stopped and whatever has loaded is returned
+        """
+        self.browser = browser
+        self.harvest_partial = harvest_partial
+
+    def fetch(self, url, deadline=None):
+        """Loads the page in the browser. Raises TimeoutException if the page
+        takes longer than the browser's page load timeout, unless partial
+        pages are harvested.
+        """
+        if deadline is not None:
+            # The load itself is bounded by the page load timeout, and is
+            # interrupted by quitting the browser
+            deadline.check()
+
+        try:
+            self.browser.get(url)
+        except TimeoutException:
+            if not self.harvest_partial:
+                raise
+            page = self._harvest(url)
+            if page is None:
+                raise
+            return page
+
+        return self._extract_page(url)
+
+    def _harvest(self, url):
+        """Stops a page that is still loading and reads what is there. The
+        DOM is usually mostly built by the time a load times out, since the
+        time goes to slow third party scripts and images.
+
+        :param url: The URL the page was loaded from
+        :return: A partial Page, or None if the page could not be read
+        """
+        try:
+            self.browser.execute_script("window.stop();")
+            page = self._extract_page(url)
+        except (WebDriverException, ValueError, TypeError):
+            return None
+        return page._replace(partial=True)
+
+    def _extract_page(self, url):
+        """Reads the image and link URLs of the loaded page with a single
+        script call, instead of one WebDriver round trip per element.
+
+        :param url: The URL the page was loaded from
+        :return: A Page with the image and link URLs
+        """
+        payload = json.loads(self.browser.execute_script(self.EXTRACT_SCRIPT))
+        return Page(url=url, image_urls=payload["images"], link_urls=payload["links"])
@@ -1,6 +1,10 @@
 import cv2
+import heapq
 import numpy as np
+import sys
+import time
 from collections import namedtuple
+from matchers import create_matcher, matcher_spec
 
 
 class Tracker:
@@ -60,26 +64,55 @@ class PlaneTracker(Tracker):
                                                'match_ratio'])
 
     # Tracker parameters
-    FLANN_INDEX_KDTREE = 1
-    FLANN_INDEX_LSH = 6
     MIN_MATCH_COUNT = 15
 
-
-    flanParams = dict(algorithm=FLANN_INDEX_LSH,
-                      table_number=6,  # 3,  #  6,  # 12,
-                      key_size=12,  # 19,  # 12,  # 20,
-                      multi_probe_level=1)  # 1)   #  1)  #  2)
-
     K = None  # Set in get3DCoordinates
     dist_coeffs = np.zeros(4)
 
-    def __init__(self, focal_length, history_length, max_features_detect=5000):
+    # Frames never get a feature budget below this
+    MIN_FEATURES_DETECT = 100
+
+    # The coarse pass of coarse_to_fine looks at the frame at this scale, with a feature budget to match, and only
+    # frames with this many matches with some target are then detected at full resolution
+    COARSE_SCALE = 0.5
+    COARSE_MIN_MATCHES = 8
+
+    def __init__(self, focal_length, history_length, max_features_detect=5000, frame_scale_factor=0,
+                 coarse_to_fine=False, matcher=None, shortlist_size=0, scale_feature_budget=False):
+        """
+        :param max_features_detect: How many features to detect in targets, and at most in frames
+        :param frame_scale_factor: If above zero, frames with more pixels than this many times the largest target
+            are scaled down to that size before features are detected
+        :param coarse_to_fine: If true, match_frames first matches a thumbnail of each frame, and only detects
+            features at full resolution in frames that had enough matches
+        :param matcher: The spec of the descriptor matcher to use, as matchers.create_matcher takes it, or None for
+            matchers.DEFAULT_MATCHER
+        :param shortlist_size: If above zero, and there are more targets than this, frames are only matched against
+            this many targets, those template_index ranks highest for them. template_index must be set for it.
+        :param scale_feature_budget: If true, frames smaller than the largest target get a feature budget in
+            proportion to their area, and their match ratio is out of the fewer of the target's keypoints and the
+            budget. Otherwise every frame gets max_features_detect, and match ratios are out of the target's keypoints.
+        """
         super(PlaneTracker, self).__init__(history_length)
         self.focal_length = focal_length
+        self.max_features_detect = max_features_detect
+        self.frame_scale_factor = frame_scale_factor
+        self.coarse_to_fine = coarse_to_fine
+        self.scale_feature_budget = scale_feature_budget
         self.detector = cv2.ORB_create(nfeatures=max_features_detect)
 
-        # For ORB
-        self.matcher = cv2.FlannBasedMatcher(self.flanParams, {})  # bug : need to pass empty dict (#1329)
+        # For ORB. Every target has its own matcher, trained as soon as the target is added, so adding or removing
+        # a target never retrains the matchers of the others. Frames matched against every target go through a
+        # shared matcher trained on all of them instead, which takes one lookup per batch rather than one per
+        # target, and is rebuilt on the first match after the targets change.
+        self.matcher_spec = matcher_spec(matcher)
+        self.matchers = []
+        self.__shared_matcher = None
+        self.__shared_owners = None  # The (target index, index into its descriptors) of the shared matcher's ones
+
+        # A vocabulary.TemplateIndex with a document for every target, in the same order, kept by its owner
+        self.shortlist_size = shortlist_size
+        self.template_index = None
 
     def create_target(self, view):
         """
@@ -105,69 +138,339 @@ class PlaneTracker(Tracker):
         # If it was possible to add the target
         return target
 
-    def add_target(self, img, rect):
-        # This function checks if a view is currently being tracked, and if not it generates a target and adds it
-
+    def add_target(self, img, rect, features=None):
+        """
+        This function checks if a view is currently being tracked, and if not it generates a target and adds it.
+        features can be the (keypoints, descrs) of the target, in the form get_target_features returns them, to skip
+        detecting them again. Returns the new PlaneTarget, or None if the view was already tracked.
+        """
         for target in self.targets:
-            if img == target.view: return
+            if target.view.image is img and target.view.rect == rect: return
         view = self.View(image=img, rect=rect)
-        planar_target = self.create_target(view)
+        if features is None:
+            planar_target = self.create_target(view)
+        else:
+            keypoints, descrs = features
+            planar_target = self.PlaneTarget(view=view, keypoints=self._to_keypoints(keypoints), descrs=descrs)
 
-        descrs = planar_target.descrs
-        self.matcher.add([descrs])
-        self.targets.append(planar_target)
+        self._add_planar_target(planar_target)
+        return planar_target
+
+    def get_detector_params(self):
+        """ Returns the settings that change which features are detected in an image """
+        return {"detector": "orb", "nfeatures": self.max_features_detect, "opencv": cv2.__version__}
+
+    def get_target_features(self, index=None):
+        """
+        Returns the rect, keypoints and descriptors of every target in a form that can be pickled, so that other
+        processes can track the same targets without detecting their features again. With an index, returns only
+        those of the target at the index.
+        """
+        if index is not None:
+            target = self.targets[index]
+            return target.view.rect, self._from_keypoints(target.keypoints), target.descrs
+        return [self.get_target_features(i) for i in range(len(self.targets))]
+
+    def add_target_features(self, features):
+        """ Adds targets from the output of get_target_features. The target images themselves are not kept. """
+        for rect, keypoints, descrs in features:
+            target = self.PlaneTarget(view=self.View(image=None, rect=rect), keypoints=self._to_keypoints(keypoints),
+                                      descrs=descrs)
+            self._add_planar_target(target)
+
+    def remove_target(self, index):
+        """ Stops tracking the target at the index. The targets after it move down by one. """
+        del self.targets[index]
+        del self.matchers[index]
+        self.__shared_matcher = None
 
     def clear(self):
         super().clear()
 
         # Remove all targets
-        self.matcher.clear()
+        self.matchers = []
+        self.__shared_matcher = None
+
+    def set_matcher(self, spec):
+        """ Switches to another descriptor matcher, retraining it on every target """
+        self.matcher_spec = matcher_spec(spec)
+        self.matchers = [self._train_matcher(target) for target in self.targets]
+        self.__shared_matcher = None
+
+    def _add_planar_target(self, target):
+        self.targets.append(target)
+        self.matchers.append(self._train_matcher(target))
+        self.__shared_matcher = None
+
+    def _train_matcher(self, target):
+        matcher = create_matcher(self.matcher_spec)
+        matcher.train(target.descrs)
+        return matcher
+
+    def _get_shared_matcher(self):
+        # Returns the matcher trained on the descriptors of every target, or None if the matchers don't do the ratio
+        # test. The nearest two over all the targets are then the same as the nearest two of the targets' own ones.
+        if self.__shared_matcher is None and all(matcher.ratio_test for matcher in self.matchers):
+            descrs = [np.uint8(target.descrs).reshape(-1, 32) for target in self.targets]
+            if not sum(len(target_descrs) for target_descrs in descrs):
+                return None
+            self.__shared_owners = [(imgIdx, trainIdx) for imgIdx, target_descrs in enumerate(descrs)
+                                    for trainIdx in range(len(target_descrs))]
+            self.__shared_matcher = create_matcher(self.matcher_spec)
+            self.__shared_matcher.train(np.concatenate(descrs))
+        return self.__shared_matcher
+
+    @staticmethod
+    def _from_keypoints(keypoints):
+        return [(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id) for kp in keypoints]
+
+    @staticmethod
+    def _to_keypoints(keypoints):
+        return [cv2.KeyPoint(x, y, size, angle, response, int(octave), int(class_id))
+                for x, y, size, angle, response, octave, class_id in keypoints]
 
     def track(self, frame):
         # updates self.tracked with a list of detected TrackedTarget objects
-        frame_points, frame_descrs = self.__detect_features(frame)
-        tracked = []
-
-        # If no keypoints were detected, then don't update the self.trackedHistory array
-        if len(frame_points) < self.MIN_MATCH_COUNT:
-            self._addToHistory(tracked)
-            return
-        matches = self.matcher.knnMatch(frame_descrs, k=2)
-
-        # try:
-        #     matches = self.matcher.knnMatch(frame_descrs, k=2)
-        # except Exception as e:
-        #     print("OPENCV ERROR!", e)
-        #     return
+        tracked, _, _ = self.match_frames([frame])[0]
+        self._addToHistory(tracked)
 
-        matches = [m[0] for m in matches if len(m) == 2 and m[0].distance < m[1].distance * 0.75]
+    def match_frames(self, frames, min_match_ratio=None, excluded=None):
+        """
+        Finds the targets in every frame without touching the history, so it is safe to use for many unrelated
+        images. The descriptors of all the frames are matched against the targets in a single knnMatch call, so the
+        matchers' overhead is paid once per batch instead of once per frame.
+
+        Returns a list with a (tracked, timings, evaluated) tuple for every frame. tracked is the list of
+        TrackedPlane objects found in the frame, most inliers first, and timings is a dict with the seconds spent on
+        the frame in the "coarse", "detect", "match" and "verify" stages, where shortlisting counts as matching. The
+        match time of a batch is split evenly between its frames. evaluated is the list of the indices of the
+        targets whose outcome is known. Targets that were evaluated but are not in tracked were not found, which
+        includes the targets a frame was not shortlisted for, and every target when the coarse pass skipped it.
+
+        If min_match_ratio is given, only whether a target reaches it matters. Targets are verified from the highest
+        match ratio down, only while they reach it, and tracked holds just the first one confirmed, which is the one
+        with the highest match ratio the full search would find. Its quad, center and rotation are None. The targets
+        that reached the ratio but were not verified after it are left out of evaluated.
+
+        excluded can be a list with the indices of the targets not to match each frame against, like those whose
+        outcome is already known. They are left out of evaluated too.
+        """
+        if excluded is None:
+            excluded = [()] * len(frames)
+        excluded = [set(targets) for targets in excluded]
+
+        promising, coarse_times = [True] * len(frames), [0] * len(frames)
+        if self.coarse_to_fine and self.targets:
+            promising, coarse_times = self._coarse_pass(frames, excluded)
+
+        detected = []
+        for frame, is_promising in zip(frames, promising):
+            if not is_promising:
+                detected.append(([], [], 0, 0))
+                continue
+            start = time.perf_counter()
+            frame_points, frame_descrs, max_features = self._detect_scaled(frame)
+            detected.append((frame_points, frame_descrs, max_features, time.perf_counter() - start))
+
+        # Frames with too few keypoints can't match anything, so leave them out of the batch
+        queried = [i for i, (frame_points, _, _, _) in enumerate(detected)
+                   if len(frame_points) >= self.MIN_MATCH_COUNT]
+
+        start = time.perf_counter()
+        frame_descrs = [detected[i][1] for i in queried]
+        shortlists = self._shortlists(frame_descrs, [excluded[i] for i in queried])
+        matches = self.match_frame_descriptors(frame_descrs, shortlists)
+        matches_by_frame = dict(zip(queried, matches))
+        match_time = (time.perf_counter() - start) / max(len(queried), 1)
+
+        results = []
+        for i, (frame, (frame_points, _, max_features, detect_time)) in enumerate(zip(frames, detected)):
+            timings = {"coarse": coarse_times[i], "detect": detect_time, "match": 0, "verify": 0}
+            tracked, unverified = [], []
+            if i in matches_by_frame:
+                timings["match"] = match_time
+                start = time.perf_counter()
+                if min_match_ratio is None:
+                    tracked = self._find_targets(frame, frame_points, max_features, matches_by_frame[i])
+                else:
+                    tracked, unverified = self._find_first_target(frame_points, max_features, matches_by_frame[i],
+                                                                  min_match_ratio)
+                timings["verify"] = time.perf_counter() - start
+
+            # The coarse pass only skips frames that barely match every target on its own, and the shortlist ranks
+            # the targets it leaves out below the ones it keeps, so both count as not found
+            unknown = excluded[i].union(unverified)
+            results.append((tracked, timings, [j for j in range(len(self.targets)) if j not in unknown]))
+        return results
+
+    def _coarse_pass(self, frames, excluded):
+        # Matches a thumbnail of every frame with a small feature budget. Returns whether each frame had enough
+        # matches with some target to be worth detecting at full resolution, and the seconds spent on each frame.
+        detected, times = [], []
+        for frame in frames:
+            start = time.perf_counter()
+            detected.append(self._detect_scaled(frame, self.COARSE_SCALE))
+            times.append(time.perf_counter() - start)
+
+        queried = [i for i, (points, _, _) in enumerate(detected) if len(points) >= self.COARSE_MIN_MATCHES]
+        promising = [False] * len(frames)
+
+        start = time.perf_counter()
+        frame_descrs = [detected[i][1] for i in queried]
+        shortlists = self._shortlists(frame_descrs, [excluded[i] for i in queried])
+        for i, matches in zip(queried, self.match_frame_descriptors(frame_descrs, shortlists)):
+            match_cnts = [0] * len(self.targets)
+            for m in matches:
+                match_cnts[m.imgIdx] += 1
+            promising[i] = max(match_cnts, default=0) >= self.COARSE_MIN_MATCHES
+        match_time = (time.perf_counter() - start) / max(len(queried), 1)
+
+        for i in queried:
+            times[i] += match_time
+        return promising, times
+
+    def _detect_scaled(self, frame, scale=1.0):
+        # Detects features in the frame after scaling it down by the resolution policy and then by scale, with a
+        # feature budget for its new size. Returns the points, as an array of (x, y) in the coordinates of the
+        # original frame, their descriptors and the feature budget. Thumbnails always get a budget for their size.
+        h, w = frame.shape[:2]
+        is_thumbnail = scale < 1
+        scale = min(scale * self._frame_scale(w * h), 1.0)
+        if scale < 1:
+            frame = cv2.resize(frame, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+            h, w = frame.shape[:2]
 
+        max_features = self._feature_budget(w * h, self.scale_feature_budget or is_thumbnail)
+        keypoints, descrs = self.__detect_features(frame, max_features)
+        points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2) / scale
+        return points, descrs, max_features
+
+    def _largest_target_pixels(self):
+        return max(((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in (t.view.rect for t in self.targets)), default=0)
+
+    def _frame_scale(self, pixels):
+        # How much the resolution policy shrinks each side of a frame with this many pixels
+        max_pixels = self._largest_target_pixels() * self.frame_scale_factor
+        if max_pixels <= 0 or pixels <= max_pixels:
+            return 1.0
+        return (max_pixels / pixels) ** 0.5
+
+    def _feature_budget(self, pixels, scaled=True):
+        # Frames at least as large as the largest target get the full budget, and if scaled, smaller ones get less
+        reference_pixels = self._largest_target_pixels()
+        if not scaled or reference_pixels <= 0:
+            return self.max_features_detect
+        budget = int(self.max_features_detect * pixels / reference_pixels)
+        return max(min(budget, self.max_features_detect), min(self.MIN_FEATURES_DETECT, self.max_features_detect))
+
+    def detect_frame(self, frame):
+        """ Returns the points and descriptors match_frames would detect in a frame, without coarse_to_fine """
+        points, descrs, _ = self._detect_scaled(frame)
+        return points, descrs
+
+    def match_frame_descriptors(self, frame_descrs, shortlists=None):
+        """
+        Matches the descriptors of several frames against the targets in a single call. Returns a list with the
+        matches of each frame, whose queryIdx indexes into the frame's own descriptors and imgIdx is the target.
+        shortlists can be a list with the indices of the only targets to match each frame against.
+        """
+        sizes = [len(descrs) for descrs in frame_descrs]
+        if not self.targets or not any(sizes):
+            return [[] for _ in frame_descrs]
+        if shortlists is None:
+            shortlists = [range(len(self.targets))] * len(frame_descrs)
+        nearest = [[[] for _ in range(size)] for size in sizes]
+
+        # The frames matched against every target go through the shared matcher in one call
+        shared_matcher = self._get_shared_matcher()
+        shared = []
+        if shared_matcher is not None:
+            shared = [i for i, shortlist in enumerate(shortlists) if sizes[i] and len(shortlist) == len(self.targets)]
+        if shared:
+            knns = shared_matcher.knn_match(np.concatenate([frame_descrs[i] for i in shared]))
+            offset = 0
+            for i in shared:
+                for queryIdx, knn in enumerate(knns[offset:offset + sizes[i]]):
+                    # Turn the index into all the targets' descriptors back into one into the target's own
+                    nearest[i][queryIdx].extend((distance,) + self.__shared_owners[trainIdx]
+                                                for distance, trainIdx in knn)
+                offset += sizes[i]
+
+        # Every target is matched against the descriptors of the other frames that shortlisted it in one call
+        frames_by_target = [[] for _ in self.targets]
+        shared = set(shared)
+        for i, shortlist in enumerate(shortlists):
+            if sizes[i] and i not in shared:
+                for imgIdx in shortlist:
+                    frames_by_target[imgIdx].append(i)
+
+        batches = {}
+        for imgIdx, (matcher, frames) in enumerate(zip(self.matchers, frames_by_target)):
+            if not frames:
+                continue
+            key = tuple(frames)
+            if key not in batches:
+                batches[key] = np.concatenate([frame_descrs[i] for i in frames])
+            knns = matcher.knn_match(batches[key])
+
+            offset = 0
+            for i in frames:
+                # Turn the index into the batch back into an index into the frame
+                for queryIdx, knn in enumerate(knns[offset:offset + sizes[i]]):
+                    nearest[i][queryIdx].extend((distance, imgIdx, trainIdx) for distance, trainIdx in knn)
+                offset += sizes[i]
+
+        return [self._filter_matches(frame_nearest) for frame_nearest in nearest]
+
+    def _filter_matches(self, nearest):
+        # Takes the nearest target descriptors of every descriptor over all the targets' matchers, and keeps the
+        # nearest one if it is clearly nearer than the second. imgIdx of the matches is the index of the target.
+
+        # Matchers without the ratio test, like cross checking ones, only return matches they already trust
+        ratio_test = all(matcher.ratio_test for matcher in self.matchers)
+
+        matches = []
+        for queryIdx, candidates in enumerate(nearest):
+            if not ratio_test:
+                if candidates:
+                    distance, imgIdx, trainIdx = min(candidates)
+                    matches.append(cv2.DMatch(queryIdx, trainIdx, imgIdx, float(distance)))
+                continue
+            if len(candidates) < 2:
+                continue
+            (distance, imgIdx, trainIdx), (second_distance, _, _) = heapq.nsmallest(2, candidates)
+            if distance < second_distance * 0.75:
+                matches.append(cv2.DMatch(queryIdx, trainIdx, imgIdx, float(distance)))
+        return matches
+
+    def _shortlists(self, frame_descrs, excluded):
+        # The targets the template index shortlists for every frame out of those it is not excluded from, or None
+        # to match frames against every target
+        if self.template_index is None or not 0 < self.shortlist_size < len(self.targets):
+            if not any(excluded):
+                return None
+            return [[j for j in range(len(self.targets)) if j not in targets] for targets in excluded]
+        return [[j for j in self.template_index.shortlist(descrs, self.shortlist_size + len(targets))
+                 if j not in targets][:self.shortlist_size]
+                for descrs, targets in zip(frame_descrs, excluded)]
+
+    def _find_targets(self, frame, frame_points, max_features, matches):
+        # Returns a TrackedPlane for every target whose matches agree on a homography
         if len(matches) < self.MIN_MATCH_COUNT:
-            self._addToHistory(tracked)
-            return
-
-        matches_by_id = [[] for _ in range(len(self.targets))]
-        for m in matches:
-            matches_by_id[m.imgIdx].append(m)
+            return []
 
         tracked = []
 
-        for imgIdx, matches in enumerate(matches_by_id):
+        for imgIdx, matches in enumerate(self._matches_by_target(matches)):
 
             if len(matches) < self.MIN_MATCH_COUNT:
                 continue
 
             target = self.targets[imgIdx]
 
-            p0 = [target.keypoints[m.trainIdx].pt for m in matches]
-            p1 = [frame_points[m.queryIdx].pt for m in matches]
-            p0, p1 = np.float32((p0, p1))
-            H, status = cv2.findHomography(p0, p1, cv2.RANSAC, 3.0)
-
-            status = status.ravel() != 0
-            if status.sum() < self.MIN_MATCH_COUNT: continue
-
-            p0, p1 = p0[status], p1[status]
+            verified = self._verify(target, frame_points, matches)
+            if verified is None: continue
+            H, p0, p1 = verified
 
             x0, y0, x1, y1 = target.view.rect
             quad = np.float32([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
@@ -180,19 +483,83 @@ class PlaneTracker(Tracker):
                                       view=target.view,
                                       quad=quad,
                                       ptCount=len(matches),
-                                      match_ratio=len(matches) / len(target.keypoints),
+                                      match_ratio=self._match_ratio(target, max_features, len(matches)),
                                       center=center,
                                       rotation=rotation,
                                       p0=p0, p1=p1, H=H)
             tracked.append(track)
 
         tracked.sort(key=lambda t: len(t.p0), reverse=True)
+        return tracked
 
-        self._addToHistory(tracked)
+    def _find_first_target(self, frame_points, max_features, matches, min_match_ratio):
+        # Returns a list with the TrackedPlane of the target with the highest match ratio that reaches
+        # min_match_ratio and agrees on a homography, without its quad or 3D pose, or an empty list if there is none,
+        # and the indices of the targets that reach it too but were not verified
+        if len(matches) < self.MIN_MATCH_COUNT:
+            return [], []
+
+        # The match ratio is known before verifying, so targets that can't reach it are never verified
+        candidates = []
+        for imgIdx, matches in enumerate(self._matches_by_target(matches)):
+            if len(matches) < self.MIN_MATCH_COUNT:
+                continue
+            match_ratio = self._match_ratio(self.targets[imgIdx], max_features, len(matches))
+            if match_ratio >= min_match_ratio:
+                candidates.append((match_ratio, imgIdx, matches))
+        candidates.sort(key=lambda c: c[0], reverse=True)
 
-    def __detect_features(self, frame):
+        for candidate, (match_ratio, imgIdx, matches) in enumerate(candidates):
+            target = self.targets[imgIdx]
+            verified = self._verify(target, frame_points, matches)
+            if verified is None: continue
+            H, p0, p1 = verified
+
+            unverified = [imgIdx for _, imgIdx, _ in candidates[candidate + 1:]]
+            return [self.TrackedPlane(target=target,
+                                      view=target.view,
+                                      quad=None,
+                                      ptCount=len(matches),
+                                      match_ratio=match_ratio,
+                                      center=None,
+                                      rotation=None,
+                                      p0=p0, p1=p1, H=H)], unverified
+        return [], []
+
+    def _match_ratio(self, target, max_features, match_cnt):
+        # With scaled budgets, a frame with a smaller feature budget than the target has keypoints can't match all
+        # of them, so the ratio is of the most features both could have
+        if self.scale_feature_budget:
+            return match_cnt / max(min(len(target.keypoints), max_features), 1)
+        return match_cnt / max(len(target.keypoints), 1)
+
+    def _matches_by_target(self, matches):
+        matches_by_id = [[] for _ in range(len(self.targets))]
+        for m in matches:
+            matches_by_id[m.imgIdx].append(m)
+        return matches_by_id
+
+    def _verify(self, target, frame_points, matches):
+        # Returns the homography from the target to the frame and the matched points that agree with it, as a
+        # (H, p0, p1) tuple, or None if too few of them agree
+        p0 = np.float32([target.keypoints[m.trainIdx].pt for m in matches])
+        p1 = np.float32(frame_points[[m.queryIdx for m in matches]])
+        H, status = cv2.findHomography(p0, p1, cv2.RANSAC, 3.0)
+        if H is None:
+            return None
+
+        status = status.ravel() != 0
+        if status.sum() < self.MIN_MATCH_COUNT:
+            return None
+
+        return H, p0[status], p1[status]
+
+    def __detect_features(self, frame, max_features=None):
         cv2.ocl.setUseOpenCL(False)  # THIS FIXES A ERROR BUG: "The data should normally be NULL!"
 
+        # Targets always get the full budget
+        self.detector.setMaxFeatures(max_features if max_features is not None else self.max_features_detect)
+
         # detect_features(self, frame) -> keypoints, descrs
         keypoints, descrs = self.detector.detectAndCompute(frame, None)
         if descrs is None:  # detectAndCompute returns descs=None if not keypoints found
@@ -306,7 +673,8 @@ class PlaneTracker(Tracker):
                     tMask = drawOutlineText(tMask, coordText, chosenCorner,
                                             self.fFnt, scaleFactor - .6, color=self.fColor, thickness=1)
                 except ValueError as e:
-                    print("Vision| ERROR: Drawing failed because a None was attempted to be turned into int", e)
+                    print("Vision| ERROR: Drawing failed because a None was attempted to be turned into int", e,
+                          file=sys.stderr)
 
         # Apply the semi-transparent mask to the frame, with translucency
         frame[tMask > 0] = tMask[tMask > 0] * .7 + frame[tMask > 0] * .3
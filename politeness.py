@@ -0,0 +1,260 @@
+"""Contains a per-host scheduler that keeps the crawler from overloading any
+one website, and a cache of robots.txt files.
+"""
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from threading import Lock, Semaphore
+from urllib.error import HTTPError
+from urllib.robotparser import RobotFileParser
+from url_utils import url_host
+import http.client
+import sys
+import time
+import urllib.request
+
+
+class RobotsCache:
+    """Downloads and caches the robots.txt file of every host the crawler
+    visits. A download cut short by a deadline or cancellation is not cached,
+    so the next request to the host tries again.
+    """
+
+    # How often a request waiting for another thread's download checks its deadline
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, user_agent, timeout):
+        """
+        :param user_agent: The user agent to match robots.txt rules against
+        :param timeout: The amount of seconds to wait for a robots.txt file
+        """
+        self.__user_agent = user_agent
+        self.__timeout = timeout
+        self.__parsers = {}
+        self.__host_locks = {}
+        self.__lock = Lock()
+
+    def allowed(self, url, deadline=None):
+        """Returns true if robots.txt allows the crawler to load the URL.
+
+        :param url: An http or https URL
+        :param deadline: An optional Deadline. Raises Cancelled or
+            DeadlineExceeded if it ends before robots.txt is loaded.
+        """
+        return self._get_parser(url, deadline).can_fetch(self.__user_agent, url)
+
+    def crawl_delay(self, url, deadline=None):
+        """Returns the amount of seconds robots.txt asks crawlers to wait
+        between requests to the URL's host, or None if it doesn't say.
+
+        :param url: An http or https URL
+        :param deadline: An optional Deadline, as for allowed
+        """
+        parser = self._get_parser(url, deadline)
+        delay = parser.crawl_delay(self.__user_agent)
+        if delay is None:
+            rate = parser.request_rate(self.__user_agent)
+            if rate is not None and rate.requests:
+                delay = rate.seconds / rate.requests
+        return delay
+
+    def _get_parser(self, url, deadline):
+        """Returns the parsed robots.txt of the URL's host, downloading it the
+        first time the host is seen.
+        """
+        host = url_host(url)
+        with self.__lock:
+            if host in self.__parsers:
+                return self.__parsers[host]
+            host_lock = self.__host_locks.setdefault(host, Lock())
+
+        # Only one thread downloads each host's robots.txt
+        if deadline is None:
+            host_lock.acquire()
+        else:
+            while not host_lock.acquire(timeout=deadline.timeout(self.POLL_INTERVAL)):
+                deadline.check()
+        try:
+            with self.__lock:
+                if host in self.__parsers:
+                    return self.__parsers[host]
+
+            scheme, _, netloc = url.split("/", 3)[:3]
+            parser = self._download(scheme + "//" + netloc + "/robots.txt", deadline)
+            with self.__lock:
+                self.__parsers[host] = parser
+            return parser
+        finally:
+            host_lock.release()
+
+    def _download(self, robots_url, deadline):
+        timeout = self.__timeout
+        if deadline is not None:
+            deadline.check()
+            timeout = deadline.timeout(timeout)
+
+        parser = RobotFileParser(robots_url)
+        request = urllib.request.Request(robots_url, headers={"User-Agent": self.__user_agent})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as resp:
+                lines = resp.read().decode("utf-8", errors="replace").splitlines()
+        except HTTPError as e:
+            # Same rules as RobotFileParser.read
+            if e.code in (401, 403):
+                parser.disallow_all = True
+            else:
+                parser.allow_all = True
+            return parser
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            if deadline is not None:
+                # A download the deadline cut short says nothing about the file
+                deadline.check()
+            print("Warning: could not load " + robots_url + ": ", e, file=sys.stderr)
+            parser.allow_all = True
+            return parser
+
+        parser.parse(lines)
+        return parser
+
+
+class _HostState:
+    """The scheduling state of a single host."""
+
+    def __init__(self, max_concurrency, min_delay):
+        self.semaphore = Semaphore(max_concurrency)
+        self.min_delay = min_delay
+        self.next_time = 0  # The earliest time.monotonic() the next request may start
+        self.throttle_cnt = 0  # How many throttling responses came in a row
+        self.lock = Lock()
+
+
+class HostScheduler:
+    """Limits how hard the crawler hits each host, for both page loads and
+    image downloads. Each host gets a maximum number of requests at once and a
+    minimum delay between the start of requests, which is raised to the
+    host's robots.txt Crawl-delay if it asks for more, up to MAX_CRAWL_DELAY.
+    When a host answers
+    with 429 or 503, requests to it are held back for an exponentially
+    growing time, or for as long as its Retry-After header asks.
+    """
+
+    THROTTLE_STATUS_CODES = {429, 503}
+
+    # The most seconds a robots.txt Crawl-delay may hold requests to a host apart
+    MAX_CRAWL_DELAY = 30
+
+    # How often a request waiting for a concurrency slot checks its deadline
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, max_concurrency, min_delay, robots=None, max_backoff=120):
+        """
+        :param max_concurrency: The most requests that may be open to one host
+        :param min_delay: The least amount of seconds between the start of two
+            requests to one host
+        :param robots: An optional RobotsCache to read crawl delays from
+        :param max_backoff: The most seconds a throttled host is held back for
+        """
+        self.throttled_cnt = 0
+
+        self.__max_concurrency = max(max_concurrency, 1)
+        self.__min_delay = min_delay
+        self.__robots = robots
+        self.__max_backoff = max_backoff
+        self.__hosts = {}
+        self.__lock = Lock()
+
+    @contextmanager
+    def slot(self, url, deadline=None):
+        """A context manager that blocks until a request to the URL's host may
+        start, and holds one of the host's concurrency slots until it exits.
+
+        :param url: An http or https URL
+        :param deadline: An optional Deadline. Raises Cancelled or
+            DeadlineExceeded if it ends before the request may start.
+        """
+        state = self._get_state(url, deadline)
+
+        if deadline is None:
+            state.semaphore.acquire()
+        else:
+            while not state.semaphore.acquire(timeout=deadline.timeout(self.POLL_INTERVAL)):
+                deadline.check()
+
+        try:
+            while True:
+                with state.lock:
+                    now = time.monotonic()
+                    if now >= state.next_time:
+                        state.next_time = now + state.min_delay
+                        break
+                    wait = state.next_time - now
+                if deadline is None:
+                    time.sleep(wait)
+                else:
+                    deadline.sleep(wait)
+
+            yield
+        finally:
+            state.semaphore.release()
+
+    def report_throttled(self, url, retry_after=None, deadline=None):
+        """Holds back requests to the URL's host after it answered 429 or 503.
+
+        :param url: An http or https URL
+        :param retry_after: The value of the response's Retry-After header
+        :param deadline: An optional Deadline for loading the host's
+            robots.txt, as for slot
+        """
+        state = self._get_state(url, deadline)
+        delay = _parse_retry_after(retry_after)
+
+        with state.lock:
+            state.throttle_cnt += 1
+            if delay is None:
+                delay = min(max(state.min_delay, 1) * 2 ** state.throttle_cnt, self.__max_backoff)
+            state.next_time = max(state.next_time, time.monotonic() + min(delay, self.__max_backoff))
+        with self.__lock:
+            self.throttled_cnt += 1
+
+        print("Warning: " + url_host(url) + " is throttling requests, waiting " +
+              str(round(delay, 1)) + "s", file=sys.stderr)
+
+    def report_success(self, url):
+        """Resets the backoff of the URL's host after a successful request.
+
+        :param url: An http or https URL
+        """
+        state = self._get_state(url)
+        with state.lock:
+            state.throttle_cnt = 0
+
+    def _get_state(self, url, deadline=None):
+        host = url_host(url)
+        with self.__lock:
+            state = self.__hosts.get(host)
+            if state is not None:
+                return state
+
+        min_delay = self.__min_delay
+        if self.__robots is not None:
+            crawl_delay = self.__robots.crawl_delay(url, deadline)
+            if crawl_delay is not None:
+                min_delay = max(min_delay, min(crawl_delay, self.MAX_CRAWL_DELAY))
+
+        with self.__lock:
+            return self.__hosts.setdefault(host, _HostState(self.__max_concurrency, min_delay))
+
+
+def _parse_retry_after(value):
+    """Returns the number of seconds a Retry-After header asks to wait, or
+    None if it is missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,286 @@
+"""Contains a cascade of cheap global checks that rejects images which clearly
+look nothing like any template, before the expensive ORB matching runs on
+them.
+
+Every stage computes a small signature of each template once, and of each
+image as it comes in, and scores how far apart the two are. An image moves on
+to the next stage only with the templates it is close enough to, and is
+rejected as soon as no template is left. Because the checks look at the whole
+image, a template that only makes up a small part of an image can be lost, so
+calibrate should be run on known matches before turning a stage on.
+"""
+from abc import ABC, abstractmethod
+from threading import Lock
+import cv2
+import numpy as np
+import sys
+
+
+def _gray(img):
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def _pack_bits(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(img):
+    """Returns the 64 bit difference hash of an image, as an int. Each bit is
+    whether a pixel of the 9x8 thumbnail is brighter than the one to its left.
+    """
+    small = cv2.resize(_gray(img), (9, 8), interpolation=cv2.INTER_AREA)
+    return _pack_bits(small[:, 1:] > small[:, :-1])
+
+
+def phash(img):
+    """Returns the 64 bit perceptual hash of an image, as an int. Each bit is
+    whether one of the lowest 8x8 DCT frequencies of the 32x32 thumbnail is
+    above their median.
+    """
+    small = cv2.resize(_gray(img), (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(np.float32(small))[:8, :8]
+    # The first coefficient is the average brightness, which would skew the median
+    return _pack_bits(low > np.median(low.ravel()[1:]))
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PrefilterStage(ABC):
+    """The base class of the checks in a Prefilter. A lower score means the
+    image and template are more alike, and a score above max_distance rejects
+    the pair.
+    """
+
+    name = None
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+
+    @abstractmethod
+    def signature(self, img):
+        """Returns what the stage needs to know about an image. Must be
+        picklable, so templates can be sent to other processes.
+        """
+
+    @abstractmethod
+    def score(self, signature, template_signature):
+        """Returns how far apart an image and a template are, from their
+        signatures.
+        """
+
+
+class AspectStage(PrefilterStage):
+    """Rejects images whose shape is too far from the template's. The score
+    is how many times wider or taller the image is, relative to its height or
+    width, than the template.
+    """
+
+    name = "aspect"
+
+    def signature(self, img):
+        h, w = img.shape[:2]
+        return w / max(h, 1)
+
+    def score(self, signature, template_signature):
+        ratio = signature / max(template_signature, 1e-6)
+        return max(ratio, 1 / max(ratio, 1e-6))
+
+
+class HistogramStage(PrefilterStage):
+    """Rejects images whose colors are too different from the template's. The
+    score is one minus the intersection of their hue/saturation histograms,
+    so 0 is the same colors and 1 is no colors in common.
+    """
+
+    name = "histogram"
+
+    THUMBNAIL_SIZE = 64
+    BINS = [16, 8]  # Hue, saturation
+
+    def signature(self, img):
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        small = cv2.resize(img, (self.THUMBNAIL_SIZE, self.THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        hist = cv2.calcHist([hsv], [0, 1], None, self.BINS, [0, 180, 0, 256])
+        return hist / max(hist.sum(), 1)
+
+    def score(self, signature, template_signature):
+        return 1 - float(np.minimum(signature, template_signature).sum())
+
+
+class DHashStage(PrefilterStage):
+    """Rejects images whose difference hash is too many bits away from the
+    template's.
+    """
+
+    name = "dhash"
+
+    def signature(self, img):
+        return dhash(img)
+
+    def score(self, signature, template_signature):
+        return hamming_distance(signature, template_signature)
+
+
+class PHashStage(PrefilterStage):
+    """Rejects images whose perceptual hash is too many bits away from the
+    template's.
+    """
+
+    name = "phash"
+
+    def signature(self, img):
+        return phash(img)
+
+    def score(self, signature, template_signature):
+        return hamming_distance(signature, template_signature)
+
+
+# Stage name -> class, in the order stages are cheapest to run
+STAGES = {AspectStage.name: AspectStage,
+          HistogramStage.name: HistogramStage,
+          DHashStage.name: DHashStage,
+          PHashStage.name: PHashStage}
+
+
+def build_prefilter(stage_names, max_aspect_change, max_histogram_distance, max_hash_distance):
+    """Creates a Prefilter with the named stages, in the given order. Unknown
+    names are skipped with a warning.
+
+    :param stage_names: A list of names from STAGES
+    :param max_aspect_change: The max_distance of the aspect stage
+    :param max_histogram_distance: The max_distance of the histogram stage
+    :param max_hash_distance: The max_distance of the dhash and phash stages
+    :return: The Prefilter, or None if there are no stages
+    """
+    max_distances = {AspectStage.name: max_aspect_change,
+                     HistogramStage.name: max_histogram_distance,
+                     DHashStage.name: max_hash_distance,
+                     PHashStage.name: max_hash_distance}
+    stages = []
+    for name in stage_names:
+        if name not in STAGES:
+            print("Warning: skipping unknown prefilter stage " + str(name), file=sys.stderr)
+            continue
+        stages.append(STAGES[name](max_distances[name]))
+    return Prefilter(stages) if stages else None
+
+
+class Prefilter:
+    """Runs images through a cascade of PrefilterStages, and counts how many
+    each stage rejected. Thread-safe.
+    """
+
+    def __init__(self, stages):
+        """
+        :param stages: The PrefilterStages to run, cheapest first
+        """
+        self.stages = list(stages)
+
+        self.__template_signatures = []  # A list with the signature of each stage, for every template
+        self.__tested_cnts = {stage.name: 0 for stage in self.stages}
+        self.__rejected_cnts = {stage.name: 0 for stage in self.stages}
+        self.__lock = Lock()
+
+    def add_template(self, img):
+        """Computes the signatures of a template image. Templates must be added
+        in the same order as they are to the tracker.
+
+        :return: The signatures, as accepted by add_template_signatures
+        """
+        signatures = [stage.signature(img) for stage in self.stages]
+        self.add_template_signatures(signatures)
+        return signatures
+
+    def add_template_signatures(self, signatures):
+        """Adds a template from signatures made by a Prefilter with the same
+        stages.
+        """
+        with self.__lock:
+            self.__template_signatures.append(signatures)
+
+    def remove_template(self, index):
+        """Forgets the signatures of the template at the index."""
+        with self.__lock:
+            del self.__template_signatures[index]
+
+    def get_template_signatures(self):
+        with self.__lock:
+            return list(self.__template_signatures)
+
+    def check(self, img):
+        """Runs an image through the stages.
+
+        :return: The name of the stage that rejected the image, or None if it
+            passed every stage with at least one template
+        """
+        templates = self.get_template_signatures()
+        if not templates:
+            return None
+
+        for i, stage in enumerate(self.stages):
+            signature = stage.signature(img)
+            templates = [t for t in templates if stage.score(signature, t[i]) <= stage.max_distance]
+
+            with self.__lock:
+                self.__tested_cnts[stage.name] += 1
+                if not templates:
+                    self.__rejected_cnts[stage.name] += 1
+            if not templates:
+                return stage.name
+        return None
+
+    def get_stats(self):
+        """Returns how many images reached each stage and how many it rejected.
+
+        :return: A dict of stage name to a dict with "tested", "rejected" and
+            "rejection_rate"
+        """
+        with self.__lock:
+            return {stage.name: {"tested": self.__tested_cnts[stage.name],
+                                 "rejected": self.__rejected_cnts[stage.name],
+                                 "rejection_rate": self.__rejected_cnts[stage.name] /
+                                                   max(self.__tested_cnts[stage.name], 1)}
+                    for stage in self.stages}
+
+    def calibrate(self, imgs):
+        """Measures how many true matches the prefilter would lose. Every stage
+        is measured on its own, and the cascade as a whole. The stats are not
+        changed.
+
+        :param imgs: An iterable of images that are all known to match one of
+            the templates
+        :return: A dict of stage name to a dict with "lost", "loss_rate",
+            "max_distance" and "lossless_max_distance", the smallest
+            max_distance that would have kept every image. Under the key
+            "cascade", how many images the whole cascade would lose.
+        """
+        templates = self.get_template_signatures()
+        closest = {stage.name: [] for stage in self.stages}  # The best score of every image, for each stage
+        cascade_lost = 0
+        img_cnt = 0
+
+        for img in imgs:
+            img_cnt += 1
+            passing = list(range(len(templates)))
+            for i, stage in enumerate(self.stages):
+                signature = stage.signature(img)
+                scores = [stage.score(signature, t[i]) for t in templates]
+                closest[stage.name].append(min(scores, default=0))
+                passing = [t for t in passing if scores[t] <= stage.max_distance]
+            if templates and not passing:
+                cascade_lost += 1
+
+        report = {}
+        for stage in self.stages:
+            scores = closest[stage.name]
+            lost = sum(1 for score in scores if score > stage.max_distance)
+            report[stage.name] = {"lost": lost,
+                                  "loss_rate": lost / max(img_cnt, 1),
+                                  "max_distance": stage.max_distance,
+                                  "lossless_max_distance": max(scores, default=0)}
+        report["cascade"] = {"lost": cascade_lost, "loss_rate": cascade_lost / max(img_cnt, 1)}
+        return report
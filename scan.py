@@ -0,0 +1,412 @@
+"""Runs a scan from the command line, without the GUI. Every image the crawler
+finds is matched against the templates as soon as it is downloaded, and each
+match is written out as one line of JSON.
+
+Exit codes, like grep:
+    0   - the scan finished and found at least one match
+    1   - the scan finished without finding a match
+    2   - the scan could not be started, or the crawler stopped with an error
+    130 - the scan was interrupted
+"""
+from config import Config
+from checkpoint import CrawlCheckpoint
+from factories import create_crawler, read_images, create_match_memo, new_comparer, create_comparer
+from metrics import MetricsServer
+from match_engine import MatchEngine, submit_downloads
+from prefilter import STAGES as PREFILTER_STAGES
+from matchers import benchmark_matchers, candidate_matchers, pick_matcher
+from vocabulary import benchmark_shortlist
+from collections import deque
+import argparse
+import concurrent.futures
+import datetime
+import json
+import sqlite3
+import sys
+import time
+
+
+EXIT_MATCH = 0
+EXIT_NO_MATCH = 1
+EXIT_ERROR = 2
+EXIT_INTERRUPTED = 130
+
+# How long to wait for the next image when none is ready
+POLL_INTERVAL = 0.01
+
+# The shortlist sizes --benchmark-shortlist measures
+BENCHMARK_SHORTLIST_SIZES = (1, 2, 5, 10, 20)
+
+
+def read_websites(path):
+    """Reads one website per line, skipping blank lines."""
+    with open(path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def is_resumable(checkpoint_file, website_list):
+    """Returns true if the checkpoint file holds an unfinished scan of the websites."""
+    if not checkpoint_file:
+        return False
+    checkpoint = CrawlCheckpoint(checkpoint_file, website_list)
+    try:
+        return checkpoint.is_resumable()
+    finally:
+        checkpoint.close()
+
+
+def add_website_arguments(parser):
+    """Adds the flags that pick the websites to crawl."""
+    parser.add_argument("-w", "--websites", default=Config.WEBSITES_FILE,
+                        help="a file with one website to crawl per line (default: %(default)s)")
+    parser.add_argument("-u", "--url", action="append", dest="urls",
+                        help="a website to crawl, instead of the websites file. May be repeated.")
+
+
+def add_matching_arguments(parser):
+    """Adds the flags that override the crawl and match settings from
+    Settings.json.
+    """
+    parser.add_argument("templates", help="a directory of template images to look for")
+    parser.add_argument("--all", action="store_true", help="write a line for images that didn't match too")
+    parser.add_argument("--depth", type=int, help="the maximum amount of pages deep to crawl")
+    parser.add_argument("--browsers", type=int, help="the maximum amount of open browsers")
+    parser.add_argument("--timeout", type=int, help="the amount of seconds to wait for a page")
+    parser.add_argument("--min-match", type=int, help="the least percent of features that must match")
+    parser.add_argument("--match-workers", type=int, help="how many processes match images, 0 for one per core")
+    parser.add_argument("--prefilter", type=lambda text: [name for name in text.split(",") if name],
+                        help="comma separated prefilter stages to run before matching, out of " +
+                             ", ".join(PREFILTER_STAGES) + ". An empty string turns the prefilter off.")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics on this local port")
+    parser.add_argument("--retrain-vocabulary", action="store_true",
+                        help="train the visual vocabulary of the template shortlist again, and store it")
+
+
+def crawler_overrides(args):
+    """Returns the Crawler arguments given as flags."""
+    overrides = {}
+    if args.depth is not None:
+        overrides["max_depth"] = args.depth
+    if args.browsers is not None:
+        overrides["max_browser_instances"] = args.browsers
+    if args.timeout is not None:
+        overrides["load_timeout"] = args.timeout
+    return overrides
+
+
+def get_websites(args):
+    """Returns the websites given with the flags of add_website_arguments.
+    Raises OSError if the websites file can't be read.
+    """
+    if args.urls:
+        return args.urls
+    return read_websites(args.websites)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Crawls websites for images that match a set of templates, "
+                                                 "and writes each match as a line of JSON.")
+    add_matching_arguments(parser)
+    add_website_arguments(parser)
+    parser.add_argument("-o", "--output", help="the file to append matches to (default: stdout)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an unfinished scan of the same websites")
+    parser.add_argument("--calibrate-prefilter", metavar="DIR",
+                        help="instead of scanning, print how many of the images in DIR, which should all match a "
+                             "template, each prefilter stage would reject")
+    parser.add_argument("--tune-matcher", metavar="DIR",
+                        help="instead of scanning, benchmark the descriptor matchers on the images in DIR against "
+                             "the templates, and save the fastest accurate one to the settings")
+    parser.add_argument("--min-recall", type=float, default=0.95,
+                        help="the least share of the exact matches a tuned matcher must find (default: %(default)s)")
+    parser.add_argument("--benchmark-shortlist", metavar="DIR",
+                        help="instead of scanning, print how often the template shortlist keeps the template each "
+                             "image in DIR shows, and how much faster it matches, for growing numbers of templates")
+    return parser.parse_args(argv)
+
+
+def start_metrics_server(crawler, config, args):
+    """Serves the crawler's metrics if a port was given as a flag or in the
+    config. Raises OSError if the port can't be used.
+
+    :return: The started MetricsServer, or None
+    """
+    port = args.metrics_port if args.metrics_port is not None else config.metrics_port
+    if not port:
+        return None
+    server = MetricsServer(crawler.metrics, port)
+    server.start()
+    return server
+
+
+def write_record(output, record):
+    """Writes a match record as a line of JSON."""
+    output.write(json.dumps(record) + "\n")
+    output.flush()
+
+
+def get_fast_match_ratio(args, min_match_percent):
+    """Returns the match ratio images only need to be checked against, or
+    None if every image needs its full score because --all was given.
+    """
+    return None if args.all else min_match_percent / 100.0
+
+
+def create_match_engine(comparer, crawler, config, args, min_match_ratio=None):
+    """Starts the processes that match the crawler's images.
+
+    :param min_match_ratio: If given, images are only checked for a match at
+        this ratio instead of being scored fully
+    """
+    worker_cnt = args.match_workers if args.match_workers is not None else config.match_workers
+    return MatchEngine(comparer, worker_cnt, metrics=crawler.metrics, min_match_ratio=min_match_ratio)
+
+
+def calibrate_prefilter(config, args):
+    """Prints how many of the known matches in args.calibrate_prefilter each
+    prefilter stage would lose, as JSON. Every stage is measured unless some
+    are given in the flags or settings.
+    """
+    stage_names = args.prefilter if args.prefilter is not None else config.prefilter_stages
+    comparer = create_comparer(config, args.templates, stage_names or list(PREFILTER_STAGES))
+    if comparer is None:
+        return EXIT_ERROR
+
+    try:
+        report = comparer.prefilter.calibrate(read_images(args.calibrate_prefilter))
+    except OSError as e:
+        print("Error: could not read known matches: ", e, file=sys.stderr)
+        return EXIT_ERROR
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+def tune_matcher(config, args):
+    """Benchmarks the descriptor matchers on the images in args.tune_matcher
+    against the current templates, prints the results as JSON, and saves the
+    fastest one that is accurate enough to the settings. If none is, the
+    settings are left alone and EXIT_ERROR is returned.
+    """
+    comparer = create_comparer(config, args.templates, [])
+    if comparer is None:
+        return EXIT_ERROR
+
+    try:
+        frame_descrs = [comparer.tracker.detect_frame(img)[1] for img in read_images(args.tune_matcher)]
+    except OSError as e:
+        print("Error: could not read images: ", e, file=sys.stderr)
+        return EXIT_ERROR
+    if not frame_descrs:
+        print("Error: there are no images in " + args.tune_matcher, file=sys.stderr)
+        return EXIT_ERROR
+
+    report = benchmark_matchers(comparer.tracker, frame_descrs, candidate_matchers())
+    best = pick_matcher(report, args.min_recall)
+    print(json.dumps({"templates": len(comparer.get_template()), "images": len(frame_descrs),
+                      "best": best, "matchers": report}, indent=2))
+
+    if best["recall"] < args.min_recall or best["precision"] < args.min_recall:
+        print("Error: no matcher reached a recall and precision of " + str(args.min_recall) +
+              ", so the settings were not changed", file=sys.stderr)
+        return EXIT_ERROR
+    config.matcher = best["matcher"]
+    print("Saved the " + best["matcher"]["name"] + " matcher to the settings", file=sys.stderr)
+    return 0
+
+
+def benchmark_template_shortlist(config, args):
+    """Prints, as JSON, the recall@K of the template shortlist on the known
+    matches in args.benchmark_shortlist, and its speedup, for the first 8, 16,
+    32 and so on templates, up to all of them.
+    """
+    comparer = create_comparer(config, args.templates, [])
+    if comparer is None:
+        return EXIT_ERROR
+    if comparer.template_index is None:
+        comparer.train_vocabulary()
+    if comparer.template_index is None:
+        print("Error: the templates have no features to index", file=sys.stderr)
+        return EXIT_ERROR
+
+    try:
+        imgs = list(read_images(args.benchmark_shortlist))
+    except OSError as e:
+        print("Error: could not read known matches: ", e, file=sys.stderr)
+        return EXIT_ERROR
+    if not imgs:
+        print("Error: there are no images in " + args.benchmark_shortlist, file=sys.stderr)
+        return EXIT_ERROR
+
+    features = comparer.get_template_features()
+    template_cnts = [cnt for cnt in (2 ** i for i in range(3, 32)) if cnt < len(features)] + [len(features)]
+    reports = []
+    for template_cnt in template_cnts:
+        subset = new_comparer(config, [])
+        subset.add_template_features(features[:template_cnt])
+        subset.set_vocabulary(comparer.template_index.vocabulary, comparer.get_index_documents())
+        reports.append(benchmark_shortlist(subset.tracker, imgs, BENCHMARK_SHORTLIST_SIZES))
+    print(json.dumps(reports, indent=2))
+    return 0
+
+
+def print_prefilter_stats(engine):
+    stats = engine.get_prefilter_stats()
+    if not stats:
+        return
+    print("Prefilter rejected " + ", ".join(name + " " + str(round(stage["rejection_rate"] * 100, 1)) + "% of " +
+                                            str(stage["tested"]) for name, stage in stats.items()), file=sys.stderr)
+
+
+def run_scan(crawler, engine, min_match_ratio, report, write_all=False, memo=None):
+    """Matches the crawler's images against the templates until the crawl is
+    done, reporting a record for every match. Images are matched in parallel
+    by the engine, and reported in the order they were downloaded.
+
+    :param crawler: A started Crawler
+    :param engine: A MatchEngine with the templates
+    :param min_match_ratio: The least match ratio that counts as a match
+    :param report: Called with the record dict of every match
+    :param write_all: If true, images that didn't match are reported too
+    :param memo: The crawler's MatchMemo, if it has one, to remember the
+        matches of new images in
+    :return: A tuple with how many images were tested and how many matched.
+        If the crawler stopped without finishing, the images it downloaded are
+        still matched, and crawler.is_finished() is False afterwards.
+    """
+    matched = crawler.metrics.counter("images_matched_total", "Images matched against the templates",
+                                      labels=("result",))
+    tested_cnt, match_cnt = 0, 0
+    pending = deque()  # (future, Download) of images being matched
+
+    while True:
+        # Once the crawler is finished every image is already downloaded, so
+        # an empty queue means the scan is done. A crawler that died with an
+        # error never finishes, so it counts as done once its thread is gone.
+        finished = crawler.is_finished() or not crawler.is_alive()
+        downloads = []
+        while len(pending) + len(downloads) < engine.max_pending:
+            download = crawler.get_next_download()
+            if download is None:
+                break
+            downloads.append(download)
+        pending.extend(submit_downloads(engine, downloads))
+
+        if not pending:
+            if finished:
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        future, download = pending[0]
+        try:
+            result = future.result(timeout=POLL_INTERVAL)
+        except concurrent.futures.TimeoutError:
+            continue
+        except Exception as e:
+            print("Error: could not match image from " + download.image_url + ": ", e, file=sys.stderr)
+            pending.popleft()
+            continue
+        pending.popleft()
+        if memo is not None and download.match is None:
+            memo.store(download.content_hash, result.scores)
+
+        is_match = result.match_ratio >= min_match_ratio
+        matched.inc(result="match" if is_match else "no_match")
+        tested_cnt += 1
+
+        if is_match:
+            match_cnt += 1
+        if is_match or write_all:
+            record = {"time": datetime.datetime.now().isoformat(),
+                      "page_url": download.page_url,
+                      "image_url": download.image_url,
+                      "score": result.match_ratio,
+                      "template": result.template,
+                      "inliers": result.inliers,
+                      "match": is_match,
+                      "match_seconds": result.seconds,
+                      "memoized": download.match is not None}
+            report(record)
+
+    return tested_cnt, match_cnt
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = Config()
+
+    if args.calibrate_prefilter:
+        return calibrate_prefilter(config, args)
+    if args.tune_matcher:
+        return tune_matcher(config, args)
+    if args.benchmark_shortlist:
+        return benchmark_template_shortlist(config, args)
+
+    try:
+        websites = get_websites(args)
+    except OSError as e:
+        print("Error: could not read websites: ", e, file=sys.stderr)
+        return EXIT_ERROR
+    if not websites:
+        print("Error: there are no websites to scan", file=sys.stderr)
+        return EXIT_ERROR
+
+    comparer = create_comparer(config, args.templates, args.prefilter, args.retrain_vocabulary)
+    if comparer is None:
+        return EXIT_ERROR
+
+    if args.resume and not is_resumable(config.checkpoint_file, websites):
+        print("Warning: there is no unfinished scan of these websites to resume, starting over",
+              file=sys.stderr)
+    min_match_percent = args.min_match if args.min_match is not None else config.min_match_percent
+
+    try:
+        memo = create_match_memo(config, comparer, get_fast_match_ratio(args, min_match_percent))
+    except sqlite3.Error as e:
+        print("Error: could not open the match memo: ", e, file=sys.stderr)
+        return EXIT_ERROR
+
+    crawler = create_crawler(config, websites, resume=args.resume, match_memo=memo, **crawler_overrides(args))
+    crawler.daemon = True
+
+    try:
+        metrics_server = start_metrics_server(crawler, config, args)
+    except OSError as e:
+        print("Error: could not serve metrics: ", e, file=sys.stderr)
+        if memo is not None:
+            memo.close()
+        return EXIT_ERROR
+
+    engine = create_match_engine(comparer, crawler, config, args, get_fast_match_ratio(args, min_match_percent))
+    output = open(args.output, "a") if args.output else sys.stdout
+    start = time.time()
+    try:
+        crawler.start()
+        tested_cnt, match_cnt = run_scan(crawler, engine, min_match_percent / 100.0,
+                                         lambda record: write_record(output, record), args.all, memo)
+    except KeyboardInterrupt:
+        print("Scan interrupted, stopping...", file=sys.stderr)
+        crawler.close()
+        return EXIT_INTERRUPTED
+    finally:
+        engine.close()
+        if memo is not None:
+            memo.close()
+        if output is not sys.stdout:
+            output.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+    if not crawler.is_finished():
+        print("Error: the crawler stopped before finishing", file=sys.stderr)
+        return EXIT_ERROR
+    print("Scanned " + str(crawler.scraped_page_cnt) + " pages (" + str(crawler.failed_page_cnt) +
+          " failed, " + str(crawler.partial_page_cnt) + " partial) and tested " + str(tested_cnt) + " images in " +
+          str(round(time.time() - start, 1)) + "s, " + str(match_cnt) + " matched", file=sys.stderr)
+    print_prefilter_stats(engine)
+
+    return EXIT_MATCH if match_cnt else EXIT_NO_MATCH
+
+
+if __name__ == '__main__':
+    sys.exit(main())
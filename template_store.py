@@ -0,0 +1,78 @@
+"""Contains an on-disk store of the features detected in template images, so
+templates don't go through feature detection again every time the app starts.
+"""
+import hashlib
+import json
+import numpy as np
+import os
+import sys
+import tempfile
+
+
+class TemplateFeatureStore:
+    """Keeps the keypoints and descriptors of each template in a compressed
+    .npz file, named after the hash of the template image and of the detector
+    settings. Changing the settings makes every template miss, and stale files
+    are simply never read again.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: The folder to keep the files in. Created if missing.
+        """
+        self.hit_cnt = 0
+        self.miss_cnt = 0
+
+        self.__directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, image_hash, params):
+        """Reads the features of a template.
+
+        :param image_hash: The ID of the template image
+        :param params: A JSON serializable dict of the detector settings
+        :return: A tuple of the keypoints, as tuples in the form
+            PlaneTracker.get_target_features returns them, and the
+            descriptors, or None if they weren't stored
+        """
+        path = self._path(image_hash, params)
+        try:
+            with np.load(path) as data:
+                features = [tuple(kp) for kp in data["keypoints"].tolist()], data["descrs"]
+        except FileNotFoundError:
+            self.miss_cnt += 1
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print("Warning: ignoring unreadable template features in " + path + ": ", e, file=sys.stderr)
+            self.miss_cnt += 1
+            return None
+
+        self.hit_cnt += 1
+        return features
+
+    def save(self, image_hash, params, keypoints, descrs):
+        """Stores the features of a template. Failing to write them only
+        prints a warning.
+
+        :param image_hash: The ID of the template image
+        :param params: A JSON serializable dict of the detector settings
+        :param keypoints: The keypoints, as tuples
+        :param descrs: The descriptors, as a Numpy array
+        """
+        path = self._path(image_hash, params)
+        try:
+            # Written to a temporary file first, so a crash never leaves half a
+            # file behind. Each save gets its own, since processes share the store.
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as file:
+                try:
+                    np.savez_compressed(file, keypoints=np.float64(keypoints).reshape(-1, 7), descrs=np.uint8(descrs))
+                except BaseException:
+                    os.remove(file.name)
+                    raise
+            os.replace(file.name, path)
+        except OSError as e:
+            print("Warning: could not store template features in " + path + ": ", e, file=sys.stderr)
+
+    def _path(self, image_hash, params):
+        params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.__directory, image_hash + "-" + params_hash + ".npz")
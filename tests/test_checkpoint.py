@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from checkpoint import CrawlCheckpoint
+from frontier import FrontierEntry
+from tests.test_frontier import Crawler
+
+if Crawler is not None:
+    from tests.test_frontier import FakeSiteCrawler
+
+SEEDS = ["http://example.com/"]
+
+
+class CrawlCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "crawl.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, seeds=SEEDS):
+        checkpoint = CrawlCheckpoint(self.path, seeds)
+        self.addCleanup(checkpoint.close)
+        return checkpoint
+
+    def test_new_database_is_not_resumable(self):
+        self.assertFalse(self.open().is_resumable())
+
+    def test_started_crawl_is_resumable(self):
+        self.open().start()
+        self.assertTrue(self.open().is_resumable())
+
+    def test_finished_crawl_is_not_resumable(self):
+        checkpoint = self.open()
+        checkpoint.start()
+        checkpoint.finish()
+        self.assertFalse(self.open().is_resumable())
+
+    def test_other_seeds_are_not_resumable(self):
+        self.open().start()
+        self.assertFalse(self.open(["http://other.com/"]).is_resumable())
+
+    def test_save_and_load(self):
+        frontier = [FrontierEntry("http://example.com/b", 1, "http://example.com/", 25.0),
+                    FrontierEntry("http://example.com/a", 1, "http://example.com/", 25.0)]
+        checkpoint = self.open()
+        checkpoint.start()
+        checkpoint.save(frontier, ["http://example.com/", "http://example.com/a"],
+                        ["http://example.com/1.jpg"], [("http://example.com/2.jpg", "http://example.com/")],
+                        {"scraped_page_cnt": 1})
+
+        state = self.open().load()
+        self.assertEqual(state["frontier"], frontier)
+        self.assertEqual(sorted(state["crawled_urls"]), ["http://example.com/", "http://example.com/a"])
+        self.assertEqual(state["found_image_urls"], ["http://example.com/1.jpg"])
+        self.assertEqual(state["pending_images"], [("http://example.com/2.jpg", "http://example.com/")])
+        self.assertEqual(state["counters"], {"scraped_page_cnt": 1})
+
+    def test_save_appends_urls_and_replaces_frontier(self):
+        checkpoint = self.open()
+        checkpoint.start()
+        checkpoint.save([FrontierEntry("http://example.com/a", 1, None, 50.0)],
+                        ["http://example.com/"], [], [("http://example.com/1.jpg", "http://example.com/")],
+                        {"scraped_page_cnt": 1})
+        checkpoint.save([], ["http://example.com/a", "http://example.com/"], ["http://example.com/1.jpg"], [],
+                        {"scraped_page_cnt": 2})
+
+        state = checkpoint.load()
+        self.assertEqual(state["frontier"], [])
+        self.assertEqual(sorted(state["crawled_urls"]), ["http://example.com/", "http://example.com/a"])
+        self.assertEqual(state["found_image_urls"], ["http://example.com/1.jpg"])
+        self.assertEqual(state["pending_images"], [])
+        self.assertEqual(state["counters"], {"scraped_page_cnt": 2})
+
+    def test_start_clears_earlier_crawl(self):
+        checkpoint = self.open()
+        checkpoint.start()
+        checkpoint.save([FrontierEntry("http://example.com/a", 1, None, 50.0)],
+                        ["http://example.com/"], ["http://example.com/1.jpg"], [], {"scraped_page_cnt": 1})
+        checkpoint.start()
+
+        state = checkpoint.load()
+        self.assertEqual(state["frontier"], [])
+        self.assertEqual(state["crawled_urls"], [])
+        self.assertEqual(state["found_image_urls"], [])
+        self.assertEqual(state["counters"], {})
+
+    @unittest.skipIf(Crawler is None, "needs Selenium")
+    def test_crawl_resumes_from_frontier(self):
+        site = {"http://example.com/": ["http://example.com/a", "http://example.com/b"],
+                "http://example.com/a": ["http://example.com/", "http://example.com/b", "http://example.com/c"],
+                "http://example.com/b": []}
+        checkpoint = self.open()
+        checkpoint.start()
+        # The seed was crawled, and the crawl stopped before its links were
+        checkpoint.save([FrontierEntry("http://example.com/a", 1, "http://example.com/", 50.0),
+                         FrontierEntry("http://example.com/b", 1, "http://example.com/", 50.0)],
+                        ["http://example.com/", "http://example.com/a", "http://example.com/b"], [], [],
+                        {"scraped_page_cnt": 1})
+
+        crawler = FakeSiteCrawler(site, SEEDS, 5, 1, 5, obey_robots=False, host_min_delay=0,
+                                  checkpoint_file=self.path, resume=True)
+        crawler.run()
+        self.assertEqual(crawler.fetched, ["http://example.com/a", "http://example.com/b", "http://example.com/c"])
+        self.assertEqual(crawler.scraped_page_cnt, 4)
+        self.assertFalse(self.open().is_resumable())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+
+    from compare_image import CompareImage
+except ImportError:
+    cv2 = None
+
+from tests.test_match_memo import textured_image
+
+
+@unittest.skipIf(cv2 is None, "needs OpenCV and Numpy")
+class SmallFrameTest(unittest.TestCase):
+
+    def setUp(self):
+        # The small template is pasted into a frame that is smaller than the large one
+        self.large_template = textured_image(0, 400, 320)
+        self.small_template = textured_image(1, 160, 120)
+        self.frame = np.full((160, 200, 3), 127, np.uint8)
+        self.frame[20:140, 20:180] = self.small_template
+
+    def match(self, **kwargs):
+        comparer = CompareImage(features_detect=500, frame_scale_factor=0, **kwargs)
+        comparer.add_template(self.large_template)
+        comparer.add_template(self.small_template)
+        return comparer, comparer.match_batch([self.frame])[0]
+
+    def test_finds_template_with_full_budget(self):
+        comparer, match = self.match()
+        self.assertEqual(match.template, 1)
+        self.assertEqual(comparer.tracker._detect_scaled(self.frame)[2], 500)
+
+    def test_ratio_is_out_of_template_keypoints_by_default(self):
+        comparer, match = self.match()
+        target = comparer.tracker.targets[1]
+        self.assertEqual(comparer.tracker._match_ratio(target, 100, 50), 50 / len(target.keypoints))
+
+    def test_scaled_budget_is_opt_in(self):
+        comparer, match = self.match(scale_feature_budget=True)
+        self.assertEqual(match.template, 1)
+        self.assertLess(comparer.tracker._detect_scaled(self.frame)[2], 500)
+        self.assertEqual(comparer.tracker._match_ratio(comparer.tracker.targets[1], 100, 50), 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
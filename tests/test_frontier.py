@@ -0,0 +1,140 @@
+import threading
+import unittest
+
+from frontier import Frontier, FrontierEntry
+
+try:
+    from crawler import Crawler
+    from page_fetcher import Page
+except ImportError:
+    Crawler = None
+
+
+def entry(url, depth=0):
+    return FrontierEntry(url=url, depth=depth, parent=None, progress_step=0)
+
+
+class FrontierTest(unittest.TestCase):
+
+    def test_first_in_first_out(self):
+        frontier = Frontier()
+        frontier.put(entry("a"))
+        frontier.put_many([entry("b"), entry("c")])
+        frontier.put(entry("d"))
+
+        urls = []
+        while True:
+            next_entry = frontier.get()
+            if next_entry is None:
+                break
+            urls.append(next_entry.url)
+            frontier.task_done(next_entry)
+        self.assertEqual(urls, ["a", "b", "c", "d"])
+
+    def test_get_returns_none_when_finished(self):
+        self.assertIsNone(Frontier().get())
+
+    def test_get_waits_for_pages_in_progress(self):
+        frontier = Frontier()
+        frontier.put(entry("a"))
+        first = frontier.get()
+
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(frontier.get()))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+
+        # The page being crawled links to another one
+        frontier.put(entry("b", depth=1))
+        frontier.task_done(first)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(taken[0].url, "b")
+
+    def test_get_stops_waiting_once_nothing_is_in_progress(self):
+        frontier = Frontier()
+        frontier.put(entry("a"))
+        first = frontier.get()
+
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(frontier.get()))
+        waiter.start()
+        frontier.task_done(first)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(taken, [None])
+
+    def test_close_wakes_waiting_threads(self):
+        frontier = Frontier()
+        frontier.put_many([entry("a"), entry("b")])
+        frontier.get()
+
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(frontier.get()))
+        frontier.get()
+        waiter.start()
+        frontier.close()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(taken, [None])
+
+    def test_snapshot_includes_pages_in_progress(self):
+        frontier = Frontier()
+        frontier.put_many([entry("a"), entry("b"), entry("c")])
+        frontier.get()
+        self.assertEqual([e.url for e in frontier.snapshot()], ["a", "b", "c"])
+        self.assertEqual(len(frontier), 2)
+
+
+if Crawler is not None:
+    class FakeSiteCrawler(Crawler):
+        """A crawler that reads pages from a dict of URL to linked URLs."""
+
+        def __init__(self, site, *args, **kwargs):
+            super(FakeSiteCrawler, self).__init__(*args, **kwargs)
+            self.site = site
+            self.fetched = []
+
+        def _fetch_page(self, url, deadline):
+            self.fetched.append(url)
+            return Page(url, [], self.site.get(url, []))
+
+
+@unittest.skipIf(Crawler is None, "needs Selenium")
+class CrawlOrderTest(unittest.TestCase):
+
+    SITE = {
+        "http://example.com/": ["http://example.com/a", "http://example.com/b"],
+        "http://example.com/a": ["http://example.com/a1", "http://example.com/b", "http://other.com/x"],
+        "http://example.com/b": ["http://example.com/b1"],
+        "http://example.com/a1": ["http://example.com/a2"],
+        "http://example.com/b1": ["http://example.com/b2"],
+    }
+
+    def crawl(self, max_depth):
+        crawler = FakeSiteCrawler(self.SITE, ["http://example.com/"], max_depth, 1, 5,
+                                  obey_robots=False, host_min_delay=0)
+        crawler.run()
+        return crawler
+
+    def test_breadth_first_order(self):
+        crawler = self.crawl(5)
+        self.assertEqual(crawler.fetched, ["http://example.com/",
+                                           "http://example.com/a", "http://example.com/b",
+                                           "http://example.com/a1", "http://example.com/b1",
+                                           "http://example.com/a2", "http://example.com/b2"])
+        self.assertTrue(crawler.is_finished())
+
+    def test_depth_cap(self):
+        crawler = self.crawl(1)
+        self.assertEqual(crawler.fetched, ["http://example.com/",
+                                           "http://example.com/a", "http://example.com/b"])
+
+    def test_depth_zero_only_crawls_seeds(self):
+        crawler = self.crawl(0)
+        self.assertEqual(crawler.fetched, ["http://example.com/"])
+
+
+if __name__ == '__main__':
+    unittest.main()
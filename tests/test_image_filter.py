@@ -0,0 +1,93 @@
+import struct
+import unittest
+
+from image_filter import ImageSize, _read_jpeg_size, read_image_size
+
+
+def jpeg_header(width, height, sof_marker=0xc0):
+    """Returns the start of a JPEG file with an APP0 and a DHT segment before its start of frame."""
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + bytes(9)
+    dht = b"\xff\xc4" + struct.pack(">H", 5) + bytes(3)
+    sof = bytes([0xff, sof_marker]) + struct.pack(">HBHHB", 17, 8, height, width, 3) + bytes(9)
+    return b"\xff\xd8" + app0 + dht + sof
+
+
+def webp_header(chunk, payload):
+    return b"RIFF" + struct.pack("<I", 1000) + b"WEBP" + chunk + struct.pack("<I", len(payload)) + payload
+
+
+class ReadJpegSizeTest(unittest.TestCase):
+
+    def test_reads_baseline_size(self):
+        self.assertEqual(read_image_size(jpeg_header(640, 480)), ImageSize("jpeg", 640, 480))
+
+    def test_reads_progressive_size(self):
+        self.assertEqual(read_image_size(jpeg_header(800, 600, 0xc2)), ImageSize("jpeg", 800, 600))
+
+    def test_skips_huffman_tables(self):
+        # DHT is in the range of the start of frame markers, but holds no size
+        self.assertEqual(_read_jpeg_size(jpeg_header(32, 16)), ImageSize("jpeg", 32, 16))
+
+    def test_skips_padding_and_restart_markers(self):
+        data = jpeg_header(10, 20)
+        data = data[:2] + b"\xff\xff\xff\xd0" + data[2:]
+        self.assertEqual(read_image_size(data), ImageSize("jpeg", 10, 20))
+
+    def test_truncated_before_start_of_frame(self):
+        data = jpeg_header(640, 480)
+        self.assertIsNone(read_image_size(data[:24]))
+
+    def test_truncated_inside_segment_length(self):
+        self.assertIsNone(read_image_size(b"\xff\xd8\xff\xe0\x00"))
+
+    def test_truncated_inside_start_of_frame(self):
+        data = jpeg_header(640, 480)
+        sof = data.index(b"\xff\xc0")
+        self.assertIsNone(read_image_size(data[:sof + 7]))
+
+    def test_not_a_marker(self):
+        self.assertIsNone(_read_jpeg_size(b"\xff\xd8\x00\x00\x00\x00"))
+
+
+class ReadImageSizeTest(unittest.TestCase):
+
+    def test_png(self):
+        data = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 300, 200)
+        self.assertEqual(read_image_size(data), ImageSize("png", 300, 200))
+
+    def test_gif87a(self):
+        self.assertEqual(read_image_size(b"GIF87a" + struct.pack("<HH", 16, 9)), ImageSize("gif", 16, 9))
+
+    def test_gif89a(self):
+        self.assertEqual(read_image_size(b"GIF89a" + struct.pack("<HH", 500, 70)), ImageSize("gif", 500, 70))
+
+    def test_truncated_gif(self):
+        self.assertIsNone(read_image_size(b"GIF89a\x10"))
+
+    def test_webp_vp8x(self):
+        # Flags, three reserved bytes, then the canvas size minus one in 24 bits each
+        payload = bytes(4) + (1919).to_bytes(3, "little") + (1079).to_bytes(3, "little")
+        self.assertEqual(read_image_size(webp_header(b"VP8X", payload)), ImageSize("webp", 1920, 1080))
+
+    def test_webp_vp8x_larger_than_16_bits(self):
+        payload = bytes(4) + (70000 - 1).to_bytes(3, "little") + (2).to_bytes(3, "little")
+        self.assertEqual(read_image_size(webp_header(b"VP8X", payload)), ImageSize("webp", 70000, 3))
+
+    def test_truncated_webp_vp8x(self):
+        payload = bytes(4) + (1919).to_bytes(3, "little") + (1079).to_bytes(3, "little")
+        self.assertIsNone(read_image_size(webp_header(b"VP8X", payload)[:28]))
+
+    def test_webp_vp8(self):
+        payload = b"\x00\x00\x00\x9d\x01\x2a" + struct.pack("<HH", 640, 480)
+        self.assertEqual(read_image_size(webp_header(b"VP8 ", payload)), ImageSize("webp", 640, 480))
+
+    def test_bmp_top_down(self):
+        data = b"BM" + bytes(16) + struct.pack("<ii", 64, -32)
+        self.assertEqual(read_image_size(data), ImageSize("bmp", 64, 32))
+
+    def test_unknown_format(self):
+        self.assertIsNone(read_image_size(b"<html><body></body></html>"))
+
+
+if __name__ == "__main__":
+    unittest.main()
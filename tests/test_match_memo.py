@@ -0,0 +1,94 @@
+import hashlib
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+
+    from compare_image import CompareImage
+    from match_memo import MatchMemo
+except ImportError:
+    cv2 = None
+
+
+def textured_image(seed, width=200, height=160):
+    """Returns a random image with enough corners for ORB."""
+    rng = np.random.RandomState(seed)
+    img = cv2.resize(rng.randint(0, 256, (height // 8, width // 8, 3)).astype(np.uint8), (width, height),
+                     interpolation=cv2.INTER_NEAREST)
+    return cv2.GaussianBlur(img, (3, 3), 0)
+
+
+@unittest.skipIf(cv2 is None, "needs OpenCV and Numpy")
+class ShortlistMemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.comparer = CompareImage(features_detect=500, frame_scale_factor=0, shortlist_size=2)
+        for seed in range(6):
+            self.comparer.add_template(textured_image(seed))
+        self.comparer.train_vocabulary(branching=8, depth=2)
+        self.memo = MatchMemo(None, self.comparer.get_settings())
+        self.memo.set_templates(self.comparer.get_template_ids())
+
+    def test_second_lookup_hits(self):
+        frame = np.full((320, 400, 3), 127, np.uint8)
+        frame[80:240, 100:300] = textured_image(3)
+        image_hash = hashlib.sha256(frame.tobytes()).hexdigest()
+
+        self.assertIsNone(self.memo.lookup(image_hash))
+        match = self.comparer.match_batch([frame])[0]
+        self.assertEqual(match.template, 3)
+        self.memo.store(image_hash, match.scores)
+
+        memoized = self.memo.lookup(image_hash)
+        self.assertIsNotNone(memoized)
+        self.assertEqual(memoized.template, 3)
+        self.assertEqual(self.memo.hit_cnt, 1)
+
+
+@unittest.skipIf(cv2 is None, "needs OpenCV and Numpy")
+class FastCheckMemoTest(unittest.TestCase):
+
+    MIN_MATCH_RATIO = 0.05
+
+    def setUp(self):
+        self.comparer = CompareImage(features_detect=500, frame_scale_factor=0)
+        for seed in range(4):
+            self.comparer.add_template(textured_image(seed))
+        self.memo = MatchMemo(None, dict(self.comparer.get_settings(), min_match_ratio=self.MIN_MATCH_RATIO))
+        self.memo.set_templates(self.comparer.get_template_ids())
+
+        self.frame = np.full((320, 400, 3), 127, np.uint8)
+        self.frame[80:240, 100:300] = textured_image(2)
+        self.image_hash = hashlib.sha256(self.frame.tobytes()).hexdigest()
+        self.memo.store(self.image_hash, self.comparer.match_batch([self.frame], self.MIN_MATCH_RATIO)[0].scores)
+
+    def test_lookup_hits_with_the_same_templates(self):
+        match = self.memo.lookup(self.image_hash)
+        self.assertIsNotNone(match)
+        self.assertEqual(match.template, 2)
+
+    def test_new_template_is_the_only_one_matched(self):
+        self.comparer.add_template(textured_image(4))
+        self.memo.set_templates(self.comparer.get_template_ids())
+        self.assertIsNone(self.memo.lookup(self.image_hash))
+
+        shortlists = []
+        match_frame_descriptors = self.comparer.tracker.match_frame_descriptors
+
+        def record_shortlists(frame_descrs, frame_shortlists=None):
+            shortlists.append(frame_shortlists)
+            return match_frame_descriptors(frame_descrs, frame_shortlists)
+
+        self.comparer.tracker.match_frame_descriptors = record_shortlists
+        known_scores = self.memo.known_scores(self.image_hash)
+        match = self.comparer.match_batch([self.frame], self.MIN_MATCH_RATIO, [known_scores])[0]
+        self.assertEqual(shortlists, [[[4]]])
+        self.assertEqual(match.template, 2)
+
+        self.memo.store(self.image_hash, match.scores)
+        self.assertEqual(self.memo.lookup(self.image_hash).template, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+try:
+    from page_fetcher import _LinkParser, _parse_srcset
+except ImportError:
+    _parse_srcset = None
+
+
+@unittest.skipIf(_parse_srcset is None, "needs Selenium")
+class ParseSrcsetTest(unittest.TestCase):
+
+    def test_single_url(self):
+        self.assertEqual(_parse_srcset("a.jpg"), ["a.jpg"])
+
+    def test_width_descriptors(self):
+        self.assertEqual(_parse_srcset("small.jpg 480w, large.jpg 1080w"), ["small.jpg", "large.jpg"])
+
+    def test_density_descriptors_without_spaces_after_commas(self):
+        self.assertEqual(_parse_srcset("a.jpg 1x,b.jpg 2x"), ["a.jpg", "b.jpg"])
+
+    def test_comma_in_url(self):
+        srcset = "https://cdn.example.com/w_400,h_300,c_fill/a.jpg 400w, https://cdn.example.com/w_800,h_600/a.jpg 800w"
+        self.assertEqual(_parse_srcset(srcset), ["https://cdn.example.com/w_400,h_300,c_fill/a.jpg",
+                                                 "https://cdn.example.com/w_800,h_600/a.jpg"])
+
+    def test_comma_ending_url(self):
+        self.assertEqual(_parse_srcset("a.jpg,b.jpg"), ["a.jpg,b.jpg"])
+        self.assertEqual(_parse_srcset("a.jpg, b.jpg"), ["a.jpg", "b.jpg"])
+
+    def test_whitespace_around_candidates(self):
+        self.assertEqual(_parse_srcset("\n  a.jpg 1x ,\t b.jpg 2x  \n"), ["a.jpg", "b.jpg"])
+
+    def test_descriptor_with_parentheses(self):
+        self.assertEqual(_parse_srcset("a.jpg (foo, bar) 1x, b.jpg"), ["a.jpg", "b.jpg"])
+
+    def test_empty(self):
+        self.assertEqual(_parse_srcset(""), [])
+        self.assertEqual(_parse_srcset(" , ,"), [])
+
+
+@unittest.skipIf(_parse_srcset is None, "needs Selenium")
+class LinkParserTest(unittest.TestCase):
+
+    def parse(self, html):
+        parser = _LinkParser("https://example.com/page/")
+        parser.feed(html)
+        parser.close()
+        return parser
+
+    def test_img_src_and_srcset(self):
+        parser = self.parse('<img src="a.jpg" srcset="b.jpg 2x">')
+        self.assertEqual(parser.image_urls, ["https://example.com/page/a.jpg", "https://example.com/page/b.jpg"])
+
+    def test_source_in_picture(self):
+        parser = self.parse('<picture><source srcset="/a.webp"><img src="/a.jpg"></picture>')
+        self.assertEqual(parser.image_urls, ["https://example.com/a.webp", "https://example.com/a.jpg"])
+
+    def test_source_outside_picture_is_ignored(self):
+        parser = self.parse('<video><source src="/v.mp4" srcset="/poster.jpg"></video>'
+                            '<picture></picture><source srcset="/b.jpg">')
+        self.assertEqual(parser.image_urls, [])
+
+    def test_links_resolve_against_base(self):
+        parser = self.parse('<base href="https://cdn.example.com/x/"><a href="next.html">')
+        self.assertEqual(parser.link_urls, ["https://cdn.example.com/x/next.html"])
+
+
+if __name__ == "__main__":
+    unittest.main()
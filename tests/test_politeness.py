@@ -0,0 +1,121 @@
+import io
+import time
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+
+from cancellation import Deadline, DeadlineExceeded
+from politeness import HostScheduler, RobotsCache
+
+ROBOTS_TXT = """
+User-agent: *
+Disallow: /private/
+Crawl-delay: 2
+
+User-agent: SlowBot
+Request-rate: 1/10
+"""
+
+
+def robots_response(text):
+    return mock.patch("urllib.request.urlopen", return_value=io.BytesIO(text.encode("utf-8")))
+
+
+def robots_error(code):
+    return mock.patch("urllib.request.urlopen",
+                      side_effect=HTTPError("http://example.com/robots.txt", code, "", {}, None))
+
+
+class RobotsCacheTest(unittest.TestCase):
+
+    def test_allowed(self):
+        robots = RobotsCache("TestBot", 5)
+        with robots_response(ROBOTS_TXT):
+            self.assertTrue(robots.allowed("http://example.com/page"))
+            self.assertFalse(robots.allowed("http://example.com/private/page"))
+
+    def test_crawl_delay(self):
+        with robots_response(ROBOTS_TXT):
+            self.assertEqual(RobotsCache("TestBot", 5).crawl_delay("http://example.com/"), 2)
+
+    def test_crawl_delay_from_request_rate(self):
+        with robots_response(ROBOTS_TXT):
+            self.assertEqual(RobotsCache("SlowBot", 5).crawl_delay("http://example.com/"), 10)
+
+    def test_no_crawl_delay(self):
+        with robots_response("User-agent: *\nDisallow: /private/\n"):
+            self.assertIsNone(RobotsCache("TestBot", 5).crawl_delay("http://example.com/"))
+
+    def test_forbidden_robots_disallows_all(self):
+        with robots_error(403):
+            self.assertFalse(RobotsCache("TestBot", 5).allowed("http://example.com/page"))
+
+    def test_missing_robots_allows_all(self):
+        with robots_error(404):
+            self.assertTrue(RobotsCache("TestBot", 5).allowed("http://example.com/page"))
+
+    def test_downloaded_once_per_host(self):
+        robots = RobotsCache("TestBot", 5)
+        with robots_response(ROBOTS_TXT) as urlopen:
+            robots.allowed("http://example.com/a")
+            robots.allowed("http://example.com/b")
+            robots.crawl_delay("http://example.com/c")
+        self.assertEqual(urlopen.call_count, 1)
+
+
+class FakeRobots:
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.deadlines = []
+
+    def crawl_delay(self, url, deadline=None):
+        self.deadlines.append(deadline)
+        return self.delay
+
+
+class HostSchedulerTest(unittest.TestCase):
+
+    def time_slots(self, scheduler, cnt):
+        start = time.monotonic()
+        for i in range(cnt):
+            with scheduler.slot("http://example.com/"):
+                pass
+        return time.monotonic() - start
+
+    def test_min_delay_between_requests(self):
+        self.assertGreaterEqual(self.time_slots(HostScheduler(2, 0.1), 3), 0.2)
+
+    def test_crawl_delay_raises_min_delay(self):
+        self.assertGreaterEqual(self.time_slots(HostScheduler(2, 0, robots=FakeRobots(0.1)), 3), 0.2)
+
+    def test_crawl_delay_is_capped(self):
+        scheduler = HostScheduler(2, 0, robots=FakeRobots(100000))
+        with scheduler.slot("http://example.com/"):
+            pass
+        deadline = Deadline(HostScheduler.MAX_CRAWL_DELAY + 1)
+        with mock.patch("time.monotonic", return_value=time.monotonic() + HostScheduler.MAX_CRAWL_DELAY):
+            with scheduler.slot("http://example.com/", deadline):
+                pass
+
+    def test_throttled_host_is_held_back(self):
+        scheduler = HostScheduler(2, 0)
+        scheduler.report_throttled("http://example.com/", "60")
+        self.assertEqual(scheduler.throttled_cnt, 1)
+        with self.assertRaises(DeadlineExceeded):
+            with scheduler.slot("http://example.com/", Deadline(0.1)):
+                pass
+        # Other hosts are not held back
+        with scheduler.slot("http://example.org/", Deadline(0.1)):
+            pass
+
+    def test_throttle_passes_deadline_to_robots(self):
+        robots = FakeRobots(None)
+        scheduler = HostScheduler(2, 0, robots=robots)
+        deadline = Deadline(5)
+        scheduler.report_throttled("http://example.com/", "0", deadline)
+        self.assertEqual(robots.deadlines, [deadline])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""Contains helpers for normalizing URLs and remembering which ones have
+already been seen during a crawl.
+"""
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from threading import Lock
+import hashlib
+import math
+
+
+# Query parameters that only track where a visitor came from. Two URLs that
+# only differ in these point to the same page.
+TRACKING_PARAMS = {"gclid", "fbclid", "msclkid", "dclid", "icid", "cm_sp", "cm_re", "cm_mmc",
+                   "mc_cid", "mc_eid", "_ga", "_gl", "yclid", "igshid"}
+TRACKING_PARAM_PREFIXES = ("utm_",)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonicalize_url(url):
+    """Returns a normalized version of the URL, so that different spellings of
+    the same address compare equal. The fragment and tracking parameters are
+    removed, the scheme and host are lowercased, default ports are dropped and
+    the remaining query parameters are sorted.
+
+    Canonical URLs are only meant for telling whether a URL was seen before.
+    Servers may treat the parameter order or case differently, so pages and
+    images are still fetched from the URL as it was found.
+
+    :param url: An absolute URL
+    :return: The canonical URL, or None if it isn't an http or https URL
+    """
+    if url is None:
+        return None
+
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        # Malformed netloc, like an unclosed IPv6 bracket or a bad port
+        return None
+
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+
+    host = _host(scheme, parts.hostname, port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ":" + parts.password
+        host = userinfo + "@" + host
+
+    query = ""
+    if parts.query:
+        params = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                  if not _is_tracking_param(key)]
+        query = urlencode(sorted(params))
+
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def url_host(url):
+    """Returns the host of a URL, spelled the same as in its canonical URL.
+
+    :param url: An http or https URL that canonicalize_url accepts
+    :return: The lowercase host, including the port if it isn't the default
+    """
+    parts = urlsplit(url.strip())
+    return _host(parts.scheme.lower(), parts.hostname, parts.port)
+
+
+def _host(scheme, hostname, port):
+    host = hostname.rstrip(".")
+    if ":" in host:
+        host = "[" + host + "]"  # IPv6
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        host += ":" + str(port)
+    return host
+
+
+def _is_tracking_param(key):
+    key = key.lower()
+    return key in TRACKING_PARAMS or key.startswith(TRACKING_PARAM_PREFIXES)
+
+
+class UrlSet:
+    """A thread-safe set of URLs with constant time lookups."""
+
+    def __init__(self):
+        self.__urls = set()
+        self.__lock = Lock()
+
+    def add(self, url):
+        """Adds the URL to the set.
+
+        :param url: The URL to add
+        :return: True if the URL was not in the set before
+        """
+        with self.__lock:
+            if url in self.__urls:
+                return False
+            self.__urls.add(url)
+            return True
+
+    def add_many(self, urls, deadline=None):
+        """Adds every URL to the set.
+
+        :param urls: A list of URLs to add
+        :param deadline: Unused, since the set is in memory. Sets kept in
+            another process take the Deadline to stop waiting for it by.
+        :return: A list with True for every URL that was not in the set before
+        """
+        with self.__lock:
+            is_new = []
+            for url in urls:
+                is_new.append(url not in self.__urls)
+                self.__urls.add(url)
+            return is_new
+
+    def __contains__(self, url):
+        with self.__lock:
+            return url in self.__urls
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__urls)
+
+
+class BloomUrlSet:
+    """A thread-safe, fixed-size probabilistic set of URLs for very large
+    crawls. Memory use depends only on the capacity and error rate given, not
+    on how many URLs are added.
+
+    Lookups never miss a URL that was added, but may report a URL that was
+    never added as present with roughly the given error rate, as long as no
+    more than the given capacity of URLs are added. For the crawler, that means
+    a few pages or images are skipped.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: The number of URLs expected to be added
+        :param error_rate: The chance of a false positive at full capacity,
+            from 0 to 1
+        """
+        if capacity <= 0:
+            raise ValueError("Bloom filter capacity must be positive")
+        if not 0 < error_rate < 1:
+            raise ValueError("Bloom filter error rate must be between 0 and 1")
+
+        # The optimal bit and hash counts for the requested error rate
+        self.bit_cnt = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_cnt = max(1, int(round(self.bit_cnt / capacity * math.log(2))))
+
+        self.__bits = bytearray((self.bit_cnt + 7) // 8)
+        self.__cnt = 0
+        self.__lock = Lock()
+
+    def add(self, url):
+        """Adds the URL to the set.
+
+        :param url: The URL to add
+        :return: True if the URL was (probably) not in the set before
+        """
+        positions = self.__positions(url)
+        with self.__lock:
+            is_new = False
+            for pos in positions:
+                byte, bit = pos >> 3, 1 << (pos & 7)
+                if not self.__bits[byte] & bit:
+                    self.__bits[byte] |= bit
+                    is_new = True
+            if is_new:
+                self.__cnt += 1
+            return is_new
+
+    def add_many(self, urls, deadline=None):
+        """Adds every URL to the set.
+
+        :param urls: A list of URLs to add
+        :param deadline: Unused, as for UrlSet.add_many
+        :return: A list with True for every URL that was (probably) not in the
+        set before
+        """
+        return [self.add(url) for url in urls]
+
+    def __contains__(self, url):
+        positions = self.__positions(url)
+        with self.__lock:
+            return all(self.__bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+
+    def __len__(self):
+        """Returns the approximate number of URLs added."""
+        with self.__lock:
+            return self.__cnt
+
+    def __positions(self, url):
+        # Double hashing: derive every bit position from two 64 bit hashes
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bit_cnt for i in range(self.hash_cnt)]
+
+
+def new_url_set(bloom_capacity, bloom_error_rate):
+    """Creates a set for remembering URLs.
+
+    :param bloom_capacity: The capacity of the Bloom filter, or zero for an
+        exact set
+    :param bloom_error_rate: The false positive rate of the Bloom filter
+    :return: A UrlSet or BloomUrlSet
+    """
+    if bloom_capacity > 0:
+        return BloomUrlSet(bloom_capacity, bloom_error_rate)
+    return UrlSet()
@@ -0,0 +1,314 @@
+"""Contains a bag of binary words index of the templates, which shortlists the
+few templates a frame most likely shows, so exact matching and verification
+only run against those instead of against every template.
+
+A vocabulary tree is trained over the ORB descriptors of the templates, and
+every descriptor is quantized to the leaf, or word, it ends up in. Each
+template is then described by how often each word occurs in it, and an
+inverted file lists the templates each word occurs in, weighted by tf-idf.
+A frame is scored against only the templates that share words with it.
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from matchers import hamming_knn, POPCOUNT
+
+
+class BinaryVocabulary:
+    """A tree of binary descriptors with branching children per node, trained
+    with k-majority clustering. Its words are the nodes of the last level, so
+    there are branching ** depth of them, and a descriptor is quantized by
+    comparing it with only branching nodes per level.
+    """
+
+    # At most this many descriptors are sampled to train a vocabulary
+    MAX_TRAINING_DESCRIPTORS = 50000
+
+    def __init__(self, levels):
+        """
+        :param levels: A list with an array of the descriptors of the nodes of
+            every level. The children of node n are nodes n * branching to
+            (n + 1) * branching - 1 of the next level.
+        """
+        self.levels = [np.uint8(level) for level in levels]
+        self.branching = len(self.levels[0])
+
+    @property
+    def size(self):
+        """ How many words there are """
+        return len(self.levels[-1])
+
+    @classmethod
+    def train(cls, descrs, branching=32, depth=2, iterations=5, seed=0):
+        """Trains a vocabulary over descriptors.
+
+        :param descrs: The descriptors of every template, as a Numpy array
+        :param branching: How many children every node has
+        :param depth: How many levels the tree has
+        :param iterations: The most k-majority rounds to run per node
+        :param seed: Seeds the sampling, so a vocabulary can be trained again
+        :return: The BinaryVocabulary
+        """
+        rng = np.random.RandomState(seed)
+        descrs = np.uint8(descrs)
+        if len(descrs) > cls.MAX_TRAINING_DESCRIPTORS:
+            descrs = descrs[rng.choice(len(descrs), cls.MAX_TRAINING_DESCRIPTORS, replace=False)]
+
+        levels = []
+        clusters = [descrs]
+        for _ in range(depth):
+            level, children = [], []
+            for cluster in clusters:
+                centers, assignment = _k_majority(cluster, branching, iterations, rng)
+                level.append(centers)
+                children += [cluster[assignment == i] for i in range(branching)]
+            levels.append(np.concatenate(level))
+            clusters = children
+        return cls(levels)
+
+    def quantize(self, descrs):
+        """Returns the word of every descriptor, as an array of indices."""
+        descrs = np.uint8(descrs)
+        nodes = np.zeros(len(descrs), np.intp)
+        if not len(descrs):
+            return nodes
+
+        offsets = np.arange(self.branching)
+        for level in self.levels:
+            children = nodes[:, None] * self.branching + offsets
+            distances = POPCOUNT[level[children] ^ descrs[:, None, :]].sum(axis=2, dtype=np.uint16)
+            nodes = children[np.arange(len(descrs)), distances.argmin(axis=1)]
+        return nodes
+
+    def get_id(self):
+        """ Returns a hash of the nodes, which tells vocabularies apart """
+        digest = hashlib.sha1()
+        for level in self.levels:
+            digest.update(level.tobytes())
+        return digest.hexdigest()
+
+
+def _k_majority(descrs, k, iterations, rng):
+    # Clusters binary descriptors like k-means, except that a center is the majority vote of every bit of its
+    # descriptors. Returns k centers, repeating descriptors if there are too few, and the cluster of every
+    # descriptor.
+    if len(descrs) == 0:
+        return np.zeros((k, 32), np.uint8), np.zeros(0, np.intp)
+    centers = descrs[rng.choice(len(descrs), k, replace=len(descrs) < k)].copy()
+
+    bits = np.unpackbits(descrs, axis=1)
+    assignment = None
+    for _ in range(iterations):
+        new_assignment = hamming_knn(descrs, centers, 1)[1][:, 0]
+        if assignment is not None and np.array_equal(new_assignment, assignment):
+            break
+        assignment = new_assignment
+
+        counts = np.bincount(assignment, minlength=k)
+        used = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[used]
+        votes = np.add.reduceat(bits[np.argsort(assignment, kind="stable")].astype(np.uint16), starts, axis=0)
+        centers[used] = np.packbits(votes > counts[used, None] / 2, axis=1)
+    else:
+        assignment = hamming_knn(descrs, centers, 1)[1][:, 0]
+    return centers, assignment
+
+
+class TemplateIndex:
+    """An inverted file of the words in every template, which shortlists the
+    templates most like a frame. Templates must be added in the same order as
+    they are to the tracker, so the indices of the shortlist are those of the
+    tracker's targets.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+        self.__documents = []  # The (words, counts) of every template, as arrays
+        self.__inverted = None  # Built when first queried after a change
+        self.__idf = None
+
+    def add_template(self, descrs):
+        """Adds a template by its descriptors.
+
+        :return: Its document, as accepted by add_document
+        """
+        words, counts = np.unique(self.vocabulary.quantize(descrs), return_counts=True)
+        document = (words, counts)
+        self.add_document(document)
+        return document
+
+    def add_document(self, document):
+        """ Adds a template from a document made with the same vocabulary """
+        self.__documents.append(document)
+        self.__inverted = None
+
+    def remove_template(self, index):
+        del self.__documents[index]
+        self.__inverted = None
+
+    def get_documents(self):
+        return list(self.__documents)
+
+    def shortlist(self, descrs, size):
+        """Returns the indices of the templates that are most like the
+        descriptors of a frame, by the cosine similarity of their tf-idf
+        weighted words, best first. Templates that share no words with the
+        frame are never shortlisted.
+
+        :param size: The most templates to return
+        """
+        if not self.__documents or not len(descrs) or size <= 0:
+            return []
+        if self.__inverted is None:
+            self.__build()
+        indptr, templates, weights = self.__inverted
+
+        words, counts = np.unique(self.vocabulary.quantize(descrs), return_counts=True)
+        query = counts * self.__idf[words]
+        norm = np.sqrt((query ** 2).sum())
+        if not norm:
+            return []
+
+        # Only the posting lists of the frame's words are read
+        postings = [slice(indptr[word], indptr[word + 1]) for word in words]
+        scores = np.bincount(np.concatenate([templates[posting] for posting in postings]),
+                             np.concatenate([weights[posting] * weight for posting, weight in zip(postings, query)]),
+                             minlength=len(self.__documents)) / norm
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > size:
+            candidates = candidates[np.argpartition(-scores[candidates], size - 1)[:size]]
+        return candidates[np.argsort(-scores[candidates], kind="stable")].tolist()
+
+    def __build(self):
+        # Builds the inverted file: for every word, the templates it occurs in and its normalized tf-idf weight
+        # in them, sorted by word
+        words = np.concatenate([words for words, _ in self.__documents])
+        counts = np.concatenate([counts for _, counts in self.__documents]).astype(np.float64)
+        templates = np.repeat(np.arange(len(self.__documents)), [len(words) for words, _ in self.__documents])
+
+        template_cnts = np.bincount(words, minlength=self.vocabulary.size)
+        # Smoothed, so words that occur in every template still count for something
+        self.__idf = np.log(1 + len(self.__documents) / np.maximum(template_cnts, 1))
+
+        weights = counts * self.__idf[words]
+        norms = np.sqrt(np.bincount(templates, weights ** 2, minlength=len(self.__documents)))
+        weights /= np.maximum(norms[templates], 1e-12)
+
+        order = np.argsort(words, kind="stable")
+        indptr = np.concatenate(([0], np.cumsum(template_cnts)))
+        self.__inverted = indptr, templates[order], weights[order]
+
+
+def save_index(path, vocabulary, documents, trained_ids):
+    """Writes a vocabulary and the documents of templates to an .npz file.
+    Written to a temporary file of its own first, so neither a crash nor
+    another process saving at once leaves half a file behind. Raises OSError
+    if it can't be written.
+
+    :param documents: A dict of template ID to its document
+    :param trained_ids: The IDs of the templates the vocabulary was trained on
+    """
+    template_ids = list(documents)
+    arrays = {"level_" + str(i): level for i, level in enumerate(vocabulary.levels)}
+    arrays["template_ids"] = np.array(template_ids, dtype=str)
+    arrays["trained_ids"] = np.array(list(trained_ids), dtype=str)
+    arrays["lengths"] = np.array([len(documents[template_id][0]) for template_id in template_ids], np.intp)
+    arrays["words"] = np.concatenate([documents[template_id][0] for template_id in template_ids] + [[]])
+    arrays["counts"] = np.concatenate([documents[template_id][1] for template_id in template_ids] + [[]])
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as file:
+        try:
+            np.savez_compressed(file, **arrays)
+        except BaseException:
+            os.remove(file.name)
+            raise
+    os.replace(file.name, path)
+
+
+def load_index(path):
+    """Reads what save_index wrote.
+
+    :return: A tuple of the BinaryVocabulary, a dict of template ID to its
+        document and the list of the IDs of the templates the vocabulary was
+        trained on, or None if there is no readable file. Files written
+        before the trained templates were kept have none.
+    """
+    try:
+        with np.load(path) as data:
+            level_cnt = sum(1 for name in data.files if name.startswith("level_"))
+            vocabulary = BinaryVocabulary([data["level_" + str(i)] for i in range(level_cnt)])
+            ends = np.cumsum(data["lengths"])
+            words = np.split(data["words"].astype(np.intp), ends[:-1])
+            counts = np.split(data["counts"].astype(np.intp), ends[:-1])
+            documents = {str(template_id): (template_words, template_counts) for template_id, template_words,
+                         template_counts in zip(data["template_ids"], words, counts)}
+            trained_ids = [str(template_id) for template_id in data["trained_ids"]] \
+                if "trained_ids" in data.files else []
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        print("Warning: ignoring unreadable template index " + path + ": ", e, file=sys.stderr)
+        return None
+    return vocabulary, documents, trained_ids
+
+
+def untrained_share(trained_ids, template_ids):
+    """Returns the share of the templates a vocabulary was not trained on.
+    The more there are, the worse its words tell the templates apart.
+
+    :param trained_ids: The IDs of the templates the vocabulary was trained on
+    :param template_ids: The IDs of the current templates
+    """
+    trained_ids = set(trained_ids)
+    return sum(1 for template_id in template_ids if template_id not in trained_ids) / max(len(template_ids), 1)
+
+
+def benchmark_shortlist(tracker, frames, shortlist_sizes):
+    """Measures how often the shortlist of the tracker's template index keeps
+    the template a frame really shows, and how much faster matching gets.
+
+    :param tracker: A PlaneTracker with a template_index
+    :param frames: Images that mostly show one of the templates
+    :param shortlist_sizes: The shortlist sizes to measure
+    :return: A dict with how many "templates" and "images" there were, how
+        many images "found" a template without a shortlist, and the
+        "exact_seconds" it took to match their descriptors. Under
+        "shortlists", a dict for every size with the "size", "recall", the
+        share of found images whose template was shortlisted, "seconds" to
+        shortlist and match, and the "speedup" over matching without one.
+    """
+    original_size = tracker.shortlist_size
+    try:
+        tracker.shortlist_size = 0
+        truth = []
+        for tracked, _, _ in tracker.match_frames(frames):
+            best = max(tracked, key=lambda t: t.match_ratio, default=None)
+            truth.append(None if best is None else [id(target) for target in tracker.targets].index(id(best.target)))
+        frame_descrs = [tracker.detect_frame(frame)[1] for frame in frames]
+
+        start = time.perf_counter()
+        tracker.match_frame_descriptors(frame_descrs)
+        exact_time = time.perf_counter() - start
+
+        found = [i for i, template in enumerate(truth) if template is not None]
+        report = {"templates": len(tracker.targets), "images": len(frames), "found": len(found),
+                  "exact_seconds": exact_time, "shortlists": []}
+        for size in shortlist_sizes:
+            start = time.perf_counter()
+            shortlists = [tracker.template_index.shortlist(descrs, size) for descrs in frame_descrs]
+            tracker.match_frame_descriptors(frame_descrs, shortlists)
+            seconds = time.perf_counter() - start
+
+            kept = sum(1 for i in found if truth[i] in shortlists[i])
+            report["shortlists"].append({"size": size,
+                                         "recall": kept / len(found) if found else 1.0,
+                                         "seconds": seconds,
+                                         "speedup": exact_time / seconds if seconds else 0})
+    finally:
+        tracker.shortlist_size = original_size
+    return report